@@ -7,6 +7,8 @@ import signal, sys, os
 from timeit import default_timer as timer
 
 from lib import testbed_database
+from lib import log_setup
+from lib import results_stream
 
 
 # --------------------------------------------------------------------------------------------
@@ -28,7 +30,74 @@ except:
     print("No radio type given...going with default: TEST_TYPE")
     RADIO_TYPE = "TEST_TYPE"
 
+# Messages whose ACK carries controller timestamps (devices use them to estimate clock offset)
+CLOCK_SYNC_TYPES = ("SYNC", "TSYNC")
 
+# Messages with sequence numbers are acknowledged with one cumulative ACK per device when the
+# controller has no more input waiting, or after so many messages
+ACK_EVERY = 8
+
+# Commands for more devices are published with a topic - devices subscribe only to their own
+# topics, so the publish socket doesn't send them commands for other devices:
+#   All, Cluster:<Ansible inventory group>, Tech:<radio technology>
+TOPIC_ALL = "All"
+TOPIC_PREFIXES = ("Cluster:", "Tech:")
+
+# ZMTP heartbeats on backend sockets - connections of dead devices are closed (in ms)
+HEARTBEAT_IVL = 1000
+HEARTBEAT_TIMEOUT = 5000
+
+# Results streamed by devices during the experiment are stored here (None = don't receive them)
+RESULTS_STREAM_DIR = "results"
+
+
+
+
+# --------------------------------------------------------------------------------------------
+# True if address is a topic of the publish socket (command for more devices)
+# --------------------------------------------------------------------------------------------
+def is_topic(adr):
+    return adr == TOPIC_ALL or (adr.startswith(TOPIC_PREFIXES) and " " not in adr)
+
+
+
+# --------------------------------------------------------------------------------------------
+# Sequence numbers received from one device
+# --------------------------------------------------------------------------------------------
+class receive_window():
+
+    def __init__(self):
+        self.base = 0           # All messages up to base were received
+        self.above = set()      # Received messages above base (some before them are missing)
+        self.unacked = 0        # Messages received since the last ACK
+
+    # ----------------------------------------------------------------------------------------
+    # Mark message as received.
+    #
+    #   @params:    seq - sequence number of the message
+    #               low - the lowest sequence number device still waits ACK for (lower ones
+    #                     were dropped, so we don't wait for them anymore)
+    #   @return:    False if message was already received (retransmission)
+    # ----------------------------------------------------------------------------------------
+    def receive(self, seq, low):
+        self.unacked += 1
+
+        if low - 1 > self.base:
+            self.base = low - 1
+            self.above = {s for s in self.above if s > self.base}
+
+        if seq <= self.base or seq in self.above:
+            self._advance()
+            return False
+
+        self.above.add(seq)
+        self._advance()
+        return True
+
+    def _advance(self):
+        while self.base + 1 in self.above:
+            self.base += 1
+            self.above.remove(self.base)
 
 
 
@@ -55,16 +124,39 @@ class zmq_broker():
         # Socket for publishing LGTC commands
         self.backend_pub = context.socket(zmq.PUB)
         self.backend_pub.sndhwm = 1100000
+        self.backend_pub.heartbeat_ivl = HEARTBEAT_IVL
+        self.backend_pub.heartbeat_timeout = HEARTBEAT_TIMEOUT
         self.backend_pub.bind('tcp://*:5561')
 
         # Socket to get responses from LGTC
         self.backend = context.socket(zmq.ROUTER)
+        self.backend.heartbeat_ivl = HEARTBEAT_IVL
+        self.backend.heartbeat_timeout = HEARTBEAT_TIMEOUT
         self.backend.bind('tcp://*:5562')
 
+        # Socket to get live results from LGTC (port 5564)
+        self.results = None
+        if RESULTS_STREAM_DIR:
+            self.results = results_stream.results_receiver(RESULTS_STREAM_DIR)
+
         # Configure poller
         self.poller = zmq.Poller()
         self.poller.register(self.backend, zmq.POLLIN)
         self.poller.register(self.frontend, zmq.POLLIN)
+        if self.results:
+            self.poller.register(self.results.socket, zmq.POLLIN)
+
+        # Time when the last message from backend was received
+        self.rx_time = None
+
+        # Sequence numbers of every device and devices which are waiting for cumulative ACK
+        self.windows = {}
+        self.acks_due = set()
+
+        # Statistics
+        self.backend_rx = 0
+        self.backend_tx = 0
+        self.backend_batches = 0
 
 
 
@@ -81,24 +173,79 @@ class zmq_broker():
             return "BACKEND"
         elif sockets.get(self.frontend) == zmq.POLLIN:
             return "FRONTEND"
+        elif self.results and sockets.get(self.results.socket) == zmq.POLLIN:
+            return "RESULTS"
         else:
             return None
 
 
 
     # ----------------------------------------------------------------------------------------
-    # Read received message from backend socket. 
+    # Read received message from backend socket. Device can send a batch of messages in one
+    # multipart message: [BATCH, nbr, data, seq, nbr, data, seq, ...]
     #
-    #   @return:    nbr - number of received message (-1 means SYSTEM message)
+    #   @return:    list of received messages (nbr, adr, data, seq)
+    #               nbr - number of received message (-1 means SYSTEM message)
     #               adr - name of the device that sent the message
     #               data - ...
+    #               seq - sequence number (None if device doesn't wait for cumulative ACK),
+    #                     -1 if message was already received (retransmission)
     # ----------------------------------------------------------------------------------------
     def backend_receive(self):
         self.log.debug("Received from backend...")
 
-        adr, nbr, data = self.backend.recv_multipart()
+        msg = self.backend.recv_multipart()
+        # Receive time for clock sync ACKs
+        self.rx_time = time.time()
 
-        return nbr.decode(), adr.decode(), data.decode()
+        adr = msg[0].decode()
+        if msg[1] == b"BATCH":
+            parts = [msg[i:i + 3] for i in range(2, len(msg), 3)]
+            self.backend_batches += 1
+        else:
+            parts = [msg[1:]]
+
+        messages = []
+        for p in parts:
+            nbr, data = p[0].decode(), p[1].decode()
+
+            # Message with sequence number: "<seq> <lowest seq waiting for ACK>"
+            seq = None
+            if len(p) > 2:
+                seq, low = (int(x) for x in p[2].split())
+                window = self.windows.setdefault(adr, receive_window())
+                if not window.receive(seq, low):
+                    self.log.debug("Retransmitted message [%s] %d from %s", nbr, seq, adr)
+                    seq = -1
+                self.acks_due.add(adr)
+
+            messages.append((nbr, adr, data, seq))
+
+        self.backend_rx += len(messages)
+        if adr in self.acks_due and self.windows[adr].unacked >= ACK_EVERY:
+            self.backend_ack(adr)
+
+        return messages
+
+
+    # ----------------------------------------------------------------------------------------
+    # Send cumulative ACK to the device - all messages up to base were received
+    # ----------------------------------------------------------------------------------------
+    def backend_ack(self, adr):
+        window = self.windows[adr]
+        self.backend_send("CACK", adr, str(window.base))
+        window.unacked = 0
+        self.acks_due.discard(adr)
+
+    # Send cumulative ACKs to all devices which are waiting for them
+    def backend_ack_all(self):
+        for adr in list(self.acks_due):
+            self.backend_ack(adr)
+
+    # New session of the device (SYNC) - it starts sequence numbers from the beginning
+    def backend_reset(self, adr):
+        self.windows.pop(adr, None)
+        self.acks_due.discard(adr)
 
 
     # ----------------------------------------------------------------------------------------
@@ -106,22 +253,25 @@ class zmq_broker():
     #
     #   @params:    nbr - number of sent message (-1 means SYSTEM message)
     #               adr - name of targeted device
-    #                     if adr is "All" send message to all devices (publish socket)           
+    #                     if adr is a topic ("All", "Cluster:<name>", "Tech:<name>") publish
+    #                     message to all devices subscribed to it
     #               data - ...
     # ----------------------------------------------------------------------------------------
     def backend_send(self, nbr, adr, data):
 
-        if adr == "All":
-            self.log.debug("Publish message [%s]: %s" % (nbr, data))
+        if is_topic(adr):
+            self.log.debug("Publish message [%s] to %s: %s", nbr, adr, data)
 
-            cmd ="%s %s" % (nbr, data)
+            cmd ="%s %s %s" % (adr, nbr, data)
             self.backend_pub.send(cmd.encode())
 
         else:
-            self.log.debug("Router send message [%s]: %s to device %s" % (nbr, data, adr))
+            self.log.debug("Router send message [%s]: %s to device %s", nbr, data, adr)
 
             self.backend.send_multipart([adr.encode(), nbr.encode(), data.encode()])
 
+        self.backend_tx += 1
+
 
 
 
@@ -150,7 +300,7 @@ class zmq_broker():
     #               data - ...
     # ----------------------------------------------------------------------------------------
     def frontend_send(self, nbr, adr, data):
-        self.log.debug("Send to frontend: [" + nbr +"|" + adr + "|" + data +"]")
+        self.log.debug("Send to frontend: [%s|%s|%s]", nbr, adr, data)
 
         self.frontend.send_multipart(
             [self.controller_server_id, nbr.encode(), adr.encode(), data.encode()])
@@ -174,7 +324,7 @@ class zmq_broker():
     #               
     # ----------------------------------------------------------------------------------------
     def frontend_info(self, device, info):
-        self.log.debug("Send info to frontend: " + info)
+        self.log.debug("Send info to frontend: %s", info)
 
         self.frontend.send_multipart(
             [self.controller_server_id, b"INFO", device.encode(), info.encode()])
@@ -193,13 +343,14 @@ if __name__ == "__main__":
     # For gracefull stop with $docker stop command
     signal.signal(signal.SIGTERM, sigterm_handler)
 
-    # Config logging module format for all scripts. 
-    # Log level is defined in each submodule with var LOG_LEVEL.
-    logging.basicConfig(format="%(asctime)s [%(levelname)7s]:[%(name)16s > %(funcName)16s() > %(lineno)3s] - %(message)s", level=LOG_LEVEL, filename=LOGGING_FILENAME)
+    # Config logging module format for all scripts - records are written into the file by
+    # a listener thread. Log level is defined in each submodule with var LOG_LEVEL and can
+    # be changed with LOG_<LEVEL>[:<module>] command sent to "Controller".
+    log_setup.setup(LOGGING_FILENAME, "%(asctime)s [%(levelname)7s]:[%(name)16s > %(funcName)16s() > %(lineno)3s] - %(message)s", LOG_LEVEL)
     #logging.basicConfig(format="[%(levelname)5s:%(funcName)16s() > %(module)17s] %(message)s", level=LOG_LEVEL)
     log = logging.getLogger("main")
 
-    log.info("New experiment " + RADIO_TYPE + " with " + str(NUMBER_OF_DEVICES) + " devices available!")
+    log.info("New experiment %s with %d devices available!", RADIO_TYPE, NUMBER_OF_DEVICES)
     
     # Init ZMQ 
     broker = zmq_broker()
@@ -224,7 +375,12 @@ if __name__ == "__main__":
     try:
         while True:
 
-            inp = broker.check_input(100)
+            # With ACKs due, only check for input - when there is none, send ACKs
+            inp = broker.check_input(0 if broker.acks_due else 100)
+
+            if inp is None and broker.acks_due:
+                broker.backend_ack_all()
+                continue
 
             # ------------------------------------------------------------------------------------
             # FRONTEND --> BACKEND
@@ -237,10 +393,14 @@ if __name__ == "__main__":
                     log.debug(db.get_tb_state_str)
                     broker.frontend_send(msg_type, "Controller", str(db.get_tb_state_json()))
 
+                # LOG LEVEL - of controller modules
+                elif address == "Controller" and arguments.startswith(log_setup.LEVEL_COMMAND):
+                    broker.frontend_info("Controller", log_setup.level_command(arguments))
+
                 # FORWARD COMMAND - to LGTC devices
                 else:
                     # Addres must be in database, otherwise it is not active
-                    if db.is_dev(address) or (address == "All"):
+                    if db.is_dev(address) or is_topic(address):
                         sqn = msg_type
                         broker.backend_send(sqn, address, arguments)
                     else:
@@ -251,55 +411,83 @@ if __name__ == "__main__":
             # ------------------------------------------------------------------------------------
             # BACKEND --> FRONTEND 
             elif inp == "BACKEND":
-                msg_type, device, data = broker.backend_receive()
-
-                # Send ACK back to backend - argument is message to be acknowledged
-                broker.backend_send("ACK", device, msg_type)
-
-                # SYSTEM MESSAGES
-                if msg_type == "SYNC":
-
-                    # If device come to experiment add it do database
-                    if not db.is_dev(device):
-                        db.insert_dev(device, "ONLINE")
-                        broker.frontend_deviceUpdate(device, "ONLINE")
-                        log.info("New device " + device)
-
-                        subscribers += 1
-                        if subscribers == NUMBER_OF_DEVICES:
-                            log.info("All devices ("+ str(NUMBER_OF_DEVICES) +") active")
-                            broker.frontend_info("Controller", "All devices (" + str(NUMBER_OF_DEVICES) +") available!")
-
-                    else:
-                        log.warning("Device %s allready in the experiment" % device)
-                        # TODO send END command to LGTC with stated reason
-
-                # TODO - tega ne uporablja client nikjer
-                elif msg_type == "ERROR":
-                    # Device encountered an error and stopped working
-                    db.remove_dev(device)
-                    broker.frontend_deviceUpdate(device, "OFFLINE")
-                    log.warning("Device %s send ERROR message..." % address)
-
-                # DEVICE STATE UPDATE
-                elif msg_type == "STATE":
-                    db.update_dev_state(device, data)
-                    broker.frontend_deviceUpdate(device, data)
-                    log.info("New state of device %s: %s" % (device, data))
-
-                # DEVICE INFO
-                elif msg_type == "INFO":
-                    broker.frontend_info(device, data)
+                for msg_type, device, data, seq in broker.backend_receive():
+
+                    # Send ACK back to backend - argument is message to be acknowledged
+                    # Clock sync ACK also carries our receive and send time, so device can estimate its clock offset
+                    # Messages with sequence number get cumulative ACK later
+                    if msg_type in CLOCK_SYNC_TYPES:
+                        broker.backend_send("ACK", device, "%s %.6f %.6f" % (msg_type, broker.rx_time, time.time()))
+                    elif seq is None:
+                        broker.backend_send("ACK", device, msg_type)
+
+                    # Retransmission - we already handled it, device only needs ACK
+                    if seq == -1:
+                        pass
+
+                    # SYSTEM MESSAGES
+                    elif msg_type == "SYNC":
+
+                        # New session of the device - sequence numbers start from the beginning
+                        # Device reconnected - it continues its sequence numbers (and replays
+                        # messages without ACK), it will also send us its state
+                        if data != "RECONNECT":
+                            broker.backend_reset(device)
+
+                        # If device come to experiment add it do database
+                        # (also devices which reconnect after the controller was restarted)
+                        if not db.is_dev(device):
+                            db.insert_dev(device, "ONLINE")
+                            broker.frontend_deviceUpdate(device, "ONLINE")
+                            log.info("New device %s", device)
+
+                            subscribers += 1
+                            if subscribers == NUMBER_OF_DEVICES:
+                                log.info("All devices ("+ str(NUMBER_OF_DEVICES) +") active")
+                                broker.frontend_info("Controller", "All devices (" + str(NUMBER_OF_DEVICES) +") available!")
+
+                        elif data == "RECONNECT":
+                            log.info("Device %s reconnected", device)
+
+                        else:
+                            log.warning("Device %s allready in the experiment", device)
+                            # TODO send END command to LGTC with stated reason
+
+                    # Periodic clock re-sync - ACK was all the device needed
+                    elif msg_type == "TSYNC":
+                        pass
+
+                    # TODO - tega ne uporablja client nikjer
+                    elif msg_type == "ERROR":
+                        # Device encountered an error and stopped working
+                        db.remove_dev(device)
+                        broker.frontend_deviceUpdate(device, "OFFLINE")
+                        log.warning("Device %s send ERROR message...", device)
+
+                    # DEVICE STATE UPDATE
+                    elif msg_type == "STATE":
+                        db.update_dev_state(device, data)
+                        broker.frontend_deviceUpdate(device, data)
+                        log.info("New state of device %s: %s", device, data)
+
+                    # DEVICE INFO
+                    elif msg_type == "INFO":
+                        broker.frontend_info(device, data)
                 
-                # EXPERIMENT COMMAND RESPONSE
-                else:
-                    # Forward response back to the server
-                    # msg_type is a command SEQUENCE NUMBER 
-                    broker.frontend_send(msg_type, device, data)
-                    log.debug("Response number [%s] from device %s: %s" % (msg_type, device, data))
+                    # EXPERIMENT COMMAND RESPONSE
+                    else:
+                        # Forward response back to the server
+                        # msg_type is a command SEQUENCE NUMBER 
+                        broker.frontend_send(msg_type, device, data)
+                        log.debug("Response number [%s] from device %s: %s", msg_type, device, data)
 
 
 
+            # ------------------------------------------------------------------------------------
+            # RESULTS STREAM - append batch of results to the file of the device
+            elif inp == "RESULTS":
+                broker.results.receive()
+
             # -----------------------------------------------------------------------------------
             # HEARTBEAT - TODO
             #else:
@@ -330,4 +518,9 @@ if __name__ == "__main__":
         broker.frontend_send("EXP_STOP", "", "")
         broker.frontend_info("Controller", "\n Experiment ended! \n -----------------")
 
+        if broker.results:
+            broker.results.close()
+
+        log.info("Backend messages: %d received (%d batches), %d sent", broker.backend_rx, broker.backend_batches, broker.backend_tx)
+
         log.info("End of controller main loop...")
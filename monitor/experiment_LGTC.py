@@ -9,6 +9,8 @@ import logging
 import time
 
 from lib import zmq_client
+from lib import log_setup
+from lib import thread_queue
 
 import BLE_experiment
 
@@ -30,12 +32,12 @@ class ECMS_client():
     # ----------------------------------------------------------------------------------------
     # INIT
     # ----------------------------------------------------------------------------------------
-    def __init__(self, input_q, output_q, lgtc_id, subscriber, router):
+    def __init__(self, input_q, output_q, lgtc_id, subscriber, router, topics=()):
 
         self.log = logging.getLogger(__name__)
         self.log.setLevel(LOG_LEVEL)
 
-        self.client = zmq_client.zmq_client(subscriber, router, lgtc_id)
+        self.client = zmq_client.zmq_client(subscriber, router, lgtc_id, topics=topics)
 
         self._controller_died = False
         self._is_app_running = False
@@ -61,16 +63,30 @@ class ECMS_client():
             self.log.error("Couldn't synchronize with broker...")
             self.queuePut("0", "CONTROLLER_DIED")
 
+        # Experiment thread wakes us up through the wakeup descriptor of the queue
+        self.client.add_wakeup(self.in_q.fileno())
+
         # ------------------------------------------------------------------------------------
         while True:
 
+            # Sleep until a message comes or until the next ACK retransmission
+            ready = self.client.wait(self.client.send_retry())
+
+            # Controller came back (or was restarted) - it still needs our state
+            if self.client.reconnected:
+                self.client.reconnected = False
+                self.updateState(self.getState())
+
+            if "WAKEUP" in ready:
+                self.in_q.clear_wakeup()
+
             # --------------------------------------------------------------------------------
             # If there is a message from experiment thread
-            if not self.in_q.empty():
+            while not self.in_q.empty():
 
                 sequence, response = self.in_q.get()
 
-                self.log.debug("Received response from apk thread [" + sequence + "]: " + response)
+                self.log.debug("Received response from apk thread [%s]: %s", sequence, response)
 
                 if sequence == "STATE":
                     self.updateState(response)
@@ -84,13 +100,13 @@ class ECMS_client():
             # --------------------------------------------------------------------------------
             # If there is some incoming commad from the controller broker
             inp = self.client.check_input(0)
-            if inp:
+            while inp:
                 sqn, msg = self.client.receive_async(inp)
 
                 # if not ACK
                 if sqn:
 
-                    self.log.debug("Received command from broker: [" + sqn + "] " + msg)
+                    self.log.debug("Received command from broker: [%s] %s", sqn, msg)
 
                     # STATE COMMAND
                     # Return the state of the node
@@ -113,19 +129,22 @@ class ECMS_client():
                         elif msg == "STOP":
                             experiment_thread.stop()
 
+                        elif msg.startswith(log_setup.LEVEL_COMMAND):
+                            self.sendCmdResp(sqn, log_setup.level_command(msg))
+
                         else:
                             # Forward it to the experiment
                             self.queuePut(sqn, msg)
 
-            # --------------------------------------------------------------------------------
-            # If there is still some message that didn't receive ACK back from server, re send it
-            elif (len(self.client.waitingForAck) != 0):
-                self.client.send_retry()
-                #TODO self.queuePut(["-1", "BROKER_DIED"])
+                inp = self.client.check_input(0)
+
+            # Loop over commands ended with EXIT
+            if inp:
+                break
 
         # ------------------------------------------------------------------------------------
         self.log.debug("Exiting client thread")
-        #self.client.close()
+        self.client.close()
 
 
     # ----------------------------------------------------------------------------------------
@@ -167,17 +186,17 @@ class ECMS_client():
         self.__LGTC_STATE = state
         # TODO check if state is possible, else set state LGTC_WARNING
         self.client.transmit_async(["STATE", state])
-        self.log.debug("Updating state: " + state)
+        self.log.debug("Updating state: %s", state)
 
     # Send info to the server (WARNING: async method used...)
     def sendInfoResp(self, info):
         self.client.transmit_async(["INFO", info])
-        self.log.debug("Sending info to the controller" + info)
+        self.log.debug("Sending info to the controller: %s", info)
 
     # Send respond to the server (WARNING: async method used...)
     def sendCmdResp(self, sqn, resp):
         self.client.transmit_async([sqn, resp])
-        self.log.debug("Sending response("+ sqn +") to the controller: " + resp)
+        self.log.debug("Sending response(%s) to the controller: %s", sqn, resp)
 
 
 
@@ -202,6 +221,12 @@ if __name__ == "__main__":
     RESULTS_FILENAME += ("_" + LGTC_ID + ".txt")
     LOGGING_FILENAME += ("_" + LGTC_ID + ".log")
 
+    # Broadcast commands for our clusters (Ansible inventory groups) and technology - given by
+    # release_targets.yml, besides commands for all devices
+    CLUSTERS = os.environ.get("CLUSTER", "").split(",")
+    TECHNOLOGY = os.environ.get("TECHNOLOGY")
+    TOPICS = zmq_client.node_topics(CLUSTERS, TECHNOLOGY)
+
     """
     try:
         APP_DIRECTORY = sys.argv[2]
@@ -224,8 +249,10 @@ if __name__ == "__main__":
     # LOGGING CONFIG
     # ------------------------------------------------------------------------------------
 
-    # Config logging module format for all scripts. Log level is defined in each submodule with var LOG_LEVEL.
-    logging.basicConfig(format="%(asctime)s [%(levelname)7s]:[%(module)26s > %(funcName)16s() > %(lineno)3s] - %(message)s", level=LOG_LEVEL, filename=LOGGING_FILENAME)
+    # Config logging module format for all scripts - records are written into the file by a listener
+    # thread. Log level is defined in each submodule with var LOG_LEVEL and can be changed with
+    # LOG_<LEVEL>[:<module>] command.
+    log_setup.setup(LOGGING_FILENAME, log_setup.LOG_FORMAT, LOG_LEVEL)
     #logging.basicConfig(format="[%(levelname)5s:%(funcName)16s() > %(module)17s] %(message)s", level=LOG_LEVEL)
 
     #logging.info("Testing application " + APP_NAME + " for " + str(APP_DURATION) + " minutes on device " + LGTC_NAME + "!")
@@ -237,8 +264,8 @@ if __name__ == "__main__":
     # Create 2 queue for communication between threads
     # Client -> Experiment
     C_E_QUEUE = Queue()
-    # Experiment -> Clinet
-    E_C_QUEUE = Queue()
+    # Experiment -> Clinet (with wakeup descriptor, so client can sleep in poll)
+    E_C_QUEUE = thread_queue.wakeup_queue()
 
 
     experiment_thread = BLE_experiment(C_E_QUEUE, E_C_QUEUE, RESULTS_FILENAME, LGTC_NAME)
@@ -248,7 +275,7 @@ if __name__ == "__main__":
     # ------------------------------------------------------------------------------------
 
     # Start main thread - zmq client (communication with controller)
-    client_thread = ECMS_client(E_C_QUEUE, C_E_QUEUE, LGTC_NAME, SUBSCR_HOSTNAME, ROUTER_HOSTNAME)
+    client_thread = ECMS_client(E_C_QUEUE, C_E_QUEUE, LGTC_NAME, SUBSCR_HOSTNAME, ROUTER_HOSTNAME, TOPICS)
     client_thread.run()
 
     # Ce pridemo sem, pomeni da se je client thread ustavil --> konec eksperimenta
@@ -1,16 +1,20 @@
 
 #!/usr/bin/python3
 import threading
-from queue import Queue
 
 import sys
 import os
+import time
 import logging
 from timeit import default_timer as timer
 from subprocess import Popen, PIPE
+from queue import Full
 
 from lib import zmq_client
 from lib import serial_monitor_thread
+from lib import thread_queue
+from lib import timer_scheduler
+from lib import log_setup
 
 
 # DEFINITIONS
@@ -22,6 +26,29 @@ SUBSCR_HOSTNAME = "tcp://193.2.205.19:5561"
 RESULTS_FILENAME = "node_results"
 LOGGING_FILENAME = "logger"
 
+# Send messages to the controller in batches (few ms linger, newer STATE replaces older)
+ZMQ_BATCHING = False
+
+CLOCK_SYNC_INTERVAL = 60    # How often to re-estimate clock offset to the controller (in seconds, 0 = never)
+
+# Max number of messages waiting in queues between threads
+C_M_QUEUE_SIZE = 100
+M_C_QUEUE_SIZE = 1000
+
+# How long the client thread waits for space in C_M queue (monitor thread may be gone or stuck)
+C_M_PUT_TIMEOUT = 1         # In seconds
+
+# Only the latest clock offset estimate must reach the monitor thread
+C_M_QUEUE_POLICIES = {
+    "SYS": thread_queue.POLICY_COALESCE,
+}
+
+# What to do with a message from the monitor thread when M_C queue is full (responses block)
+M_C_QUEUE_POLICIES = {
+    "STATE": thread_queue.POLICY_COALESCE,      # Only the latest state matters
+    "INFO": thread_queue.POLICY_DROP_OLDEST,
+}
+
 
 
 class ECMS_client():
@@ -29,169 +56,243 @@ class ECMS_client():
     # ----------------------------------------------------------------------------------------
     # INIT
     # ----------------------------------------------------------------------------------------
-    def __init__(self, input_q, output_q, lgtc_id, subscriber, router):
+    def __init__(self, input_q, output_q, lgtc_id, subscriber, router, topics=()):
 
         self.log = logging.getLogger(__name__)
         self.log.setLevel(LOG_LEVEL)
         
-        self.client = zmq_client.zmq_client(subscriber, router, lgtc_id)
+        self.client = zmq_client.zmq_client(subscriber, router, lgtc_id, batching=ZMQ_BATCHING, topics=topics)
 
-        self._controller_died = False
         self._is_app_running = False
 
         self.in_q = input_q
         self.out_q = output_q
 
         self.__LGTC_STATE = "OFFLINE"
-        self._UPTIME = 0
+        self._start_time = time.monotonic()
+
+        # Deadlines (clock sync...)
+        self.timers = timer_scheduler.timer_scheduler()
 
 
     # ----------------------------------------------------------------------------------------
     # MAIN
+    # Thread sleeps in one poll on both ZMQ sockets and wakeup descriptor of the input queue
+    # (monitor thread writes into it with every message) until something comes or until the
+    # next deadline (timers, ACK retransmissions, batch of messages).
     # ----------------------------------------------------------------------------------------
     def run(self):
 
-        # Sync with broker with timeout of 10 seconds
-        self.log.info("Sync with broker ... ")
-        self.client.transmit(["SYNC", "SYNC"])
-        if self.client.wait_ack("SYNC", 10) is False:
-            self.log.error("Couldn't synchronize with broker...")
-            self._controller_died = True
+        self.client.add_wakeup(self.in_q.fileno())
+
+        # Keep clock offset to the controller up to date
+        if CLOCK_SYNC_INTERVAL:
+            self.timers.call_every(CLOCK_SYNC_INTERVAL, self.clockSync)
 
         # ------------------------------------------------------------------------------------
-        loop_time = timer()
-        while True:
+        running = True
+        while running:
 
-            # --------------------------------------------------------------------------------
-            # Count seconds
-            if ((timer() - loop_time) > 1):
-                self._UPTIME += (timer() - loop_time)
-                loop_time = timer()
+            # Run expired timers, resend messages without ACK, send batch when its linger
+            # time passed - and sleep until the first of the next deadlines
+            timeout = self.timers.run_due()
+            for t in (self.client.send_retry(), self.client.flush_due()):
+                if t is not None and (timeout is None or t < timeout):
+                    timeout = t
+
+            ready = self.client.wait(timeout)
+
+            # Controller came back (or was restarted) - client replayed messages without ACK,
+            # controller still needs our state
+            if self.client.reconnected:
+                self.client.reconnected = False
+                self.updateState(self.getState())
 
             # --------------------------------------------------------------------------------
-            # If there is a message from experiment thread
-            if not self.in_q.empty():
+            # Messages from experiment thread
+            if "WAKEUP" in ready:
+                self.in_q.clear_wakeup()
 
+            while running and not self.in_q.empty():
                 sequence, response = self.in_q.get()
+                running = self.handleResponse(sequence, response)
 
-                self.log.debug("Received response from apk thread [" + sequence + "]: " + response)
+            # --------------------------------------------------------------------------------
+            # Incoming commands from the controller broker
+            while running:
+                inp = self.client.check_input(0)
+                if not inp:
+                    break
+                sqn, cmd = self.client.receive_async(inp)
+                running = self.handleCommand(sqn, cmd)
 
-                if sequence == "STATE":
-                    self.updateState(response)
+        # ------------------------------------------------------------------------------------
+        self.client.flush_batch()
+        self.log.debug("Exiting client thread")
+        self.client.close()
 
-                elif sequence == "INFO":
 
-                    if response == "JOIN_DAG":
-                        self.updateState("JOINED_NETWORK")
-                        self.log.debug("Device joined RPL network!")
+    # ----------------------------------------------------------------------------------------
+    # Message from experiment (monitor) thread
+    #
+    #   @return:    False if client thread must stop
+    # ----------------------------------------------------------------------------------------
+    def handleResponse(self, sequence, response):
 
-                    elif response == "EXIT_DAG":
-                        self.updateState("EXITED_NETWORK")
-                        self.log.debug("Device exited RPL network!")
+        self.log.debug("Received response from apk thread [%s]: %s", sequence, response)
 
-                    else:
-                        self.sendInfoResp(response)
+        if sequence == "STATE":
+            self.updateState(response)
 
-                else:
-                    if response == "VTRIP":
-                        self.sendCmdResp(sequence, "ROUNDTRIP")
+        elif sequence == "INFO":
 
-                    elif response == "START":
-                        self._is_app_running = True
-                        self.updateState("RUNNING")
-                        self.log.debug("Application started!")
-                    
-                    elif response == "STOP":
-                        self._is_app_running = False
-                        self.updateState("STOPPED")
-                    
-                    elif response == "END":
-                        self._is_app_running = False
-                        self.updateState("FINISHED")
+            if response == "JOIN_DAG":
+                self.updateState("JOINED_NETWORK")
+                self.log.debug("Device joined RPL network!")
 
-                        if self._controller_died:
-                            break
+            elif response == "EXIT_DAG":
+                self.updateState("EXITED_NETWORK")
+                self.log.debug("Device exited RPL network!")
 
-                    elif response == "ROOT":
-                        self.updateState("DAG_ROOT")
-                        self.sendCmdResp(sequence, "Device is now RPL DAG root!")
-                    
-                    # Forward command to the controller
-                    else:
-                        self.sendCmdResp(sequence, response)
+            else:
+                self.sendInfoResp(response)
+
+        else:
+            if response == "VTRIP":
+                self.sendCmdResp(sequence, "ROUNDTRIP")
+
+            elif response == "START":
+                self._is_app_running = True
+                self.updateState("RUNNING")
+                self.log.debug("Application started!")
             
-            # --------------------------------------------------------------------------------
-            # If there is some incoming commad from the controller broker
-            inp = self.client.check_input(0)
-            if inp:
-                sqn, cmd = self.client.receive_async(inp)
+            elif response == "STOP":
+                self._is_app_running = False
+                self.updateState("STOPPED")
+            
+            elif response == "END":
+                self._is_app_running = False
+                self.updateState("FINISHED")
 
-                # if not ACK
-                if sqn:
+                # Nobody to report to - controller isn't (back) online
+                if not self.client.synced:
+                    return False
+
+            elif response == "ROOT":
+                self.updateState("DAG_ROOT")
+                self.sendCmdResp(sequence, "Device is now RPL DAG root!")
+            
+            # Forward command to the controller
+            else:
+                self.sendCmdResp(sequence, response)
 
-                    self.log.debug("Received command from broker: [" + sqn + "] " + cmd)
+        return True
+
+
+    # ----------------------------------------------------------------------------------------
+    # Message from the controller
+    #
+    #   @return:    False if client thread must stop
+    # ----------------------------------------------------------------------------------------
+    def handleCommand(self, sqn, cmd):
+
+        # ACK on clock sync brought new offset estimate
+        if self.client.clock_updated:
+            self.clockUpdated()
+
+        # if not ACK
+        if sqn:
+
+            self.log.debug("Received command from broker: [%s] %s", sqn, cmd)
+            
+            # STATE COMMAND
+            # Return the state of the node
+            if sqn == "STATE":
+                self.updateState(self.getState())
+
+            # EXPERIMENT COMMAND
+            else:
+                # Evaluation 
+                if cmd == "ROUNDTRIP":
+                    # First to test roundtrip to VESNA
+                    #self.queuePut(sqn, "VTRIP")
+                    # Second to test roundtrip to LGTC
+                    self.sendCmdResp(sqn, "ROUNDTRIP")
                     
-                    # STATE COMMAND
-                    # Return the state of the node
-                    if sqn == "STATE":
-                        self.updateState(self.getState())
+                elif cmd == "EXIT":
+                    self.updateState("OFFLINE")
+                    self.log.info("Closing client thread.")
+                    return False
+
+                elif cmd == "FLASH":
+                    self.log.debug("Flash obsolete..delete me")
+
+                elif cmd == "RESET":
+                    self.log.debug("Reset obsolete..delete me")
+                
+                elif cmd == "START":
+                    if self._is_app_running == True:
+                        self.sendCmdResp(sqn, "App is allready running...")
+                    else:
+                        self.queuePut(sqn, cmd)
 
-                    # EXPERIMENT COMMAND
+                elif cmd == "STOP":
+                    if self._is_app_running == False:
+                        self.sendCmdResp(sqn, "No application running ...")
                     else:
-                        # Evaluation 
-                        if cmd == "ROUNDTRIP":
-                            # First to test roundtrip to VESNA
-                            #self.queuePut(sqn, "VTRIP")
-                            # Second to test roundtrip to LGTC
-                            self.sendCmdResp(sqn, "ROUNDTRIP")
-                            
-                        elif cmd == "EXIT":
-                            self.updateState("OFFLINE")
-                            self.log.info("Closing client thread.")
-                            break
-
-                        elif cmd == "FLASH":
-                            self.log.debug("Flash obsolete..delete me")
-
-                        elif cmd == "RESET":
-                            self.log.debug("Reset obsolete..delete me")
-                        
-                        elif cmd == "START":
-                            if self._is_app_running == True:
-                                self.sendCmdResp(sqn, "App is allready running...")
-                            else:
-                                self.queuePut(sqn, cmd)
-
-                        elif cmd == "STOP":
-                            if self._is_app_running == False:
-                                self.sendCmdResp(sqn, "No application running ...")
-                            else:
-                                self.queuePut(sqn, cmd)
-
-                        elif cmd == "RESTART":
-                            self.log.info("Restart the application") #TODO
-
-                        elif cmd == "DURATION":
-                            resp = "Defined duration: " + str(APP_DUR) + " minutes"
-                            self.sendCmdResp(sqn, resp)
-
-                        elif cmd == "UPTIME":
-                            resp = "Node is online for: " + str(self._UPTIME) + " seconds"
-                            self.sendCmdResp(sqn, resp)
-
-                        # All other commands are forwarded to the VESNA device
-                        else:
-                            self.queuePut(sqn, cmd)
+                        self.queuePut(sqn, cmd)
 
-            # --------------------------------------------------------------------------------
-            # If there is still some message that didn't receive ACK back from server, re send it
-            elif (len(self.client.waitingForAck) != 0):
-                self.client.send_retry()
-                #TODO self.queuePut(["-1", "BROKER_DIED"])
+                elif cmd == "RESTART":
+                    self.log.info("Restart the application") #TODO
 
-        # ------------------------------------------------------------------------------------
-        self.log.debug("Exiting client thread")
-        #self.client.close()
+                elif cmd == "DURATION":
+                    resp = "Defined duration: " + str(APP_DUR) + " minutes"
+                    self.sendCmdResp(sqn, resp)
+
+                elif cmd == "UPTIME":
+                    resp = "Node is online for: " + str(self.getUptime()) + " seconds"
+                    self.sendCmdResp(sqn, resp)
+
+                elif cmd == "CLOCK":
+                    self.sendCmdResp(sqn, self.getClockOffset())
+
+                elif cmd == "QUEUES":
+                    self.sendCmdResp(sqn, self.getQueueStats())
+
+                elif cmd == "ACKS":
+                    self.sendCmdResp(sqn, self.client.ack_stats())
+
+                elif cmd == "TOPICS":
+                    self.sendCmdResp(sqn, "Topics: " + ", ".join(sorted(self.client.topics)))
+
+                elif cmd.startswith(log_setup.LEVEL_COMMAND):
+                    self.sendCmdResp(sqn, log_setup.level_command(cmd))
+
+                # All other commands are forwarded to the VESNA device
+                else:
+                    self.queuePut(sqn, cmd)
+
+        return True
+
+
+    # ----------------------------------------------------------------------------------------
+    # SYNC
+    # Register to the broker with timeout of 10 seconds. Controller ACK carries its timestamps,
+    # so we also get the first estimate of our clock offset.
+    #
+    #   @return:    True if broker acknowledged the SYNC
+    # ----------------------------------------------------------------------------------------
+    def sync(self):
+        self.log.info("Sync with broker ... ")
+        self.client.transmit(["SYNC", "SYNC"])
+        if self.client.wait_ack("SYNC", 10) is False:
+            self.log.error("Couldn't synchronize with broker...")
+            return False
+
+        if self.client.clock_updated:
+            self.client.clock_updated = False
+            self.log.info(self.getClockOffset())
+        return True
 
 
     # ----------------------------------------------------------------------------------------
@@ -215,8 +316,16 @@ class ECMS_client():
     # OTHER FUNCTIONS
     # ----------------------------------------------------------------------------------------
 
+    # Client thread must never block on the monitor thread - if there is no space in the
+    # queue, the command is dropped and reported
     def queuePut(self, sequence, command):
-        self.out_q.put([sequence, command])
+        try:
+            self.out_q.put([sequence, command], timeout=C_M_PUT_TIMEOUT)
+        except Full:
+            self.log.warning("Monitor queue is full - dropped command [%s] %s", sequence, command)
+            if sequence != "SYS":
+                self.sendCmdResp(sequence, "Monitor is not responding - command dropped")
+            self.updateState("LGTC_WARNING")
 
     def queueGet(self):
         tmp = self.in_q.get()
@@ -227,23 +336,51 @@ class ECMS_client():
     def getState(self):
         return self.__LGTC_STATE
 
+    # Seconds since the client was started
+    def getUptime(self):
+        return round(time.monotonic() - self._start_time, 1)
+
+    # Statistics of queues between threads (high water mark, drops...)
+    def getQueueStats(self):
+        resp = []
+        for name, q in (("C->M", self.out_q), ("M->C", self.in_q)):
+            if hasattr(q, "stats"):
+                resp.append(name + ": " + q.stats())
+        return "; ".join(resp)
+
+    def getClockOffset(self):
+        if self.client.clock_offset is None:
+            return "Clock offset unknown"
+        return "Clock offset %.6f s (RTT %.6f s)" % (self.client.clock_offset, self.client.clock_rtt)
+
+    # Timer callback - send clock re-sync request (controller ACK carries timestamps)
+    # It is not retransmitted - lost request only means one sample less
+    def clockSync(self):
+        self.client.transmit(["TSYNC", "TSYNC"])
+
+    # New clock offset estimate - log it and store it in the results file
+    def clockUpdated(self):
+        self.client.clock_updated = False
+        self.log.info(self.getClockOffset())
+        self.queuePut("SYS", "CLOCK_OFFSET %.6f RTT %.6f" % (self.client.clock_offset, self.client.clock_rtt))
+
     # Set global variable and
     # Send new state to the server (WARNING: async method used...)
     def updateState(self, state):
         self.__LGTC_STATE = state
         # TODO check if state is possible, else set state LGTC_WARNING
         self.client.transmit_async(["STATE", state])
-        self.log.debug("Updating state: " + state)
+        self.log.debug("Updating state: %s", state)
 
     # Send info to the server (WARNING: async method used...)
     def sendInfoResp(self, info):
         self.client.transmit_async(["INFO", info])
-        self.log.debug("Sending info to the controller" + info)
+        self.log.debug("Sending info to the controller: %s", info)
 
     # Send respond to the server (WARNING: async method used...)
     def sendCmdResp(self, sqn, resp):
         self.client.transmit_async([sqn, resp])
-        self.log.debug("Sending response("+ sqn +") to the controller: " + resp)
+        self.log.debug("Sending response(%s) to the controller: %s", sqn, resp)
 
     
 
@@ -282,6 +419,12 @@ if __name__ == "__main__":
 
     APP_NAME = APP_DIRECTORY[3:]
 
+    # Broadcast commands for our clusters (Ansible inventory groups) and technology - given by
+    # release_targets.yml, besides commands for all devices
+    CLUSTERS = os.environ.get("CLUSTER", "").split(",")
+    TECHNOLOGY = os.environ.get("TECHNOLOGY")
+    TOPICS = zmq_client.node_topics(CLUSTERS, TECHNOLOGY)
+
     try:
         APP_DUR = int(sys.argv[3])
     except:
@@ -292,38 +435,45 @@ if __name__ == "__main__":
     # LOGGING CONFIG
     # ------------------------------------------------------------------------------------
 
-    # Config logging module format for all scripts. Log level is defined in each submodule with var LOG_LEVEL.
-    logging.basicConfig(format="%(asctime)s [%(levelname)7s]:[%(module)26s > %(funcName)16s() > %(lineno)3s] - %(message)s", level=LOG_LEVEL, filename=LOGGING_FILENAME)
+    # Config logging module format for all scripts - records are written into the file by a listener
+    # thread. Log level is defined in each submodule with var LOG_LEVEL and can be changed with
+    # LOG_<LEVEL>[:<module>] command.
+    log_setup.setup(LOGGING_FILENAME, log_setup.LOG_FORMAT, LOG_LEVEL)
     #logging.basicConfig(format="[%(levelname)5s:%(funcName)16s() > %(module)17s] %(message)s", level=LOG_LEVEL)
 
-    logging.info("Testing application " + APP_NAME + " for " + str(APP_DUR) + " minutes on device " + LGTC_NAME + "!")
+    logging.info("Testing application %s for %d minutes on device %s!", APP_NAME, APP_DUR, LGTC_NAME)
 
 
     # ------------------------------------------------------------------------------------
     # QUEUE CONFIG
     # ------------------------------------------------------------------------------------
 
-    # Create 2 queue for communication between threads
-    # Client -> Monitor
-    C_M_QUEUE = Queue()
-    # Monitr -> Clinet
-    M_C_QUEUE = Queue()
+    # Create 2 bounded queue for communication between threads
+    # Client -> Monitor (with wakeup descriptor, so monitor thread can sleep in select)
+    C_M_QUEUE = thread_queue.bounded_queue(C_M_QUEUE_SIZE, C_M_QUEUE_POLICIES)
+    # Monitr -> Clinet (if client can't keep up, old INFO messages are dropped and STATE updates coalesced)
+    M_C_QUEUE = thread_queue.bounded_queue(M_C_QUEUE_SIZE, M_C_QUEUE_POLICIES)
 
 
     # ------------------------------------------------------------------------------------
     # SERIAL MONITOR THREAD
     # ------------------------------------------------------------------------------------
 
+    # Zmq client (communication with controller) - sync with the controller first, so clock
+    # offset can be written in the header of the results file
+    main_thread = ECMS_client(M_C_QUEUE, C_M_QUEUE, LGTC_NAME, SUBSCR_HOSTNAME, ROUTER_HOSTNAME, TOPICS)
+    main_thread.sync()
+
     # Start serial monitor thread (communication with VESNA)
-    monitor_thread = serial_monitor_thread.serial_monitor_thread(C_M_QUEUE, M_C_QUEUE, RESULTS_FILENAME, LGTC_NAME, APP_NAME, APP_PATH)
+    monitor_thread = serial_monitor_thread.serial_monitor_thread(C_M_QUEUE, M_C_QUEUE, RESULTS_FILENAME, LGTC_NAME, APP_NAME, APP_PATH,
+                                                                 clock_offset=main_thread.client.clock_offset, clock_rtt=main_thread.client.clock_rtt)
     monitor_thread.start()
 
     # ------------------------------------------------------------------------------------
     # MAIN THREAD (ZMQ CLINET)
     # ------------------------------------------------------------------------------------
 
-    # Start main thread - zmq client (communication with controller)
-    main_thread = ECMS_client(M_C_QUEUE, C_M_QUEUE, LGTC_NAME, SUBSCR_HOSTNAME, ROUTER_HOSTNAME)
+    # Start main thread loop
     main_thread.run()
 
 
@@ -1,43 +1,410 @@
 # ----------------------------------------------------------------------
 # FILE LOGGER
 # ----------------------------------------------------------------------
+import os
+import gzip
+import json
+import time
+import logging
+import threading
+from queue import SimpleQueue, Empty
 from datetime import datetime
 
+from lib import measurement_store as ms
+from lib import results_index
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 # ----------------------------------------------------------------------
+LOG_LEVEL = logging.DEBUG
+
 DEFAULT_FILE_NAME = "node_results.txt"
 
+# Writer thread - buffered lines are written to the file when one of the limits is reached
+FLUSH_INTERVAL = 500        # In ms
+FLUSH_BYTES = 64 * 1024     # In bytes
+FSYNC = False               # Also fsync() the file on every flush
+
+# Results file segments
+COMPRESSION = None          # None, "gzip" or "zstd" (needs zstandard package)
+COMPRESS_LEVEL = {"gzip": 6, "zstd": 3}
+ROTATE_BYTES = 0            # Start a new segment after so many (uncompressed) bytes, 0 = never
+ROTATE_INTERVAL = 0         # Start a new segment after so many seconds, 0 = never
+COMPRESS_EXT = {None: "", "gzip": ".gz", "zstd": ".zst"}
+MANIFEST_EXT = ".manifest"
+
+# Tags of LGTC lines in the text file
+TEXT_TAGS = {
+    ms.LINE_LGTC: b"[LGTC]: ",
+    ms.LINE_WARNING: b"[LGTC_WARNING]:",
+    ms.LINE_ERROR: b"[LGTC_ERROR]:",
+}
+
+# ----------------------------------------------------------------------
+# Results file is opened in binary mode - lines from VESNA are written
+# as they came from UART (bytes or memoryview), without decoding them.
+# Strings are still accepted and encoded before writing.
+#
+# With writer=True the caller only puts (timestamp, line) tuples in a
+# queue and a background thread formats them and writes them to the file
+# in large batches, so a slow SD card never blocks the serial thread.
+# Write errors (disk full...) don't stop the writer thread - lines which
+# couldn't be written are counted in lost_bytes and write_errors, so the
+# caller can report them. If the thread still dies, lines are written
+# directly again.
+#
+# With compression or rotation enabled, results are written in segments
+# instead of one file:
+#   node_results_<id>.000.txt.gz, node_results_<id>.001.txt.gz, ...
+# (without rotation: node_results_<id>.txt.gz). Every segment starts
+# with the file header. When a segment is closed, a JSON line is added
+# to node_results_<id>.manifest with its file name, start and end time,
+# number of lines and uncompressed size.
+#
+# With columnar=True every line is also appended to a columnar binary
+# store node_results_<id>.cols/ (see measurement_store.py), which can be
+# loaded into NumPy arrays without parsing the text file. Raw measurement
+# frames (store_frame) are only written there, as LINE_FRAME records -
+# they are not in the text file, index or results stream.
+#
+# With index=True a sparse time index node_results_<id>.idx is written
+# next to the (uncompressed, not rotated) results file, so time ranges can
+# be read without scanning the whole file (see results_index.py).
+#
+# With stream (results_stream.results_streamer) everything written into
+# the results file is also streamed to the controller.
 # ----------------------------------------------------------------------
 class file_logger():
 
-    def prepare_file(self, filename, deviceName):
-        # Prepare a file and add description to it (date, time)
+    def __init__(self, writer=False, flush_interval=FLUSH_INTERVAL, flush_bytes=FLUSH_BYTES, fsync=FSYNC,
+                 compression=COMPRESSION, rotate_bytes=ROTATE_BYTES, rotate_interval=ROTATE_INTERVAL, columnar=False,
+                 index=False, stream=None):
+        self.writer = writer
+        self.flush_interval = flush_interval / 1000
+        self.flush_bytes = flush_bytes
+        self.fsync = fsync
+
+        if compression not in COMPRESS_EXT:
+            raise ValueError("Unknown compression: " + str(compression))
+        if compression == "zstd" and zstandard is None:
+            raise ValueError("zstd compression needs zstandard package")
+
+        self.compression = compression
+        self.rotate_bytes = rotate_bytes
+        self.rotate_interval = rotate_interval
+        self.segmented = bool(compression or rotate_bytes or rotate_interval)
+        self.columnar = columnar
+        self.store = None
+
+        if index and self.segmented:
+            raise ValueError("Index can only be used with a single uncompressed results file")
+        self.index = index
+        self.indexer = None
+        self.stream = stream
+
+        self._q = None
+        self._thread = None
+        self._writer_dead = False
+        self._buf = bytearray()     # Lines formatted by the writer thread, not written yet
+
+        self.log = logging.getLogger(__name__)
+        self.log.setLevel(LOG_LEVEL)
+
+        # Writer statistics
+        self.flushes = 0
+        self.bytes_written = 0
+        self.write_errors = 0
+        self.lost_bytes = 0
+        self.last_error = None
+
+    def prepare_file(self, filename, deviceName, clock_offset=None, clock_rtt=None):
+        # Prepare a file and add description to it (date, time, clock offset to the controller)
         self.filename = filename
-        self.file = open(filename, mode="w") #, encoding="ASCII") only in python3
-        self.file.write(str(datetime.now())+"\n")
-        self.file.write("----------------------------------------------------------------------------------------------- \n")
-        self.file.write("SERIAL INPUT FROM LGTC DEVICE " + deviceName + "\n")
-        self.file.write("----------------------------------------------------------------------------------------------- \n")
+        self._header = (str(datetime.now())+"\n").encode()
+        self._header += b"----------------------------------------------------------------------------------------------- \n"
+        self._header += ("SERIAL INPUT FROM LGTC DEVICE " + deviceName + "\n").encode()
+        if clock_offset is not None:
+            self._header += ("CLOCK OFFSET %.6f s (RTT %.6f s)\n" % (clock_offset, clock_rtt or 0)).encode()
+        else:
+            self._header += b"CLOCK OFFSET unknown\n"
+        self._header += b"----------------------------------------------------------------------------------------------- \n"
+
+        if self.stream is not None:
+            self.stream.put(self._header)
+
+        if self.columnar:
+            self.store = ms.measurement_store(os.path.splitext(filename)[0] + ms.STORE_EXT)
+
+        if self.index:
+            self.indexer = results_index.index_writer(results_index.index_name(filename))
+
+        if self.segmented:
+            self.manifest = os.path.splitext(filename)[0] + MANIFEST_EXT
+            open(self.manifest, mode="w").close()
+            self._segment = -1
+            return
+
+        self.file = open(filename, mode="wb")
+        self.file.write(self._header)
         self.file.close()
 
 
     def open_file(self):
-        self.file = open(self.filename, mode="a") # , encoding="ASCII")
+        if self.segmented:
+            self._open_segment()
+        else:
+            self.file = open(self.filename, mode="ab")
+            self._raw = self.file
+            self._pos = os.path.getsize(self.filename)
+
+        if self.writer:
+            self._q = SimpleQueue()
+            self._thread = threading.Thread(target=self._writer_loop, name="file_writer", daemon=True)
+            self._thread.start()
+
+    def _prefix(self, timestamp=None):
+        if timestamp is None:
+            return ("[" + str(datetime.now().time()) + "]: ").encode()
+        return ("[" + str(datetime.fromtimestamp(timestamp).time()) + "]: ").encode()
+
+    # Write a line with time prefix or pass it to the writer thread
+    def _store(self, ltype, data):
+        if self._q is not None:
+            if not self._writer_dead:
+                self._q.put((time.time(), time.monotonic(), ltype, bytes(data)))
+                return
+            self._writer_died()
+
+        self._store_now(time.time(), time.monotonic(), ltype, data)
+
+    def _store_now(self, wall, mono, ltype, data):
+        if ltype == ms.LINE_FRAME:
+            try:
+                self.store.append(mono, wall, ltype, data)
+            except Exception as e:
+                self._write_error(e, len(data))
+            return
+
+        line = self._prefix(wall) + TEXT_TAGS.get(ltype, b"") + data
+        try:
+            if self.indexer is not None:
+                self.indexer.add(wall, self._pos)
+            self._write(line)
+            if self.store is not None:
+                self.store.append(mono, wall, ltype, data)
+        except Exception as e:
+            self._write_error(e, len(line))
+
+    # Line(s) couldn't be written - count them, caller reports it (see write_errors)
+    def _write_error(self, e, nbytes):
+        self.write_errors += 1
+        self.lost_bytes += nbytes
+        if self.last_error != str(e):
+            self.log.error("Writing results failed: %s", e)
+        self.last_error = str(e)
+
+    # Writer thread is gone - write what it left in the queue and everything else directly
+    def _writer_died(self):
+        self.log.error("Results writer thread died - writing results directly")
+        q = self._q
+        self._q = None
+        self._thread = None
+        if self._buf:
+            try:
+                self._write(bytes(self._buf))
+            except Exception as e:
+                self._write_error(e, len(self._buf))
+            self._buf.clear()
+        while True:
+            try:
+                item = q.get_nowait()
+            except Empty:
+                break
+            if item is not None:
+                self._store_now(*item)
 
+    # Store a line as it is (it must end with \n)
     def store_line(self, data):
-        self.file.write("[" + str(datetime.now().time())+"]: ")
-        self.file.write(data)
+        if isinstance(data, str):
+            data = data.encode()
+        self._store(ms.line_type(data), data)
+
+    # Store raw payload of a measurement frame (only in the columnar store)
+    def store_frame(self, data):
+        if self.store is None:
+            raise ValueError("Measurement frames need the columnar store (columnar=True)")
+        self._store(ms.LINE_FRAME, data)
 
     def store_lgtc_line(self,s):
-        self.file.write("[" + str(datetime.now().time())+"]: [LGTC]: ")
-        self.file.write(s + "\n")
+        self._store(ms.LINE_LGTC, s.encode() + b"\n")
 
     def warning(self, s):
-        self.file.write("[" + str(datetime.now().time())+"]: [LGTC_WARNING]:")
-        self.file.write(s + "\n")
+        self._store(ms.LINE_WARNING, s.encode() + b"\n")
 
     def error(self, s):
-        self.file.write("[" + str(datetime.now().time())+"]: [LGTC_ERROR]:")
-        self.file.write(s + "\n")
+        self._store(ms.LINE_ERROR, s.encode() + b"\n")
+
+    # Write everything buffered so far to the disk (called from the writer thread or with no writer)
+    def flush(self, buf=b""):
+        if buf:
+            self._write(buf)
+        self.file.flush()
+        if self.store is not None:
+            self.store.flush()
+        if self.fsync:
+            os.fsync(self._raw.fileno())
+        # After the results file, so index never points past its end
+        if self.indexer is not None:
+            self.indexer.flush()
+        self.flushes += 1
 
     def close(self):
-        self.file.close()
\ No newline at end of file
+        if self._q is not None and self._writer_dead:
+            self._writer_died()
+
+        if self._thread is not None:
+            # None tells the writer thread to write what is left and exit
+            self._q.put(None)
+            self._thread.join()
+            self._thread = None
+            self._q = None
+        else:
+            try:
+                self.flush()
+            except Exception as e:
+                self._write_error(e, 0)
+
+        if self.segmented:
+            self._close_segment()
+        else:
+            self.file.close()
+
+        if self.store is not None:
+            self.store.close()
+        if self.indexer is not None:
+            self.indexer.close()
+        if self.stream is not None:
+            self.stream.close()
+
+
+    # ------------------------------------------------------------------
+    # SEGMENTS
+    # ------------------------------------------------------------------
+    def _write(self, data):
+        self.file.write(data)
+        self.bytes_written += len(data)
+        if self.stream is not None:
+            self.stream.put(data)
+
+        if not self.segmented:
+            self._pos += len(data)
+            return
+
+        self._seg_info["lines"] += data.count(b"\n")
+        self._seg_info["bytes"] += len(data)
+
+        if (self.rotate_bytes and self._seg_info["bytes"] >= self.rotate_bytes) or \
+           (self.rotate_interval and time.monotonic() - self._seg_opened >= self.rotate_interval):
+            self._close_segment()
+            self._open_segment()
+
+    def _segment_name(self, n):
+        base, ext = os.path.splitext(self.filename)
+        if self.rotate_bytes or self.rotate_interval:
+            base += ".%03d" % n
+        return base + ext + COMPRESS_EXT[self.compression]
+
+    def _open_segment(self):
+        self._segment += 1
+        name = self._segment_name(self._segment)
+
+        self._raw = open(name, mode="wb")
+        if self.compression == "gzip":
+            self.file = gzip.GzipFile(filename=os.path.basename(name[:-3]), mode="wb",
+                                      compresslevel=COMPRESS_LEVEL["gzip"], fileobj=self._raw)
+        elif self.compression == "zstd":
+            self.file = zstandard.ZstdCompressor(level=COMPRESS_LEVEL["zstd"]).stream_writer(self._raw)
+        else:
+            self.file = self._raw
+
+        self.file.write(self._header)
+        self._seg_opened = time.monotonic()
+        self._seg_info = {"file": os.path.basename(name), "start": time.time(), "lines": 0, "bytes": 0}
+
+    def _close_segment(self):
+        self.file.close()
+        if self._raw is not self.file and not self._raw.closed:
+            self._raw.close()
+
+        self._seg_info["end"] = time.time()
+        self._seg_info["compression"] = self.compression
+        with open(self.manifest, mode="a") as m:
+            m.write(json.dumps(self._seg_info) + "\n")
+
+
+    # ------------------------------------------------------------------
+    # WRITER THREAD
+    # ------------------------------------------------------------------
+    def _next_item(self):
+        try:
+            return self._q.get_nowait()
+        except Empty:
+            return False
+
+    def _writer_loop(self):
+        try:
+            self._writer_run()
+        finally:
+            self._writer_dead = True
+
+    def _writer_run(self):
+        buf = self._buf
+        deadline = time.monotonic() + self.flush_interval
+        running = True
+        pending = False     # Something was stored since the last flush
+
+        while running:
+            try:
+                item = self._q.get(timeout=max(0, deadline - time.monotonic()))
+            except Empty:
+                item = False
+
+            try:
+                # Take everything that is in the queue at once
+                while item is not False:
+                    if item is None:
+                        running = False
+                        break
+                    wall, mono, ltype, data = item
+                    pending = True
+                    if ltype == ms.LINE_FRAME:
+                        self.store.append(mono, wall, ltype, data)
+                        item = self._next_item()
+                        continue
+                    if self.indexer is not None:
+                        self.indexer.add(wall, self._pos + len(buf))
+                    buf += self._prefix(wall)
+                    buf += TEXT_TAGS.get(ltype, b"")
+                    buf += data
+                    if self.store is not None:
+                        self.store.append(mono, wall, ltype, data)
+                    if len(buf) >= self.flush_bytes:
+                        break
+                    item = self._next_item()
+
+                if not running or len(buf) >= self.flush_bytes or time.monotonic() >= deadline:
+                    if pending or not running:
+                        self.flush(buf)
+                        buf.clear()
+                        pending = False
+                    deadline = time.monotonic() + self.flush_interval
+
+            # Disk full, compressor error... - drop what is buffered and keep going
+            except Exception as e:
+                self._write_error(e, len(buf))
+                buf.clear()
+                pending = False
+                deadline = time.monotonic() + self.flush_interval
@@ -0,0 +1,173 @@
+# ----------------------------------------------------------------------
+# LOG SETUP: Shared logging configuration for all ECMS processes
+# ----------------------------------------------------------------------
+# Loggers don't write into the log file themselves - every record is put
+# into a queue (QueueHandler) and a listener thread (QueueListener) formats
+# it and writes it into the file. Hot loops only pay for creating the
+# record and merging its arguments, file I/O happens off their thread.
+# The listener flushes the file only when the queue is empty, so a burst
+# of records is written with a few big writes instead of one per record.
+#
+# Log level of every module can be changed at runtime with a command:
+#   LOG_<LEVEL>             all loggers (e.g. LOG_INFO)
+#   LOG_<LEVEL>:<module>    one logger (e.g. LOG_WARNING:zmq_client)
+#
+# Use lazy %-formatting in log calls, so arguments are formatted only if
+# the record passes the level check:
+#   self.log.debug("Got [%s]: %s", nbr, data)
+# ----------------------------------------------------------------------
+import queue
+import atexit
+import logging
+import logging.handlers
+
+# ----------------------------------------------------------------------
+LOG_FORMAT = "%(asctime)s [%(levelname)7s]:[%(module)26s > %(funcName)16s() > %(lineno)3s] - %(message)s"
+LEVEL_COMMAND = "LOG_"
+
+LEVELS = ("DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL")
+
+
+# ----------------------------------------------------------------------
+# Queue handler which leaves the formatting to the listener thread.
+# The message is merged with its arguments here (arguments may change
+# after the call), but time, level and location are formatted later.
+# ----------------------------------------------------------------------
+class deferred_queue_handler(logging.handlers.QueueHandler):
+
+    def prepare(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        # Traceback objects can't wait in the queue
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+# ----------------------------------------------------------------------
+# File handler which is flushed by the listener, not after every record
+# ----------------------------------------------------------------------
+class buffered_file_handler(logging.FileHandler):
+
+    def flush(self):
+        pass
+
+    def sync(self):
+        logging.FileHandler.flush(self)
+
+
+# ----------------------------------------------------------------------
+# Queue listener which flushes its handlers before waiting for records
+# ----------------------------------------------------------------------
+class batched_queue_listener(logging.handlers.QueueListener):
+
+    def dequeue(self, block):
+        if block:
+            try:
+                return self.queue.get_nowait()
+            except queue.Empty:
+                for h in self.handlers:
+                    if hasattr(h, "sync"):
+                        h.sync()
+        return self.queue.get(block)
+
+
+_listener = None
+
+
+# ----------------------------------------------------------------------
+# Configure root logger to write into filename through a queue.
+#
+#   @params:    filename - log file (None - stderr)
+#               fmt      - format of log lines
+#               level    - level of the root logger
+#   @return:    QueueListener (it is stopped at exit)
+# ----------------------------------------------------------------------
+def setup(filename=None, fmt=LOG_FORMAT, level=logging.DEBUG):
+    global _listener
+
+    shutdown()
+
+    if filename:
+        handler = buffered_file_handler(filename)
+    else:
+        handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter(fmt))
+
+    q = queue.SimpleQueue()
+
+    root = logging.getLogger()
+    for h in root.handlers[:]:
+        root.removeHandler(h)
+    root.addHandler(deferred_queue_handler(q))
+    root.setLevel(level)
+
+    _listener = batched_queue_listener(q, handler)
+    _listener.start()
+
+    return _listener
+
+
+# Write all queued records, stop the listener thread and close the file
+def shutdown():
+    global _listener
+
+    if _listener is not None:
+        _listener.stop()
+        for h in _listener.handlers:
+            h.close()
+        _listener = None
+
+atexit.register(shutdown)
+
+
+# ----------------------------------------------------------------------
+# Change log level at runtime.
+#
+#   @params:    level - level name ("DEBUG", ...) or number
+#               name  - logger name or last part of it ("zmq_client" is
+#                       "lib.zmq_client"), None - all loggers
+#   @return:    list of changed logger names
+# ----------------------------------------------------------------------
+def set_level(level, name=None):
+    if isinstance(level, str):
+        level = level.upper()
+        if level not in LEVELS:
+            raise ValueError("Unknown log level " + level)
+        level = getattr(logging, level)
+
+    manager = logging.Logger.manager
+    loggers = [n for n, l in manager.loggerDict.items() if isinstance(l, logging.Logger)]
+
+    if name is None:
+        changed = ["root"] + loggers
+    elif name == "root":
+        changed = ["root"]
+    else:
+        changed = [n for n in loggers if n == name or n.endswith("." + name)]
+
+    for n in changed:
+        logging.getLogger(None if n == "root" else n).setLevel(level)
+
+    return changed
+
+
+# ----------------------------------------------------------------------
+# Handle LOG_<LEVEL>[:<module>] command.
+#
+#   @return:    response string, None if cmd is not a log level command
+# ----------------------------------------------------------------------
+def level_command(cmd):
+    if not cmd.startswith(LEVEL_COMMAND):
+        return None
+
+    level, _, name = cmd[len(LEVEL_COMMAND):].partition(":")
+    try:
+        changed = set_level(level, name or None)
+    except ValueError as e:
+        return str(e)
+
+    if not changed:
+        return "No logger " + name
+    return "Log level " + level.upper() + " for " + (name or "all loggers")
@@ -0,0 +1,188 @@
+# ----------------------------------------------------------------------
+# MEASUREMENT STORE: Columnar binary copy of the results file
+# ----------------------------------------------------------------------
+# Every stored line is one record with columns:
+#   mono    - time.monotonic() when line was stored      (float64)
+#   wall    - time.time() when line was stored           (float64)
+#   type    - line type (LINE_* below)                   (uint8)
+#   offset  - start of the payload in payload.bin        (uint64)
+#   length  - length of the payload (without \n)         (uint32)
+#
+# Store is a directory (node_results_<id>.cols/) with one raw little
+# endian file per column, payload.bin with all payloads one after another
+# and meta.json with column types. Writer only needs the standard library
+# (array module) - columns are buffered and appended with one write per
+# column. Reader maps the files into NumPy arrays without any parsing.
+#
+# If the writer was killed in the middle of a flush, columns may have a
+# different number of records - reader uses only complete records.
+# ----------------------------------------------------------------------
+import os
+import sys
+import json
+import array
+
+# ----------------------------------------------------------------------
+LINE_DATA = 0           # Line from VESNA (measurement)
+LINE_RESPONSE = 1       # Response on a command from VESNA ("$")
+LINE_INFO = 2           # Info from VESNA ("&")
+LINE_LGTC = 3           # Message from LGTC
+LINE_WARNING = 4        # Warning from LGTC
+LINE_ERROR = 5          # Error from LGTC
+LINE_FRAME = 6          # Raw payload of a measurement frame from VESNA (binary framing)
+
+LINE_TYPES = ["DATA", "RESPONSE", "INFO", "LGTC", "WARNING", "ERROR", "FRAME"]
+
+STORE_EXT = ".cols"
+PAYLOAD_FILE = "payload.bin"
+META_FILE = "meta.json"
+BUFFER_ROWS = 4096      # Records buffered in memory before they are appended to files
+
+# Column name : (array typecode for writer, NumPy dtype for reader)
+COLUMNS = {
+    "mono":     ("d", "<f8"),
+    "wall":     ("d", "<f8"),
+    "type":     ("B", "u1"),
+    "offset":   ("Q", "<u8"),
+    "length":   ("I", "<u4"),
+}
+VERSION = 1
+
+
+# Line type of a line from VESNA
+def line_type(data):
+    if data[:1] == b"$":
+        return LINE_RESPONSE
+    if data[:1] == b"&":
+        return LINE_INFO
+    return LINE_DATA
+
+
+# ----------------------------------------------------------------------
+# WRITER
+# ----------------------------------------------------------------------
+class measurement_store():
+
+    def __init__(self, path, buffer_rows=BUFFER_ROWS):
+        self.path = path
+        self.buffer_rows = buffer_rows
+        self.rows = 0
+
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, META_FILE), "w") as m:
+            json.dump({"version": VERSION, "columns": {c: d[1] for c, d in COLUMNS.items()}}, m)
+
+        self._files = {c: open(os.path.join(path, c), "wb") for c in COLUMNS}
+        self._payload = open(os.path.join(path, PAYLOAD_FILE), "wb")
+        self._payload_size = 0
+
+        self._new_buffers()
+
+    def _new_buffers(self):
+        self._cols = {c: array.array(d[0]) for c, d in COLUMNS.items()}
+        self._buf = bytearray()
+
+    # Add one record (payload is bytes-like, trailing \n of a line is not stored)
+    def append(self, mono, wall, ltype, payload):
+        if ltype != LINE_FRAME and payload[-1:] == b"\n":
+            payload = payload[:-1]
+
+        cols = self._cols
+        cols["mono"].append(mono)
+        cols["wall"].append(wall)
+        cols["type"].append(ltype)
+        cols["offset"].append(self._payload_size + len(self._buf))
+        cols["length"].append(len(payload))
+        self._buf += payload
+
+        if len(cols["type"]) >= self.buffer_rows:
+            self.flush()
+
+    # Append buffered records to column files
+    def flush(self):
+        n = len(self._cols["type"])
+        if n:
+            # Payload first, so offsets never point past the end of payload.bin
+            self._payload.write(self._buf)
+            self._payload_size += len(self._buf)
+
+            for c, col in self._cols.items():
+                if sys.byteorder != "little":
+                    col.byteswap()
+                col.tofile(self._files[c])
+
+            self.rows += n
+            self._new_buffers()
+
+        self._payload.flush()
+        for f in self._files.values():
+            f.flush()
+
+    def close(self):
+        self.flush()
+        self._payload.close()
+        for f in self._files.values():
+            f.close()
+
+
+# ----------------------------------------------------------------------
+# READER (needs NumPy)
+# ----------------------------------------------------------------------
+class measurements():
+
+    def __init__(self, path, mmap=True):
+        import numpy as np
+
+        with open(os.path.join(path, META_FILE)) as m:
+            meta = json.load(m)
+
+        def load(name, dtype):
+            fname = os.path.join(path, name)
+            if os.path.getsize(fname) == 0:
+                return np.zeros(0, dtype=dtype)
+            if mmap:
+                return np.memmap(fname, dtype=dtype, mode="r")
+            return np.fromfile(fname, dtype=dtype)
+
+        cols = {c: load(c, dtype) for c, dtype in meta["columns"].items()}
+        self.payload = load(PAYLOAD_FILE, "u1")
+
+        # Only complete records
+        rows = min(len(col) for col in cols.values())
+        for c, col in cols.items():
+            cols[c] = col[:rows]
+
+        valid = cols["offset"] + cols["length"] <= len(self.payload)
+        if rows and not valid[-1]:
+            rows = int(valid.argmin())
+            for c, col in cols.items():
+                cols[c] = col[:rows]
+
+        self.columns = cols
+        self.mono = cols["mono"]
+        self.wall = cols["wall"]
+        self.type = cols["type"]
+        self.offset = cols["offset"]
+        self.length = cols["length"]
+
+    def __len__(self):
+        return len(self.type)
+
+    # Payload of i-th record as bytes
+    def line(self, i):
+        start = int(self.offset[i])
+        return self.payload[start:start + int(self.length[i])].tobytes()
+
+    # Indexes of records of given type(s)
+    def of_type(self, *ltypes):
+        import numpy as np
+        return np.flatnonzero(np.isin(self.type, ltypes))
+
+    # Indexes of records with wall time in [start, end)
+    def time_range(self, start, end):
+        import numpy as np
+        return np.flatnonzero((self.wall >= start) & (self.wall < end))
+
+
+def load(path, mmap=True):
+    return measurements(path, mmap)
@@ -0,0 +1,218 @@
+# ----------------------------------------------------------------------
+# RESULTS INDEX: Sparse time index of node_results_<id>.txt files
+# ----------------------------------------------------------------------
+# Sidecar file node_results_<id>.idx holds records (little endian)
+#   time    - UNIX time of the line                      (float64)
+#   offset  - byte offset of the line in results file    (uint64)
+# for the first line of every INDEX_INTERVAL seconds long time slot and
+# at least every INDEX_LINES lines.
+#
+# file_logger writes it while logging (index=True). For older files it
+# can be rebuilt offline from the text file:
+#   python3 -m lib.results_index node_results_51.txt [...]
+#
+# Reader finds the last indexed line before the start of the range with
+# a binary search, then reads lines from the memory mapped file from
+# there on until the end of the range.
+# ----------------------------------------------------------------------
+import os
+import sys
+import mmap
+import struct
+import bisect
+from datetime import datetime, date, time as dtime, timedelta
+
+# ----------------------------------------------------------------------
+INDEX_EXT = ".idx"
+INDEX_LINES = 1000          # Index at least every N-th line ...
+INDEX_INTERVAL = 1.0        # ... and the first line of every time slot of so many seconds
+DAY = 24 * 3600
+ENTRY = struct.Struct("<dQ")
+
+
+def index_name(filename):
+    return os.path.splitext(filename)[0] + INDEX_EXT
+
+
+# ----------------------------------------------------------------------
+# WRITER
+# ----------------------------------------------------------------------
+class index_writer():
+
+    def __init__(self, path, every_lines=INDEX_LINES, every_seconds=INDEX_INTERVAL):
+        self.path = path
+        self.every_lines = every_lines
+        self.every_seconds = every_seconds
+
+        self.file = open(path, mode="wb")
+        self.entries = 0
+        self._lines = 0
+        self._slot = None
+        self._buf = bytearray()
+
+    # Called for every line before it is written at given offset
+    def add(self, wall, offset):
+        self._lines += 1
+        slot = int(wall // self.every_seconds)
+        if self._lines < self.every_lines and slot == self._slot:
+            return
+
+        self._lines = 0
+        self._slot = slot
+        self._buf += ENTRY.pack(wall, offset)
+        self.entries += 1
+
+    # Must be called only after lines up to the last offset are flushed to the results file
+    def flush(self):
+        if self._buf:
+            self.file.write(self._buf)
+            self._buf = bytearray()
+        self.file.flush()
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+# ----------------------------------------------------------------------
+# Rebuild index of an existing results file (needs NumPy)
+#
+#   @return:    number of index entries
+# ----------------------------------------------------------------------
+def build_index(filename, every_lines=INDEX_LINES, every_seconds=INDEX_INTERVAL):
+    import numpy as np
+    from lib import results_parser
+
+    r = results_parser.parse(filename)
+    times = r.timestamps()
+
+    # Same rule as index_writer, but lines are counted from the start of the file
+    slots = np.floor(times / every_seconds)
+    sel = np.zeros(len(times), dtype=bool)
+    sel[:1] = True
+    sel[1:] = slots[1:] != slots[:-1]
+    sel[::every_lines] = True
+
+    entries = np.empty(np.count_nonzero(sel), dtype=[("time", "<f8"), ("offset", "<u8")])
+    entries["time"] = times[sel]
+    entries["offset"] = r.records["start"][sel]
+
+    with open(index_name(filename), "wb") as f:
+        f.write(entries.tobytes())
+    return len(entries)
+
+
+def load_index(filename):
+    with open(index_name(filename), "rb") as f:
+        data = f.read()
+
+    # Incomplete last entry (writer killed during write) is ignored
+    data = data[:len(data) - len(data) % ENTRY.size]
+    entries = list(ENTRY.iter_unpack(data))
+    return [e[0] for e in entries], [e[1] for e in entries]
+
+
+# ----------------------------------------------------------------------
+# READER
+# ----------------------------------------------------------------------
+class indexed_results():
+
+    def __init__(self, filename, rebuild=True):
+        self.filename = filename
+
+        if not os.path.exists(index_name(filename)):
+            if not rebuild:
+                raise FileNotFoundError(index_name(filename))
+            build_index(filename)
+
+        self.times, self.offsets = load_index(filename)
+
+        self._f = open(filename, "rb")
+        self.data = mmap.mmap(self._f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        # Date of the first line, to convert time of day into UNIX time
+        self.start = datetime.fromtimestamp(self.times[0]) if self.times else None
+
+    def close(self):
+        self.data.close()
+        self._f.close()
+
+    # ------------------------------------------------------------------
+    # Lines with time in [start, end) as (UNIX time, line) tuples
+    #
+    #   start, end: UNIX time, datetime or time of day (datetime.time or
+    #               "HH:MM[:SS]" string) on the day of the first line
+    # ------------------------------------------------------------------
+    def range(self, start, end):
+        start = self.to_timestamp(start)
+        end = self.to_timestamp(end)
+        if not self.times or end <= start:
+            return
+
+        # Last indexed line before start of the range
+        i = max(0, bisect.bisect_right(self.times, start) - 1)
+        pos = self.offsets[i]
+        last = self.times[i]
+
+        while pos < len(self.data):
+            nl = self.data.find(b"\n", pos)
+            if nl < 0:
+                nl = len(self.data)
+            line = self.data[pos:nl]
+            pos = nl + 1
+
+            t = self._line_time(line, last)
+            if t is None:
+                continue
+            last = t
+
+            if t >= end:
+                break
+            if t >= start:
+                yield t, line
+
+    def to_timestamp(self, t):
+        if isinstance(t, (int, float)):
+            return float(t)
+        if isinstance(t, str):
+            t = dtime.fromisoformat(t)
+        if isinstance(t, dtime):
+            t = datetime.combine(self.start.date() if self.start else date.today(), t)
+        return t.timestamp()
+
+    # UNIX time of a line from its time of day prefix (near the previous line time)
+    @staticmethod
+    def _line_time(line, previous):
+        if line[:1] != b"[":
+            return None
+        end = line.find(b"]")
+        try:
+            tod = dtime.fromisoformat(line[1:end].decode())
+        except ValueError:
+            return None
+
+        day = datetime.fromtimestamp(previous).date()
+        t = datetime.combine(day, tod).timestamp()
+        if t < previous - DAY / 2:
+            t = datetime.combine(day + timedelta(days=1), tod).timestamp()
+        return t
+
+
+def read_range(filename, start, end):
+    r = indexed_results(filename)
+    try:
+        for t, line in r.range(start, end):
+            yield t, line
+    finally:
+        r.close()
+
+
+
+if __name__ == "__main__":
+
+    if len(sys.argv) < 2:
+        print("Usage: python3 -m lib.results_index node_results_<id>.txt [...]")
+        sys.exit(1)
+
+    for fname in sys.argv[1:]:
+        print("%s: %d index entries" % (index_name(fname), build_index(fname)))
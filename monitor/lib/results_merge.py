@@ -0,0 +1,207 @@
+# ----------------------------------------------------------------------
+# RESULTS MERGE: Merge results files of all nodes into one timeline
+# ----------------------------------------------------------------------
+# Every results file is read line by line and lines of all nodes are
+# merged by time with a heap (heapq.merge), so only one line per node is
+# kept in memory no matter how big the files are.
+#
+# Times are corrected with the clock offset of the node:
+#   reference time = node time - offset
+# Offsets are taken from the results file header and "[LGTC]: CLOCK_OFFSET
+# <seconds>" lines (every line changes the offset for the lines after it)
+# and can be overridden per node.
+#
+# Corrected times of one node never go backwards - heapq.merge needs
+# every stream sorted. When a new offset would move the time back (offset
+# grew), following lines keep the last corrected time until the node time
+# catches up, so they stay in order but are up to the offset step late.
+#
+# Segments of one node (node_results_<id>.000.txt.gz, ...) are read one
+# after another as one stream. Compressed files (.gz, .zst) are supported.
+#
+# Usage: python3 -m lib.results_merge [-o merged.txt] [--offset ID=SECONDS ...] FILE [...]
+# ----------------------------------------------------------------------
+import os
+import re
+import sys
+import gzip
+import heapq
+import argparse
+from datetime import datetime
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# ----------------------------------------------------------------------
+DAY = 24 * 3600
+CLOCK_OFFSET_HEADER = b"CLOCK OFFSET "
+CLOCK_OFFSET_TAG = b"[LGTC]: CLOCK_OFFSET "
+
+# node_results_<id>[.<segment>].txt[.gz|.zst]
+NODE_FILE = re.compile(r"node_results_(?P<node>[^.]+)(\.(?P<segment>\d+))?\.txt(\.gz|\.zst)?$")
+
+
+# Open results file (compressed or not) for reading in binary mode
+def open_results(filename):
+    if filename.endswith(".gz"):
+        return gzip.open(filename, "rb")
+    if filename.endswith(".zst"):
+        if zstandard is None:
+            raise ValueError("Reading " + filename + " needs zstandard package")
+        return zstandard.ZstdDecompressor().stream_reader(open(filename, "rb"), closefd=True)
+    return open(filename, "rb")
+
+
+# Node ID from the file name (or file name if it doesn't match)
+def node_id(filename):
+    m = NODE_FILE.search(os.path.basename(filename))
+    if m:
+        return m.group("node")
+    return os.path.basename(filename)
+
+# Segment number from the file name (0 if file is not a segment)
+def segment_number(filename):
+    m = NODE_FILE.search(os.path.basename(filename))
+    if m and m.group("segment"):
+        return int(m.group("segment"))
+    return 0
+
+
+# ----------------------------------------------------------------------
+# Lines of one results file as (reference time, line payload) tuples
+#
+#   offset: initial clock offset in seconds (None - use offsets from file,
+#           starting with 0); if given, offsets from the file are ignored
+# ----------------------------------------------------------------------
+def read_lines(filename, offset=None, state=None):
+    # State is shared between segments of one node (current day and offset)
+    if state is None:
+        state = {}
+    # Every segment repeats the header of the first one - its offset is only valid at the start
+    first = "offset" not in state
+    state.setdefault("offset", offset if offset is not None else 0.0)
+
+    with open_results(filename) as f:
+        for n, line in enumerate(f):
+
+            # Header - start time and clock offset measured at the start
+            if line[:1] != b"[":
+                if n == 0 and "midnight" not in state:
+                    try:
+                        start = datetime.fromisoformat(line.strip().decode())
+                        state["midnight"] = datetime.combine(start.date(), datetime.min.time()).timestamp()
+                        state["last"] = start.timestamp()
+                    except ValueError:
+                        pass
+                elif first and offset is None and line.startswith(CLOCK_OFFSET_HEADER):
+                    try:
+                        state["offset"] = float(line.split()[2])
+                    except (ValueError, IndexError):
+                        pass
+                continue
+
+            # Time prefix [HH:MM:SS.ffffff]
+            end = line.find(b"]: ")
+            if line[:1] != b"[" or end < 0:
+                continue
+            try:
+                h, m, s = line[1:end].split(b":")
+                tod = int(h) * 3600 + int(m) * 60 + float(s)
+            except ValueError:
+                continue
+
+            # Day changes - time of day wrapped around
+            midnight = state.setdefault("midnight", 0.0)
+            t = midnight + tod
+            if t < state.get("last", t) - DAY / 2:
+                midnight += DAY
+                state["midnight"] = midnight
+                t += DAY
+            state["last"] = t
+
+            payload = line[end + 3:].rstrip(b"\r\n")
+
+            if offset is None and payload.startswith(CLOCK_OFFSET_TAG):
+                try:
+                    state["offset"] = float(payload[len(CLOCK_OFFSET_TAG):].split()[0])
+                except (ValueError, IndexError):
+                    pass
+
+            # Monotone correction - clamp to the previous corrected time
+            ref = t - state["offset"]
+            if ref < state.get("ref", ref):
+                ref = state["ref"]
+            state["ref"] = ref
+
+            yield ref, payload
+
+
+# Lines of all segments of one node as (reference time, node, line payload)
+def read_node(node, filenames, offset=None):
+    state = {}
+    for fname in filenames:
+        for t, payload in read_lines(fname, offset, state):
+            yield t, node, payload
+
+
+# ----------------------------------------------------------------------
+# Merge results files of all nodes into one iterator of
+# (reference time, node, line payload) tuples sorted by time
+#
+#   offsets: {node : clock offset in seconds} to override offsets from files
+# ----------------------------------------------------------------------
+def merge(filenames, offsets=None):
+    offsets = offsets or {}
+
+    nodes = {}
+    for fname in filenames:
+        nodes.setdefault(node_id(fname), []).append(fname)
+
+    streams = []
+    for node, files in sorted(nodes.items()):
+        files.sort(key=segment_number)
+        streams.append(read_node(node, files, offsets.get(node)))
+
+    return heapq.merge(*streams, key=lambda x: x[0])
+
+
+def format_line(t, node, payload):
+    ts = datetime.fromtimestamp(t).isoformat(sep=" ", timespec="microseconds")
+    return b"[" + ts.encode() + b"] [" + node.encode() + b"]: " + payload + b"\n"
+
+
+# Write merged timeline into a file
+#
+#   @return:    number of lines
+def write_merged(filenames, out, offsets=None):
+    n = 0
+    with open(out, "wb") as f:
+        for t, node, payload in merge(filenames, offsets):
+            f.write(format_line(t, node, payload))
+            n += 1
+    return n
+
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Merge results files of all nodes into one timeline")
+    parser.add_argument("files", nargs="+", help="node_results_<id>.txt files (or segments)")
+    parser.add_argument("-o", "--out", help="output file (default: stdout)")
+    parser.add_argument("--offset", action="append", default=[], metavar="ID=SECONDS",
+                        help="clock offset of a node (overrides offsets in its results file)")
+    args = parser.parse_args()
+
+    offsets = {}
+    for o in args.offset:
+        node, _, sec = o.partition("=")
+        offsets[node] = float(sec)
+
+    if args.out:
+        print("Merged %d lines into %s" % (write_merged(args.files, args.out, offsets), args.out))
+    else:
+        out = sys.stdout.buffer
+        for t, node, payload in merge(args.files, offsets):
+            out.write(format_line(t, node, payload))
@@ -0,0 +1,216 @@
+# ----------------------------------------------------------------------
+# RESULTS PARSER: Vectorized parser for node_results_<id>.txt files
+# ----------------------------------------------------------------------
+# Results file (see file_logger.py) has a header (start time, device name
+# and clock offset between two separator lines) followed by lines
+#   [HH:MM:SS.ffffff]: <line from VESNA>
+#   [HH:MM:SS.ffffff]: [LGTC]: <message>
+#   [HH:MM:SS.ffffff]: [LGTC_WARNING]:<message>
+#   [HH:MM:SS.ffffff]: [LGTC_ERROR]:<message>
+# (microseconds are omitted when they are 0 - "[HH:MM:SS]: ").
+#
+# File is memory mapped and handled as a NumPy byte array: line ends are
+# found with one comparison over the whole chunk, timestamp digits and
+# tags are picked with fancy indexing at line starts. No Python code runs
+# per line, so even GB sized files are parsed in seconds.
+#
+# Result is a structured array with one record per line:
+#   time    - seconds since midnight of the first day (day changes are detected)
+#   type    - line type (measurement_store.LINE_*)
+#   start   - start of the line (time prefix) in file
+#   offset  - start of the line payload (after time prefix and LGTC tag) in file
+#   length  - length of the payload (without \n)
+# ----------------------------------------------------------------------
+import os
+import mmap
+from datetime import datetime
+
+import numpy as np
+
+from lib import measurement_store as ms
+
+# ----------------------------------------------------------------------
+HEADER_MAX = 4096                   # Header must be within first HEADER_MAX bytes
+HEADER_SEPARATOR = b"-----"
+CHUNK_BYTES = 4 * 1024 * 1024       # File is parsed in chunks of (about) this size (fits in cache)
+
+PREFIX_LEN = 19                     # len("[HH:MM:SS.ffffff]: ")
+PREFIX_SHORT_LEN = 12               # len("[HH:MM:SS]: ")
+DAY = 24 * 3600
+
+# Tag (as it is in the file) : line type
+TAGS = {
+    b"[LGTC]: ": ms.LINE_LGTC,
+    b"[LGTC_WARNING]:": ms.LINE_WARNING,
+    b"[LGTC_ERROR]:": ms.LINE_ERROR,
+}
+
+RECORD = np.dtype([("time", "<f8"), ("type", "u1"), ("start", "<u8"), ("offset", "<u8"), ("length", "<u4")])
+
+# Position of timestamp digits in the prefix and their weights (in seconds and microseconds)
+_HMS = ((1, 36000), (2, 3600), (4, 600), (5, 60), (7, 10), (8, 1))
+_USEC = ((10, 100000), (11, 10000), (12, 1000), (13, 100), (14, 10), (15, 1))
+
+
+class results_file():
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.data = np.zeros(0, "u1")
+        if os.path.getsize(filename):
+            with open(filename, "rb") as f:
+                self.data = np.frombuffer(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ), dtype="u1")
+
+        self.start = None
+        self.device = None
+        self.clock_offset = None
+        self.records = self._parse()
+
+    def __len__(self):
+        return len(self.records)
+
+    # Payload of i-th line as bytes
+    def line(self, i):
+        r = self.records[i]
+        return self.data[r["offset"]:r["offset"] + r["length"]].tobytes()
+
+    # Indexes of lines of given type(s)
+    def of_type(self, *ltypes):
+        return np.flatnonzero(np.isin(self.records["type"], ltypes))
+
+    # Absolute (UNIX) times of lines (time of day only if there is no date in the header)
+    def timestamps(self):
+        if self.start is None:
+            return self.records["time"].copy()
+        midnight = datetime.combine(self.start.date(), datetime.min.time()).timestamp()
+        return midnight + self.records["time"]
+
+
+    # ------------------------------------------------------------------
+    # PARSER
+    # ------------------------------------------------------------------
+    def _parse(self):
+        size = len(self.data)
+        body = self._header()
+
+        chunks = []
+        pos = body
+        while pos < size:
+            end = min(pos + CHUNK_BYTES, size)
+            nl = np.flatnonzero(self.data[pos:end] == 10) + pos
+
+            if end < size:
+                if not len(nl):
+                    # Line longer than chunk - look further
+                    nl = np.flatnonzero(self.data[pos:] == 10)[:1] + pos
+                    if not len(nl):
+                        nl = np.array([size])
+            elif not len(nl) or nl[-1] != size - 1:
+                # Last line without \n
+                nl = np.append(nl, size)
+
+            starts = np.empty_like(nl)
+            starts[0] = pos
+            starts[1:] = nl[:-1] + 1
+
+            chunks.append(self._parse_lines(starts, nl))
+            pos = int(nl[-1]) + 1
+
+        if not chunks:
+            return np.zeros(0, RECORD)
+
+        rec = np.concatenate(chunks)
+
+        # Time prefixes are time of day - add a day every time the clock wraps around
+        t = rec["time"]
+        wraps = np.flatnonzero(np.diff(t) < -DAY / 2)
+        for w in wraps:
+            t[w + 1:] += DAY
+        return rec
+
+
+    # Header ends with the second separator line
+    def _header(self):
+        if self.data[:1].tobytes() == b"[":
+            return 0
+
+        head = self.data[:HEADER_MAX].tobytes()
+        lines = head.split(b"\n")
+        sep = [i for i, l in enumerate(lines[:-1]) if l.startswith(HEADER_SEPARATOR)]
+        if len(sep) < 2:
+            return 0
+
+        try:
+            self.start = datetime.fromisoformat(lines[0].decode())
+        except ValueError:
+            pass
+
+        for line in lines[sep[0] + 1:sep[1]]:
+            if line.startswith(b"SERIAL INPUT FROM LGTC DEVICE "):
+                self.device = line.decode(errors="replace").rsplit(" ", 1)[-1]
+            elif line.startswith(b"CLOCK OFFSET "):
+                try:
+                    self.clock_offset = float(line.split()[2])
+                except (ValueError, IndexError):
+                    pass
+
+        return sum(len(l) + 1 for l in lines[:sep[1] + 1])
+
+
+    def _parse_lines(self, starts, ends):
+        d = self.data
+        last = len(d) - 1
+        lengths = ends - starts
+
+        # Lines without a valid time prefix are skipped
+        def at(offset):
+            return d[np.minimum(starts + offset, last)]
+
+        valid = (lengths >= PREFIX_SHORT_LEN) & (at(0) == ord("[")) & (at(3) == ord(":")) & (at(6) == ord(":"))
+        starts = starts[valid]
+        ends = ends[valid]
+        lengths = lengths[valid]
+
+        long_prefix = (at(9) == ord(".")) & (lengths >= PREFIX_LEN)
+
+        # Timestamp digits - one gather per digit position (short prefix has no microseconds)
+        sec = np.zeros(len(starts), np.int32)
+        for pos, weight in _HMS:
+            sec += (d[starts + pos].astype(np.int32) - ord("0")) * weight
+
+        usec = np.zeros(len(starts), np.int32)
+        for pos, weight in _USEC:
+            usec += (d[np.minimum(starts + pos, last)].astype(np.int32) - ord("0")) * weight
+        usec[~long_prefix] = 0
+
+        seconds = sec + usec * 1e-6
+
+        payload = starts + np.where(long_prefix, PREFIX_LEN, PREFIX_SHORT_LEN)
+
+        # Line types
+        types = np.full(len(starts), ms.LINE_DATA, dtype="u1")
+        first = d[np.minimum(payload, last)]
+        types[first == ord("$")] = ms.LINE_RESPONSE
+        types[first == ord("&")] = ms.LINE_INFO
+
+        # LGTC tags - only lines starting with "[" are checked
+        cand = np.flatnonzero(first == ord("["))
+        for tag, ltype in TAGS.items():
+            p = payload[cand]
+            match = (ends[cand] - p) >= len(tag)
+            for i, c in enumerate(tag):
+                match &= d[np.minimum(p + i, last)] == c
+            types[cand[match]] = ltype
+            payload[cand[match]] += len(tag)
+
+        rec = np.empty(len(starts), RECORD)
+        rec["time"] = seconds
+        rec["type"] = types
+        rec["start"] = starts
+        rec["offset"] = payload
+        rec["length"] = ends - payload
+        return rec
+
+
+def parse(filename):
+    return results_file(filename)
@@ -0,0 +1,159 @@
+# ----------------------------------------------------------------------
+# RESULTS STATS: Statistics of collected results and log files
+# ----------------------------------------------------------------------
+# results files (node_results_<id>.txt) - parsed with results_parser:
+#   lines per type, timeouts, warnings, errors, first/last line time and
+#   gaps between lines longer than GAP seconds
+# log files (*.log, logging format from experiment_VESNA.py):
+#   lines per log level, command timeouts and command latencies from
+#   "Response on command [...] in X ms" lines
+#
+# Results of one file are a plain dict (JSON serializable), so they can be
+# returned from worker processes and cached.
+# ----------------------------------------------------------------------
+import re
+import hashlib
+
+import numpy as np
+
+from lib import results_parser
+from lib import measurement_store as ms
+
+# ----------------------------------------------------------------------
+VERSION = 1                 # Change when stats change, so cached results are not used
+GAP = 1.0                   # In seconds - pause between lines which is counted as a gap
+HASH_BLOCK = 1024 * 1024
+
+TIMEOUT_MARKERS = (b"Timeout detected", b"timeout occurred")
+
+LOG_LEVEL = re.compile(rb"^\S+ \S+ \[\s*(DEBUG|INFO|WARNING|ERROR|CRITICAL)\]", re.M)
+LOG_LATENCY = re.compile(rb"Response on command \[[^\]]*\] in ([0-9.]+) ms")
+LOG_TIMEOUT = re.compile(rb"No response on command \[")
+
+
+def file_hash(path):
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        while True:
+            block = f.read(HASH_BLOCK)
+            if not block:
+                break
+            h.update(block)
+    return h.hexdigest()
+
+
+# ----------------------------------------------------------------------
+# Statistics of one file
+# ----------------------------------------------------------------------
+def file_stats(path, gap=GAP):
+    if path.endswith(".log"):
+        return log_stats(path)
+    return results_stats(path, gap)
+
+
+def results_stats(path, gap=GAP):
+    r = results_parser.parse(path)
+    rec = r.records
+    types = rec["type"]
+
+    res = {
+        "kind": "results",
+        "node": r.device,
+        "lines": len(r),
+        "types": {name: int(np.count_nonzero(types == t)) for t, name in enumerate(ms.LINE_TYPES)},
+        "timeouts": 0,
+        "warnings": int(np.count_nonzero(types == ms.LINE_WARNING)),
+        "errors": int(np.count_nonzero(types == ms.LINE_ERROR)),
+        "start": None,
+        "end": None,
+        "gaps": 0,
+        "max_gap": 0.0,
+        "latencies": [],
+    }
+
+    # Timeouts are in (few) LGTC lines, so they are checked one by one
+    for i in r.of_type(ms.LINE_LGTC, ms.LINE_WARNING):
+        line = r.line(i)
+        if any(m in line for m in TIMEOUT_MARKERS):
+            res["timeouts"] += 1
+
+    if len(r):
+        t = r.timestamps()
+        res["start"] = float(t[0])
+        res["end"] = float(t[-1])
+        d = np.diff(t)
+        res["gaps"] = int(np.count_nonzero(d > gap))
+        res["max_gap"] = float(d.max()) if len(d) else 0.0
+
+    return res
+
+
+def log_stats(path):
+    with open(path, "rb") as f:
+        data = f.read()
+
+    levels = {}
+    for m in LOG_LEVEL.finditer(data):
+        level = m.group(1).decode()
+        levels[level] = levels.get(level, 0) + 1
+
+    return {
+        "kind": "log",
+        "lines": data.count(b"\n"),
+        "levels": levels,
+        "warnings": levels.get("WARNING", 0),
+        "errors": levels.get("ERROR", 0) + levels.get("CRITICAL", 0),
+        "timeouts": len(LOG_TIMEOUT.findall(data)),
+        "latencies": [float(x) for x in LOG_LATENCY.findall(data)],
+    }
+
+
+# ----------------------------------------------------------------------
+# Reduce statistics of all files into a summary
+# ----------------------------------------------------------------------
+def summary(stats):
+    res = {
+        "files": len(stats),
+        "results_files": 0,
+        "log_files": 0,
+        "lines": 0,
+        "types": {name: 0 for name in ms.LINE_TYPES},
+        "timeouts": 0,
+        "warnings": 0,
+        "errors": 0,
+        "gaps": 0,
+        "max_gap": 0.0,
+        "start": None,
+        "end": None,
+        "commands": 0,
+        "latency_avg": None,
+        "latency_p95": None,
+        "latency_max": None,
+    }
+
+    latencies = []
+    for s in stats:
+        res[s["kind"] + "_files"] += 1
+        for key in ("lines", "timeouts", "warnings", "errors"):
+            res[key] += s[key]
+        latencies += s["latencies"]
+
+        if s["kind"] != "results":
+            continue
+
+        for name, n in s["types"].items():
+            res["types"][name] += n
+        res["gaps"] += s["gaps"]
+        res["max_gap"] = max(res["max_gap"], s["max_gap"])
+        if s["start"] is not None:
+            res["start"] = s["start"] if res["start"] is None else min(res["start"], s["start"])
+            res["end"] = s["end"] if res["end"] is None else max(res["end"], s["end"])
+
+    if latencies:
+        lat = np.array(latencies)
+        res["commands"] = len(lat)
+        res["latency_avg"] = float(lat.mean())
+        res["latency_p95"] = float(np.percentile(lat, 95))
+        res["latency_max"] = float(lat.max())
+
+    return res
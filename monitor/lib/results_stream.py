@@ -0,0 +1,345 @@
+# ----------------------------------------------------------------------
+# RESULTS STREAM: Live streaming of results from LGTC to the controller
+# ----------------------------------------------------------------------
+# LGTC side (results_streamer) - file_logger passes everything it writes
+# into the results file to put(). Data is collected into batches, which
+# are compressed (zlib) and sent by a separate thread over a dedicated
+# DEALER socket (port STREAM_PORT), so results are available on the
+# controller while the experiment is still running.
+#
+#   * a batch is sent when it reaches BATCH_BYTES or BATCH_INTERVAL
+#     seconds after its first byte
+#   * at most WINDOW batches wait for ACK, they are sent again if there
+#     is no ACK in ACK_TIMEOUT seconds (controller drops duplicates)
+#   * back-pressure: put() blocks while more than MAX_BUFFER bytes are
+#     buffered or unacknowledged; if there is no space in BLOCK_TIMEOUT
+#     seconds (controller is gone), data is dropped until the buffer is
+#     half empty and a warning line with the number of lost bytes is
+#     inserted in the stream - results file on LGTC is always complete
+#
+# Controller side (results_receiver) - ROUTER socket which appends
+# batches of every node to <out_dir>/<results file name of the node>.
+#
+# Messages:
+#   LGTC -> controller:     [b"RES", b"<stream id> <seq> <low> <file name>", zlib(data)]
+#   controller -> LGTC:     [b"RACK", b"<stream id> <seq>"]
+# Stream ID is new for every run of the LGTC, so the controller knows when
+# to start the file from the beginning. Low is the lowest batch still
+# waiting for ACK - all before it were written. If controller was restarted
+# during the run, it doesn't know the stream, so it continues the file from
+# batch <low> on.
+# ----------------------------------------------------------------------
+import os
+import zmq
+import time
+import zlib
+import logging
+import threading
+from datetime import datetime
+
+# ----------------------------------------------------------------------
+LOG_LEVEL = logging.DEBUG
+
+STREAM_PORT = 5564
+BATCH_BYTES = 64 * 1024     # In bytes (uncompressed)
+BATCH_INTERVAL = 1.0        # In seconds
+MAX_BUFFER = 4 * 1024 * 1024    # In bytes - buffered and unacknowledged data
+BLOCK_TIMEOUT = 1.0         # In seconds - how long put() waits for space
+WINDOW = 4                  # Batches waiting for ACK
+ACK_TIMEOUT = 3.0           # In seconds
+CLOSE_TIMEOUT = 5.0         # In seconds - how long close() waits for the last ACKs
+COMPRESS_LEVEL = 6
+
+LOST_LINE = "[LGTC_WARNING]:Results stream lost %d bytes\n"
+
+
+class results_streamer():
+
+    def __init__(self, hostname, device, filename, batch_bytes=BATCH_BYTES, batch_interval=BATCH_INTERVAL,
+                 max_buffer=MAX_BUFFER, block_timeout=BLOCK_TIMEOUT, window=WINDOW):
+
+        self.log = logging.getLogger(__name__)
+        self.log.setLevel(LOG_LEVEL)
+
+        self.hostname = hostname
+        self.device = device
+        self.name = os.path.basename(filename)
+        self.batch_bytes = batch_bytes
+        self.batch_interval = batch_interval
+        self.max_buffer = max_buffer
+        self.block_timeout = block_timeout
+        self.window = window
+
+        self.stream_id = "%x" % time.time_ns()
+
+        self._cond = threading.Condition()
+        self._buf = bytearray()
+        self._first = None          # When the first byte of the current batch came in
+        self._buffered = 0          # Bytes in buffer and in batches waiting for ACK
+        self._lost = 0              # Bytes dropped since the last warning line
+        self._closing = False
+
+        # Batches waiting for ACK: {seq : [data, compressed data, time sent]}
+        self._pending = {}
+        self._seq = 0
+
+        # Wakeup pipe - sender thread sleeps in poll on it and the socket
+        self._rfd, self._wfd = os.pipe()
+        os.set_blocking(self._rfd, False)
+        os.set_blocking(self._wfd, False)
+
+        # Statistics
+        self.batches = 0
+        self.bytes_in = 0
+        self.bytes_sent = 0
+        self.resent = 0
+        self.dropped = 0
+
+        self._thread = threading.Thread(target=self._run, name="results_streamer", daemon=True)
+        self._thread.start()
+
+
+    # ----------------------------------------------------------------------------------------
+    # Add data to the stream (called by the file_logger)
+    #
+    #   @return:    False if data was dropped
+    # ----------------------------------------------------------------------------------------
+    def put(self, data):
+        n = len(data)
+        with self._cond:
+            if self._closing:
+                return False
+
+            # After a drop, don't wait again until the controller catches up
+            limit = self.max_buffer // 2 if self._lost else self.max_buffer
+            if self._buffered + n > limit:
+                if self._lost or not self._cond.wait_for(
+                        lambda: self._buffered + n <= limit or self._closing, self.block_timeout):
+                    if not self._lost:
+                        self.log.warning("Controller doesn't keep up with results stream - dropping data")
+                    self._lost += n
+                    self.dropped += n
+                    return False
+
+            if self._lost:
+                self._append(self._lost_line())
+                self._lost = 0
+
+            self._append(data)
+            self.bytes_in += n
+        return True
+
+    def _append(self, data):
+        wake = not self._buf
+        if wake:
+            self._first = time.monotonic()
+        self._buf += data
+        self._buffered += len(data)
+        if wake or len(self._buf) >= self.batch_bytes:
+            self._wakeup()
+
+    def _lost_line(self):
+        return ("[" + str(datetime.now().time()) + "]: " + LOST_LINE % self._lost).encode()
+
+    def _wakeup(self):
+        try:
+            os.write(self._wfd, b"\0")
+        except BlockingIOError:
+            pass
+
+    # Send what is buffered and wait (at most CLOSE_TIMEOUT) until the controller has it
+    def close(self):
+        with self._cond:
+            self._closing = True
+            self._cond.notify_all()
+        self._wakeup()
+        self._thread.join()
+        os.close(self._rfd)
+        os.close(self._wfd)
+
+    def stats(self):
+        return "Stream: %d batches, %d bytes in, %d sent (compressed), %d resent, %d dropped, %d buffered" % (
+            self.batches, self.bytes_in, self.bytes_sent, self.resent, self.dropped, self._buffered)
+
+
+    # ----------------------------------------------------------------------------------------
+    # SENDER THREAD
+    # ----------------------------------------------------------------------------------------
+    def _run(self):
+        sock = zmq.Context.instance().socket(zmq.DEALER)
+        sock.identity = self.device.encode()
+        sock.linger = 0
+        sock.connect(self.hostname)
+
+        poller = zmq.Poller()
+        poller.register(sock, zmq.POLLIN)
+        poller.register(self._rfd, zmq.POLLIN)
+
+        close_deadline = None
+
+        while True:
+            now = time.monotonic()
+
+            with self._cond:
+                closing = self._closing
+                # Next batch
+                if self._buf and len(self._pending) < self.window and \
+                   (closing or len(self._buf) >= self.batch_bytes or now - self._first >= self.batch_interval):
+                    data = bytes(self._buf[:self.batch_bytes])
+                    del self._buf[:len(data)]
+                    self._first = now if self._buf else None
+                else:
+                    data = None
+                empty = not self._buf and not self._pending
+
+            if data is not None:
+                self._send(sock, self._seq, data)
+                self._seq += 1
+                continue
+
+            if closing:
+                if empty:
+                    break
+                if close_deadline is None:
+                    close_deadline = now + CLOSE_TIMEOUT
+                elif now >= close_deadline:
+                    self.log.warning("Results stream closed with %d bytes not acknowledged", self._buffered)
+                    break
+
+            # Resend batches without ACK (all of them, in order)
+            for seq, p in sorted(self._pending.items()):
+                if now - p[2] >= ACK_TIMEOUT:
+                    self.resent += 1
+                    self._send(sock, seq, p[0], p[1])
+
+            # Sleep until ACK, new data, batch deadline or ACK deadline
+            timeout = [ACK_TIMEOUT]
+            with self._cond:
+                if self._buf and len(self._pending) < self.window:
+                    timeout.append(self._first + self.batch_interval - now)
+            for p in self._pending.values():
+                timeout.append(p[2] + ACK_TIMEOUT - now)
+            if close_deadline is not None:
+                timeout.append(close_deadline - now)
+
+            events = dict(poller.poll(max(0, min(timeout)) * 1000))
+
+            if self._rfd in events:
+                try:
+                    while os.read(self._rfd, 4096):
+                        pass
+                except BlockingIOError:
+                    pass
+
+            if sock in events:
+                while sock.poll(0):
+                    self._ack(sock.recv_multipart())
+
+        sock.close()
+
+    def _send(self, sock, seq, data, compressed=None):
+        if compressed is None:
+            compressed = zlib.compress(data, COMPRESS_LEVEL)
+            self.batches += 1
+        low = min(seq, min(self._pending)) if self._pending else seq
+        meta = "%s %d %d %s" % (self.stream_id, seq, low, self.name)
+        sock.send_multipart([b"RES", meta.encode(), compressed])
+        self._pending[seq] = [data, compressed, time.monotonic()]
+        self.bytes_sent += len(compressed)
+
+    def _ack(self, msg):
+        try:
+            kind, meta = msg
+            stream_id, seq = meta.decode().split()
+            seq = int(seq)
+        except ValueError:
+            self.log.warning("Bad message on results stream: %s", msg)
+            return
+
+        if kind != b"RACK" or stream_id != self.stream_id or seq not in self._pending:
+            return
+
+        data = self._pending.pop(seq)[0]
+        with self._cond:
+            self._buffered -= len(data)
+            self._cond.notify_all()
+
+
+
+# ----------------------------------------------------------------------
+# Controller side - receive batches and append them to per node files
+# ----------------------------------------------------------------------
+class results_receiver():
+
+    def __init__(self, out_dir, port=STREAM_PORT):
+
+        self.log = logging.getLogger(__name__)
+        self.log.setLevel(LOG_LEVEL)
+
+        self.out_dir = out_dir
+        os.makedirs(out_dir, exist_ok=True)
+
+        self.socket = zmq.Context.instance().socket(zmq.ROUTER)
+        self.socket.bind("tcp://*:%d" % port)
+
+        # {device : [stream id, next seq, file]}
+        self.nodes = {}
+
+        self.batches = 0
+        self.bytes = 0
+
+    # Handle one message from the socket
+    def receive(self):
+        msg = self.socket.recv_multipart()
+        try:
+            device, kind, meta, payload = msg
+            stream_id, seq, low, name = meta.decode().split(" ", 3)
+            seq = int(seq)
+            low = int(low)
+        except ValueError:
+            self.log.warning("Bad message on results stream from %s", msg[0])
+            return
+
+        device = device.decode()
+        node = self.nodes.get(device)
+
+        # New run of the node - start its file from the beginning; stream which started
+        # before we were (re)started - continue its file with the lowest batch without ACK
+        if node is None or node[0] != stream_id:
+            if seq != low:
+                return
+            if node is not None:
+                node[2].close()
+            name = os.path.basename(name)
+            if seq == 0:
+                self.log.info("New results stream from %s into %s", device, name)
+                f = open(os.path.join(self.out_dir, name), "wb")
+            else:
+                self.log.info("Continuing results stream from %s into %s at batch %d", device, name, seq)
+                f = open(os.path.join(self.out_dir, name), "ab")
+            node = [stream_id, seq, f]
+            self.nodes[device] = node
+
+        # Next batch - append it; older one - it was resent, only ACK it again;
+        # newer one - previous is missing, wait for the LGTC to resend it
+        if seq == node[1]:
+            try:
+                data = zlib.decompress(payload)
+            except zlib.error:
+                self.log.warning("Corrupted batch %d from %s", seq, device)
+                return
+            node[2].write(data)
+            node[2].flush()
+            node[1] += 1
+            self.batches += 1
+            self.bytes += len(data)
+        elif seq > node[1]:
+            return
+
+        self.socket.send_multipart([msg[0], b"RACK", ("%s %d" % (stream_id, seq)).encode()])
+
+    def close(self):
+        for node in self.nodes.values():
+            node[2].close()
+        self.nodes = {}
+        self.socket.close()
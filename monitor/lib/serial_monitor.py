@@ -4,10 +4,216 @@
 import sys
 import serial
 import logging
+import binascii
+from collections import deque
 from timeit import default_timer as timer
 
 LOG_LEVEL = logging.DEBUG
 
+# Size of receive buffer - one read never takes more than this from the driver
+RX_BUFFER_SIZE = 64 * 1024
+
+# Binary framing: SOF | type | length (2B, LE) | payload | CRC16 (2B, LE)
+# CRC16-CCITT (init 0xFFFF) is calculated over type, length and payload.
+FRAME_SOF = 0x7E
+FRAME_HEADER = 4
+FRAME_CRC = 2
+FRAME_MAX_PAYLOAD = 1024
+
+# Frame types - text frames use the same characters as lines in text mode
+FRAME_RESPONSE = ord("$")   # Response on command
+FRAME_INFO = ord("&")       # Info message from VESNA (not a response on command)
+FRAME_SYNC = ord("@")       # Sync
+FRAME_STOP = ord("=")       # Stop the application
+FRAME_LINE = ord("L")       # Plain text line
+FRAME_DATA = ord("M")       # Binary measurement payload
+
+# Measurement frames are given out as raw payloads (data_frame), which go to the columnar
+# store without any formatting. With True they are given out as "M <hex>" text lines, as
+# they were written into the results file before (compatibility with old analysis tools).
+MEASUREMENT_HEX = False
+
+
+# Build a binary frame with given type and payload (bytes)
+def encode_frame(ftype, payload):
+    head = bytes([ftype, len(payload) & 0xFF, len(payload) >> 8])
+    crc = binascii.crc_hqx(payload, binascii.crc_hqx(head, 0xFFFF))
+    return bytes([FRAME_SOF]) + head + payload + bytes([crc & 0xFF, crc >> 8])
+
+
+# Raw payload of a measurement frame - not a text line (no ending \n)
+class data_frame(bytes):
+    pass
+
+
+# Line that represents the frame in the results file (bytes, with ending \n)
+def frame_line(ftype, payload):
+    if ftype == FRAME_LINE:
+        return bytes(payload) + b"\n"
+    elif ftype == FRAME_DATA:
+        return b"M " + payload.hex().encode() + b"\n"
+    else:
+        return bytes([ftype]) + bytes(payload) + b"\n"
+
+
+# ----------------------------------------------------------------------
+# Incremental line framer. Bytes from the driver are read in large chunks
+# into a fixed bytearray and all complete lines are cut out of it at once.
+# Partial line stays in the buffer until the rest of it arrives.
+# ----------------------------------------------------------------------
+class line_framer():
+
+    def __init__(self, size=RX_BUFFER_SIZE):
+        self.buf = bytearray(size)
+        self.view = memoryview(self.buf)
+        self.start = 0      # First byte that was not framed yet
+        self.end = 0        # End of received data
+
+        self.log = logging.getLogger(__name__)
+        self.log.setLevel(LOG_LEVEL)
+
+    # Make room at the end of buffer by moving the partial line to the front
+    def _compact(self):
+        if self.start == self.end:
+            self.start = self.end = 0
+        elif self.start > 0:
+            n = self.end - self.start
+            self.buf[:n] = bytes(self.view[self.start:self.end])
+            self.start = 0
+            self.end = n
+
+    # ------------------------------------------------------------------
+    # Read bytes from serial port into the buffer. Takes everything that
+    # is waiting in the driver (up to free space); if nothing is waiting,
+    # it blocks for one byte (or serial timeout).
+    #
+    #   @params:    ser - opened serial port
+    #   @return:    number of bytes read
+    # ------------------------------------------------------------------
+    def fill(self, ser):
+        self._compact()
+
+        # Line is longer than the whole buffer - give it out as it is
+        if self.end == len(self.buf):
+            self.log.warning("Line longer than %d bytes, splitting it", len(self.buf))
+            return 0
+
+        n = min(max(ser.in_waiting, 1), len(self.buf) - self.end)
+        n = ser.readinto(self.view[self.end:self.end + n])
+        self.end += n
+        return n
+
+    # ------------------------------------------------------------------
+    # Cut all complete lines out of the buffer. Lines are memoryviews into
+    # the buffer (no copy) - they are valid only until the next fill().
+    #
+    #   @return:    list of lines (memoryview, including the ending \n)
+    # ------------------------------------------------------------------
+    def lines(self):
+        lines = []
+        find = self.buf.find
+        start = self.start
+        end = self.end
+
+        while True:
+            i = find(b"\n", start, end)
+            if i < 0:
+                break
+            lines.append(self.view[start:i + 1])
+            start = i + 1
+
+        # Buffer is full of a single partial line
+        if not lines and start == 0 and end == len(self.buf):
+            lines.append(self.view[:end])
+            start = end
+
+        self.start = start
+        return lines
+
+    # Put given bytes in the buffer (instead of reading them from serial port)
+    def feed(self, data):
+        self._compact()
+        n = min(len(data), len(self.buf) - self.end)
+        self.buf[self.end:self.end + n] = data[:n]
+        self.end += n
+        return n
+
+    # Return True if there is a partial line in the buffer
+    def pending(self):
+        return self.start != self.end
+
+
+# ----------------------------------------------------------------------
+# Decoder of binary frames. Uses the same receive buffer as line_framer.
+# On wrong length or CRC the decoder skips one byte and searches for the
+# next SOF, so it resyncs after corrupted or lost bytes.
+# ----------------------------------------------------------------------
+class frame_decoder(line_framer):
+
+    def __init__(self, size=RX_BUFFER_SIZE, measurement_hex=MEASUREMENT_HEX):
+        line_framer.__init__(self, size)
+        self.measurement_hex = measurement_hex
+
+        self.crc_errors = 0         # Number of corrupted frames
+        self.resync_bytes = 0       # Number of bytes skipped while searching for SOF
+
+    # ------------------------------------------------------------------
+    # Cut all complete frames out of the buffer. Payloads are memoryviews
+    # into the buffer - they are valid only until the next fill().
+    #
+    #   @return:    list of (type, payload)
+    # ------------------------------------------------------------------
+    def frames(self):
+        frames = []
+        buf = self.buf
+        start = self.start
+        end = self.end
+
+        while True:
+            i = buf.find(FRAME_SOF, start, end)
+            if i < 0:
+                self.resync_bytes += end - start
+                start = end
+                break
+
+            self.resync_bytes += i - start
+            start = i
+
+            # Wait for the rest of the header
+            if end - start < FRAME_HEADER:
+                break
+
+            length = buf[start + 2] | (buf[start + 3] << 8)
+            if length > FRAME_MAX_PAYLOAD:
+                self.crc_errors += 1
+                start += 1
+                continue
+
+            # Wait for the rest of the frame
+            total = FRAME_HEADER + length + FRAME_CRC
+            if end - start < total:
+                break
+
+            crc = buf[start + total - 2] | (buf[start + total - 1] << 8)
+            if binascii.crc_hqx(self.view[start + 1:start + FRAME_HEADER + length], 0xFFFF) != crc:
+                self.crc_errors += 1
+                start += 1
+                continue
+
+            frames.append((buf[start + 1], self.view[start + FRAME_HEADER:start + FRAME_HEADER + length]))
+            start += total
+
+        self.start = start
+        return frames
+
+    # All complete frames, given out as lines for the results file (measurements as data_frame)
+    def lines(self):
+        if self.measurement_hex:
+            return [frame_line(ftype, payload) for ftype, payload in self.frames()]
+        return [data_frame(payload) if ftype == FRAME_DATA else frame_line(ftype, payload)
+                for ftype, payload in self.frames()]
+
+
 # ----------------------------------------------------------------------
 class serial_monitor():
 
@@ -17,11 +223,20 @@ class serial_monitor():
     STOPBIT = serial.STOPBITS_ONE
     BYTESIZE = serial.EIGHTBITS
     
-    def __init__(self, timeout=10):
+    # framing - "line" for newline terminated text, "binary" for frames with CRC
+    # measurement_hex - give out measurement frames as text lines (see MEASUREMENT_HEX)
+    def __init__(self, timeout=10, framing="line", measurement_hex=MEASUREMENT_HEX):
         self.timeout = timeout
         self.ser = None
         self.serial_avaliable = False
 
+        self.framing = framing
+        if framing == "binary":
+            self.framer = frame_decoder(measurement_hex=measurement_hex)
+        else:
+            self.framer = line_framer()
+        self.lines = deque()    # Framed lines (bytes) not yet given out by read_line()
+
         self.log = logging.getLogger(__name__)
         self.log.setLevel(LOG_LEVEL)
         
@@ -53,33 +268,77 @@ class serial_monitor():
         return True
 
 
+    # Read one line - compatibility wrapper around read_raw_lines()
+    # Returns empty string if there was no complete line until timeout
+    # Other lines that came with it stay in self.lines (as bytes) for the next read
     def read_line(self):
-        #self.log.debug("Serial read")
-        #data = self.ser.readline()
+        startTime = timer()
+        while not self.lines:
+            self.lines.extend(line if isinstance(line, bytes) else bytes(line) for line in self._read_framed())
+            if not self.lines and (timer() - startTime) > self.timeout:
+                return ""
+        return str(self.lines.popleft(), "utf-8", "replace")
+
+
+    # Read everything that is waiting in the driver and return all complete lines
+    # If there is nothing to read, wait for data (at most until serial timeout)
+    def read_lines(self):
+        return [str(line, "utf-8", "replace") for line in self.read_raw_lines()]
+
+
+    # Same as read_lines() but without decoding - returns memoryviews into the receive
+    # buffer, which must be consumed before the next read from the serial port
+    # In binary mode frames are converted to lines (see frame_line()), measurement frames
+    # are given out as data_frame unless MEASUREMENT_HEX is set
+    def read_raw_lines(self):
+        # Lines allready framed by read_line() go first (input_waiting() reports them)
+        if self.lines:
+            lines = list(self.lines)
+            self.lines.clear()
+            return lines
+
+        return self._read_framed()
+
+    def _read_framed(self):
         # TODO:AttributeError: 'NoneType' object has no attribute 'read_until'
-        data = self.ser.read_until(b'\n', None)
-        data = data.decode()
-        self.serial_avaliable = True
-        return data
+        self.framer.fill(self.ser)
+        lines = self.framer.lines()
+        if lines:
+            self.serial_avaliable = True
+        return lines
 
 
     def write_line(self, data):
         # Convert data to string and add \n | send over serial
+        # In binary mode first character is the frame type and the rest is payload
         #self.log.debug("Serial write")
         try:
-            self.ser.write((data + "\n").encode("ASCII"))
+            if self.framing == "binary":
+                self.ser.write(encode_frame(ord(data[0]), data[1:].encode("ASCII")))
+            else:
+                self.ser.write((data + "\n").encode("ASCII"))
         except:
             self.log.error("Error writing to device!")
         finally:
             return
 
     def input_waiting(self):
-        if self.ser.inWaiting() > 0:
+        if self.lines or self.ser.inWaiting() > 0:
             return True
         else:
             return False
 
+    # Number of corrupted frames (always 0 in line mode)
+    def frame_errors(self):
+        return getattr(self.framer, "crc_errors", 0)
+
+    # File descriptor of the serial port - use it to wait for input with select/poll
+    def fileno(self):
+        return self.ser.fileno()
+
     def flush(self):
+        self.framer.start = self.framer.end = 0
+        self.lines.clear()
         self.ser.reset_input_buffer()
         self.ser.reset_output_buffer()
         return
@@ -132,16 +391,19 @@ class serial_monitor():
         return True
 
 
-    def send_command(self, command):
-        self.log.debug("Serial send %s command to VESNA" % command)
+    # Tagged commands are sent as "$<tag> CMD" - VESNA must echo the tag in the response
+    def send_command(self, command, tag=None):
+        self.log.debug("Serial send %s command to VESNA", command)
 
         if len(command) > 5:
             self.log.warning("Command must be only 5 characters long!")
-        else:
+        elif tag is None:
             self.write_line("$ " + command)
+        else:
+            self.write_line("$" + tag + " " + command)
 
     def send_command_with_arg(self, command, arg):
-        self.log.debug("Serial send %s command with argument %s to VESNA" % (command, arg))
+        self.log.debug("Serial send %s command with argument %s to VESNA", command, arg)
         
         if len(command) > 5:
             self.log.warning("Command must be only 5 characters long!")
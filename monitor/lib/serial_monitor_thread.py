@@ -2,6 +2,8 @@
 
 
 import threading
+import selectors
+from collections import OrderedDict
 from queue import Queue
 import sys
 import os
@@ -12,11 +14,55 @@ from subprocess import Popen, PIPE
 
 from lib import serial_monitor
 from lib import file_logger
+from lib import timer_scheduler
+from lib import results_stream
 
 
 # DEFINITIONS
 LOG_LEVEL = logging.DEBUG
 SERIAL_TIMEOUT = 2  # In seconds
+SERIAL_PORT = "ttyS2"
+
+# Serial monitor loop - "event" sleeps until something happens, "spin" is the legacy busy loop
+READ_MODE = "event"
+FAILSAFE = True
+SERIAL_CHECK_INTERVAL = 10  # In seconds
+SERIAL_TIMEOUTS = 5         # Number of check intervals without input before TIMEOUT state
+QUEUE_POLL_INTERVAL = 0.05  # In seconds - only used if input queue has no wakeup descriptor
+
+# UART framing - "line" for newline terminated text, "binary" for frames with CRC
+FRAMING = "line"
+
+CHAR_RESPONSE = ord("$")
+CHAR_INFO = ord("&")
+CHAR_NO_TAG = ord(" ")
+
+# Number of commands sent to VESNA without waiting for response. With 1 commands are sent
+# as "$ CMD" (legacy). With more, each command gets a tag which VESNA must echo in its
+# response: "$<tag> CMD" --> "$<tag> RESP".
+CMD_WINDOW = 1
+CMD_TIMEOUT = 3     # In seconds
+CMD_TAGS = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
+
+# Results file is written by a separate writer thread, so serial reading never waits for the SD card
+ASYNC_WRITER = True
+WRITER_CHECK_INTERVAL = 5   # In seconds - how often write errors of the results file are reported
+
+# Results file compression (None, "gzip", "zstd") and rotation into segments (0 = never)
+RESULTS_COMPRESSION = None
+RESULTS_ROTATE_BYTES = 0        # In bytes (uncompressed)
+RESULTS_ROTATE_INTERVAL = 0     # In seconds
+
+# Also store lines in a columnar binary store (node_results_<id>.cols/) for fast analysis
+# (always on with binary framing - raw measurement frames are stored only there, unless
+# serial_monitor.MEASUREMENT_HEX is set)
+RESULTS_COLUMNAR = False
+
+# Write a sparse time index (node_results_<id>.idx) for reading time ranges of the results file
+RESULTS_INDEX = False
+
+# Also stream results to the controller while the experiment runs (None = don't stream)
+RESULTS_STREAM = None       # e.g. "tcp://193.2.205.19:5564"
 
 
 class serial_monitor_thread(threading.Thread):
@@ -24,35 +70,56 @@ class serial_monitor_thread(threading.Thread):
     # ----------------------------------------------------------------------------------------
     # INIT
     # ----------------------------------------------------------------------------------------
-    def __init__(self, input_q, output_q, filename, lgtcname, app_name, app_path):
+    def __init__(self, input_q, output_q, filename, lgtcname, app_name, app_path, read_mode=READ_MODE, framing=FRAMING, cmd_window=CMD_WINDOW, async_writer=ASYNC_WRITER,
+                 clock_offset=None, clock_rtt=None, stream=RESULTS_STREAM):
 
         threading.Thread.__init__(self)
         self._is_thread_running = True
         self.app_name = app_name
         self.app_path = app_path
+        self.port = SERIAL_PORT
+        self.read_mode = read_mode
 
         self.log = logging.getLogger(__name__)
         self.log.setLevel(LOG_LEVEL)
 
         # Init lib
-        self.monitor = serial_monitor.serial_monitor(SERIAL_TIMEOUT)
-        self.f = file_logger.file_logger()
+        self.monitor = serial_monitor.serial_monitor(SERIAL_TIMEOUT, framing)
+        columnar = RESULTS_COLUMNAR or (framing == "binary" and not serial_monitor.MEASUREMENT_HEX)
+        self.stream = None
+        if stream:
+            self.stream = results_stream.results_streamer(stream, lgtcname, filename)
+        self.f = file_logger.file_logger(writer=async_writer, compression=RESULTS_COMPRESSION,
+                                         rotate_bytes=RESULTS_ROTATE_BYTES, rotate_interval=RESULTS_ROTATE_INTERVAL,
+                                         columnar=columnar, index=RESULTS_INDEX, stream=self.stream)
 
         # Link multithread input output queue
         self.in_q = input_q
         self.out_q = output_q
 
         # file_logger.py - prepare measurements file
-        self.f.prepare_file(filename, lgtcname)
+        self.f.prepare_file(filename, lgtcname, clock_offset, clock_rtt)
         self.f.open_file()  
 
-        # Experiment vars
-        self._command_waiting = None
-        self._command_timeout = False
+        # Deadlines for failsafe and command timeouts
+        self.timers = timer_scheduler.timer_scheduler()
+
+        # Commands waiting for response: {tag : [sqn, time sent, timeout timer]}
+        self.cmd_window = max(1, min(cmd_window, len(CMD_TAGS)))
+        self._commands_waiting = OrderedDict()
+        self._next_tag = 0
+
+        # Command latency statistics
+        self.cmd_count = 0
+        self.cmd_latency_sum = 0
+        self.cmd_latency_max = 0
+        self.cmd_latency_last = 0
 
         # Class vars
         self.lines_stored = 0
-        self.elapsed_sec = 0
+        self._timeout_cnt = 0
+        self._frame_errors = 0
+        self._write_errors = 0
 
 
     # ----------------------------------------------------------------------------------------  
@@ -74,112 +141,275 @@ class serial_monitor_thread(threading.Thread):
         if not self.VESNA_sync():
             return
 
-        timeout_cnt = 0
-        loop_time = timer()
+        # Failsafe - check if VESNA is still sending something
+        if FAILSAFE:
+            self.timers.call_every(SERIAL_CHECK_INTERVAL, self.check_serial)
+
+        # Results which couldn't be written (disk full...) must not be lost silently
+        self.timers.call_every(WRITER_CHECK_INTERVAL, self.check_writer)
+
+        if self.read_mode == "event":
+            self.run_event()
+        else:
+            self.run_spin()
+
+
+    # ----------------------------------------------------------------------------------------
+    # Event driven loop - thread sleeps in select() until there are bytes on the serial port,
+    # a command in the input queue or the next timer deadline.
+    # ----------------------------------------------------------------------------------------
+    def run_event(self):
+
+        sel = selectors.DefaultSelector()
+        sel.register(self.monitor.fileno(), selectors.EVENT_READ, "SERIAL")
+
+        # Without a wakeup descriptor on the input queue we must check it periodically
+        max_timeout = None
+        if hasattr(self.in_q, "fileno"):
+            sel.register(self.in_q.fileno(), selectors.EVENT_READ, "QUEUE")
+        else:
+            self.log.warning("Input queue has no wakeup descriptor - polling it every %s s", QUEUE_POLL_INTERVAL)
+            max_timeout = QUEUE_POLL_INTERVAL
 
         while self._is_thread_running:
 
-            # -------------------------------------------------------------------------------
-            # SERAIL_MONITOR - FAILSAFE
-            # You can disable it by changing value to False (TODO different mechanism?)
-            #   * Check if serial was available in last 10 seconds
-            #   * Check if we got respond on a command in last 3 sec
-            if True:
-
-                # Count seconds
-                if ((timer() - loop_time) > 1):
-                    self.elapsed_sec += (timer() - loop_time)
-                    loop_time = timer()
-                    #self.log.debug("Elapsed seconds: " + str(self.elapsed_sec))
-
-                    # Every 10 seconds
-                    if self.elapsed_sec % 10 == 0:
-                        
-                        # Check if serial_monitor received something
-                        if not self.monitor.serial_avaliable:
-                            self.f.store_lgtc_line("Timeout detected.")
-                            timeout_cnt += 1
-                            self.log.warning("No lines read for more than 10 seconds..")
-
-                        if timeout_cnt > 5:
-                            self.f.warning("VESNA did not respond for more than a minute")
-                            self.queuePutState("TIMEOUT")
-                            self.log.error("VESNA did not respond for more than a minute")
-                            timeout_cnt = 0
-                            self._is_app_running = False
-                            # We don't do anything here - let the user interfeer
-
-                        # Set to False, so when monitor reads something, it goes back to True
-                        self.monitor.serial_avaliable = False
-
-                    # Every 3 seconds
-                    if self.elapsed_sec % 3 == 0:
-                        if self._command_waiting != None:
-                            self.log.debug("Waiting for response...")
-                            # If _command_timeout allready occurred - response on command was
-                            # not captured for more than 3 seconds. Something went wrong, 
-                            # so stop waiting for it
-                            if self._command_timeout:
-                                self.f.warning("Command timeout occurred!")
-                                self.queuePutResp(self._command_waiting, "Failed to get response ...")
-                                self.queuePutState("TIMEOUT")
-                                self.log.warning("No response on command for more than 3 seconds!")
-                                self._command_timeout = False
-                                self._command_waiting = None
-                            
-                            self._command_timeout = True
-
-            # -------------------------------------------------------------------------------
-            # SERIAL MONITOR - READ UART
-            # Read and store everything that comes on Serial connection
-            # If line is a response, forward it to zmq thread for processing
-            if self.monitor.input_waiting():
-                data = self.monitor.read_line()
+            timeout = self.timers.run_due()
 
-                self.f.store_line(data)
-                self.lines_stored += 1
+            # Command timeout may have freed the command window - send waiting commands before
+            # sleeping (queue wakeup was already consumed) and take their timers into account
+            if self.check_commands():
+                continue
 
-                # If we got response on the command
-                # TODO: check if it is a multiline response
-                if data[0] == "$":
+            if max_timeout is not None and (timeout is None or timeout > max_timeout):
+                timeout = max_timeout
 
-                    # Remove first 2 char '$ ' and last two char '\n'
-                    resp = data[2:-1]
+            events = sel.select(timeout)
 
-                    # If application just started, reset values
-                    if resp == "START":
-                        self.lines_stored = 0
-                        self.elapsed_sec = 0
+            for key, mask in events:
+                if key.data == "QUEUE":
+                    self.in_q.clear_wakeup()
 
-                    # If there is no SQN waiting for response, we got INFO message from VESNA for monitor
-                    if(self._command_waiting):
-                        self.queuePutResp(self._command_waiting, resp)
-                        self.log.debug("Got response on cmd from VESNA: " + resp)
-                    else:
-                        # TODO: if there is command waiting but VESNA responds with info, SQN is lost - 
-                        # Fix this with another character for info (@-sync, $-cmd, &-info for example)
-                        self.queuePutInfo(resp)
-                        self.log.debug("Got info from VESNA: " + resp)
+            while self._is_thread_running and self.monitor.input_waiting():
+                self.read_uart()
 
-                    self._command_waiting = None
-                    self._command_timeout = False
+            while self._is_thread_running and self.check_commands():
+                pass
 
+        sel.close()
+
+
+    # ----------------------------------------------------------------------------------------
+    # Legacy busy loop - keeps checking serial port and input queue without blocking
+    # ----------------------------------------------------------------------------------------
+    def run_spin(self):
+
+        while self._is_thread_running:
+
+            self.timers.run_due()
+
+            if self.monitor.input_waiting():
+                self.read_uart()
 
-            # -------------------------------------------------------------------------------
-            # CONTROLLER CLIENT - GET COMMANDS
             # Check for incoming commands only when there is time - nothing to do on UART
-            # If all comand responses were received (not waiting for one)
-            # and there is new command in queue, forward it to VESNA
-            elif (not self.in_q.empty() and self._command_waiting == None):
+            else:
+                self.check_commands()
+
+
+    # ----------------------------------------------------------------------------------------
+    # SERAIL_MONITOR - FAILSAFE
+    # Called every SERIAL_CHECK_INTERVAL seconds. You can disable it by changing value of 
+    # FAILSAFE to False.
+    #   * Check if serial was available in last interval
+    #   * After SERIAL_TIMEOUTS such intervals in a row, report TIMEOUT
+    # ----------------------------------------------------------------------------------------
+    def check_serial(self):
+
+        # Check if serial_monitor received something
+        if not self.monitor.serial_avaliable:
+            self.f.store_lgtc_line("Timeout detected.")
+            self._timeout_cnt += 1
+            self.log.warning("No lines read for more than %s seconds..", SERIAL_CHECK_INTERVAL)
+        else:
+            self._timeout_cnt = 0
+
+        if self._timeout_cnt > SERIAL_TIMEOUTS:
+            self.f.warning("VESNA did not respond for more than a minute")
+            self.queuePutState("TIMEOUT")
+            self.log.error("VESNA did not respond for more than a minute")
+            self._timeout_cnt = 0
+            # We don't do anything here - let the user interfeer
+
+        # Set to False, so when monitor reads something, it goes back to True
+        self.monitor.serial_avaliable = False
+
+
+    # ----------------------------------------------------------------------------------------
+    # Called every WRITER_CHECK_INTERVAL seconds - report new write errors of the results file
+    # (once per interval, not for every lost line)
+    # ----------------------------------------------------------------------------------------
+    def check_writer(self):
+
+        errors = self.f.write_errors
+        if errors == self._write_errors:
+            return
+
+        self.log.error("Results file write failed %d time(s): %s (%d bytes lost so far)",
+                       errors - self._write_errors, self.f.last_error, self.f.lost_bytes)
+        self.queuePutInfo("Writing results failed: " + str(self.f.last_error) + " (" + str(self.f.lost_bytes) + " bytes lost)")
+        self.queuePutState("LGTC_WARNING")
+        self._write_errors = errors
+
+
+    # ----------------------------------------------------------------------------------------
+    # Timer callback - we didn't get response on a command in CMD_TIMEOUT seconds, so stop
+    # waiting for it
+    # ----------------------------------------------------------------------------------------
+    def command_timeout(self, tag):
+
+        sqn, sent, handle = self._commands_waiting.pop(tag)
+        self.f.warning("Command timeout occurred!")
+        self.queuePutResp(sqn, "Failed to get response ...")
+        self.queuePutState("TIMEOUT")
+        self.log.warning("No response on command [%s] for more than %s seconds!", sqn, CMD_TIMEOUT)
+
+
+    # ----------------------------------------------------------------------------------------
+    # SERIAL MONITOR - READ UART
+    # Read and store everything that comes on Serial connection (all waiting lines at once)
+    # If line is a response, forward it to zmq thread for processing
+    # ----------------------------------------------------------------------------------------
+    def read_uart(self):
+
+        for data in self.monitor.read_raw_lines():
+            self.handle_line(data)
+
+        # In binary mode corrupted frames are detected and dropped
+        errors = self.monitor.frame_errors()
+        if errors != self._frame_errors:
+            self.f.warning("Dropped " + str(errors - self._frame_errors) + " corrupted frame(s)")
+            self.log.warning("Dropped %d corrupted frame(s) from VESNA", errors - self._frame_errors)
+            self._frame_errors = errors
+
+
+    # Lines are kept in bytes (memoryview) all the way to the results file - only
+    # responses on commands are decoded
+    def handle_line(self, data):
+
+        self.lines_stored += 1
+
+        # Raw measurement frame (binary framing) - nothing else to do with it
+        if type(data) is serial_monitor.data_frame:
+            self.f.store_frame(data)
+            return
+
+        self.f.store_line(data)
+
+        # If we got response on the command
+        # TODO: check if it is a multiline response
+        if data[0] == CHAR_RESPONSE:
+
+            # Untagged response '$ RESP\n' or tagged response '$<tag> RESP\n'
+            if len(data) > 1 and data[1] != CHAR_NO_TAG:
+                tag = chr(data[1])
+                resp = str(data[3:-1], "utf-8", "replace")
+            else:
+                tag = " "
+                resp = str(data[2:-1], "utf-8", "replace")
+
+            # If application just started, reset values
+            if resp == "START":
+                self.lines_stored = 0
+
+            # With legacy (untagged) commands any response belongs to the waiting command
+            if self.cmd_window == 1 and self._commands_waiting:
+                tag = next(iter(self._commands_waiting))
+
+            # If there is no SQN waiting for response, we got INFO message from VESNA for monitor
+            if tag in self._commands_waiting:
+                sqn, sent, handle = self._commands_waiting.pop(tag)
+                handle.cancel()
+                self.queuePutResp(sqn, resp)
+                self.command_latency(sqn, timer() - sent)
+                self.log.debug("Got response on cmd from VESNA: %s", resp)
+            else:
+                # If there is command waiting but VESNA responds with info, SQN is lost -
+                # applications should send info messages with '&' instead
+                if tag != " ":
+                    self.log.warning("Got response with unknown tag %s (timed out?)", tag)
+                self.queuePutInfo(resp)
+                self.log.debug("Got info from VESNA: %s", resp)
+
+        # Info message from VESNA - never a response, so waiting SQN is not lost
+        elif data[0] == CHAR_INFO:
+            resp = str(data[2:-1], "utf-8", "replace")
+            self.queuePutInfo(resp)
+            self.log.debug("Got info from VESNA: %s", resp)
+
+
+    # ----------------------------------------------------------------------------------------
+    # CONTROLLER CLIENT - GET COMMANDS
+    # If there is room in the command window (less than cmd_window commands waiting for
+    # response) and there is new command in queue, forward it to VESNA
+    #
+    #   @return:    True if a command was taken from the queue
+    # ----------------------------------------------------------------------------------------
+    def check_commands(self):
+
+        if self.in_q.empty() or len(self._commands_waiting) >= self.cmd_window:
+            return False
+
+        sqn, cmd = self.queueGet()
+
+        if cmd == "LINES":
+            resp = "Sotred lines: " + str(self.lines_stored)
+            self.queuePutResp(sqn, resp)
+
+        elif cmd == "LATENCY":
+            self.queuePutResp(sqn, self.latency_str())
+
+        elif cmd == "STREAM":
+            self.queuePutResp(sqn, self.stream.stats() if self.stream else "Results stream is disabled")
+
+        # New clock offset estimate from the client - only store it in the results file
+        elif cmd.startswith("CLOCK_OFFSET"):
+            self.f.store_lgtc_line(cmd)
+
+        elif self.cmd_window == 1:
+            self.monitor.send_command(cmd)
+            self._commands_waiting[" "] = [sqn, timer(), self.timers.call_later(CMD_TIMEOUT, self.command_timeout, " ")]
+
+        else:
+            tag = self.new_tag()
+            self.monitor.send_command(cmd, tag)
+            self._commands_waiting[tag] = [sqn, timer(), self.timers.call_later(CMD_TIMEOUT, self.command_timeout, tag)]
+
+        return True
+
+
+    # Next free tag for a command
+    def new_tag(self):
+        while True:
+            tag = CMD_TAGS[self._next_tag]
+            self._next_tag = (self._next_tag + 1) % len(CMD_TAGS)
+            if tag not in self._commands_waiting:
+                return tag
+
+
+    # Store latency of the command (time from sending it to VESNA until its response)
+    def command_latency(self, sqn, latency):
+        self.cmd_count += 1
+        self.cmd_latency_sum += latency
+        self.cmd_latency_last = latency
+        self.cmd_latency_max = max(self.cmd_latency_max, latency)
+        self.log.debug("Response on command [%s] in %.1f ms", sqn, latency * 1000)
 
-                sqn, cmd = self.queueGet()
 
-                if cmd == "LINES":
-                    resp = "Sotred lines: " + self.lines_stored
-                    self.queuePutResp(sqn, resp)
-                else:
-                    self.monitor.send_command(cmd)
-                    self._command_waiting = sqn
+    def latency_str(self):
+        if not self.cmd_count:
+            return "No command responses yet"
+        return "Command latency: last %.1f ms, avg %.1f ms, max %.1f ms (%d commands)" % (
+            self.cmd_latency_last * 1000, self.cmd_latency_sum / self.cmd_count * 1000,
+            self.cmd_latency_max * 1000, self.cmd_count)
 
 
     # ----------------------------------------------------------------------------------------
@@ -187,6 +417,9 @@ class serial_monitor_thread(threading.Thread):
     # ----------------------------------------------------------------------------------------
     def stop(self):
         self._is_thread_running = False
+        # Wake up the thread if it is sleeping in select()
+        if hasattr(self.in_q, "wakeup"):
+            self.in_q.wakeup()
         self.monitor.send_command("STOP")
         self.f.store_lgtc_line("Application exit!")
         self.log.info("Stopping serial monitor thread")
@@ -215,7 +448,7 @@ class serial_monitor_thread(threading.Thread):
     # -------------------------------------------------------------------------------------
     # Connect to VESNA serial port
     def VESNA_connect(self):
-        if not self.monitor.connect_to("ttyS2"):
+        if not self.monitor.connect_to(self.port):
             self.f.error("Couldn't connect to VESNA.")
             self.queuePutState("VESNA_ERR")
             self.log.error("Couldn't connect to VESNA.")
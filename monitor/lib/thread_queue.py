@@ -0,0 +1,174 @@
+# ----------------------------------------------------------------------
+# THREAD QUEUE: Queues for communication between ECMS threads
+# ----------------------------------------------------------------------
+import os
+from queue import Queue, Full
+from time import monotonic
+
+
+# ----------------------------------------------------------------------
+# Queue with a wakeup file descriptor. Every put() writes a byte into a
+# pipe, so the consumer thread can block in select/poll on fileno()
+# together with other descriptors (serial port, sockets) instead of
+# polling queue.empty() in a loop.
+# ----------------------------------------------------------------------
+class wakeup_queue(Queue):
+
+    def __init__(self, maxsize=0):
+        Queue.__init__(self, maxsize)
+
+        self._rfd, self._wfd = os.pipe()
+        os.set_blocking(self._rfd, False)
+        os.set_blocking(self._wfd, False)
+
+    def _put(self, item):
+        Queue._put(self, item)
+        self.wakeup()
+
+    # File descriptor which becomes readable when something is put in the queue
+    def fileno(self):
+        return self._rfd
+
+    # Wake up the consumer without putting anything in the queue
+    def wakeup(self):
+        try:
+            os.write(self._wfd, b"\0")
+        except BlockingIOError:
+            # Pipe is full - consumer has plenty of wakeups pending
+            pass
+
+    # Consumer must call this after it was woken up and before it checks the queue
+    def clear_wakeup(self):
+        try:
+            while os.read(self._rfd, 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def close(self):
+        os.close(self._rfd)
+        os.close(self._wfd)
+
+
+# ----------------------------------------------------------------------
+# Bounded queue with a policy per message class. Messages are lists
+# [type, data] as used between ECMS threads - message class is its type
+# ("STATE", "INFO", ...), all other types (SQNs) use the default policy.
+#
+# Policies when the queue is full (or when message comes in):
+#   POLICY_BLOCK       - wait until there is space in the queue
+#   POLICY_DROP_OLDEST - drop the oldest message of the same class
+#   POLICY_COALESCE    - message replaces pending message of the same
+#                        class, so only the latest one is delivered
+#                        (e.g. STATE updates)
+#
+# Messages of other classes are never dropped to make space. If no
+# message of the same class is queued, the default policy decides: with
+# POLICY_BLOCK the put waits for space, otherwise the new message itself
+# is dropped (and counted in drops).
+# ----------------------------------------------------------------------
+POLICY_BLOCK = "block"
+POLICY_DROP_OLDEST = "drop_oldest"
+POLICY_COALESCE = "coalesce"
+
+
+class bounded_queue(wakeup_queue):
+
+    def __init__(self, maxsize, policies=None, default_policy=POLICY_BLOCK):
+        wakeup_queue.__init__(self, maxsize)
+
+        self.policies = policies or {}
+        self.default_policy = default_policy
+
+        # Statistics
+        self.high_water = 0         # Max number of messages in the queue
+        self.drops = {}             # Dropped messages per class
+        self.coalesced = 0          # Messages replaced by newer ones
+        self.blocked = 0            # Number of puts that had to wait for space
+
+
+    def put(self, item, block=True, timeout=None):
+        mtype = item[0]
+        policy = self.policies.get(mtype, self.default_policy)
+
+        with self.not_full:
+
+            if policy == POLICY_COALESCE and self._replace(item):
+                self.coalesced += 1
+                self.not_empty.notify()
+                self.wakeup()
+                return
+
+            if 0 < self.maxsize <= self._qsize():
+                if policy == POLICY_BLOCK:
+                    self._wait_space(block, timeout)
+                elif not self._drop_oldest(mtype):
+                    if self.default_policy == POLICY_BLOCK:
+                        self._wait_space(block, timeout)
+                    else:
+                        self.drops[mtype] = self.drops.get(mtype, 0) + 1
+                        return
+
+            self._put(item)
+            self.unfinished_tasks += 1
+            self.high_water = max(self.high_water, self._qsize())
+            self.not_empty.notify()
+
+
+    # Replace pending message of the same class with the new one (new goes to the end)
+    def _replace(self, item):
+        for i, old in enumerate(self.queue):
+            if old[0] == item[0]:
+                del self.queue[i]
+                self.queue.append(item)
+                return True
+        return False
+
+
+    # Messages of the same class - same type, or both without their own policy
+    def _same_class(self, a, b):
+        return a == b or (a not in self.policies and b not in self.policies)
+
+    # Drop the oldest message of the same class
+    #
+    #   @return:    False if there is none
+    def _drop_oldest(self, mtype):
+        for i, old in enumerate(self.queue):
+            if self._same_class(old[0], mtype):
+                del self.queue[i]
+                break
+        else:
+            return False
+
+        self.drops[old[0]] = self.drops.get(old[0], 0) + 1
+        # Dropped message will never be processed
+        self.unfinished_tasks -= 1
+        return True
+
+
+    # Same as waiting in Queue.put()
+    def _wait_space(self, block, timeout):
+        self.blocked += 1
+
+        if not block:
+            raise Full
+        elif timeout is None:
+            while self._qsize() >= self.maxsize:
+                self.not_full.wait()
+        elif timeout < 0:
+            raise ValueError("'timeout' must be a non-negative number")
+        else:
+            endtime = monotonic() + timeout
+            while self._qsize() >= self.maxsize:
+                remaining = endtime - monotonic()
+                if remaining <= 0.0:
+                    raise Full
+                self.not_full.wait(remaining)
+
+
+    # Queue statistics as a string (for the user console)
+    def stats(self):
+        with self.mutex:
+            drops = ", ".join("%s %d" % (k, v) for k, v in sorted(self.drops.items()))
+            return "size %d/%d, high water %d, drops [%s], coalesced %d, blocked %d" % (
+                self._qsize(), self.maxsize, self.high_water, drops, self.coalesced, self.blocked)
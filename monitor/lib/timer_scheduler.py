@@ -0,0 +1,98 @@
+# ----------------------------------------------------------------------
+# TIMER SCHEDULER: One-shot and periodic deadlines for ECMS loops
+# ----------------------------------------------------------------------
+# Deadlines are kept in a heap keyed on time.monotonic(). The loop calls
+# run_due() every time it wakes up - it executes all expired timers and
+# returns the time until the next deadline, so the loop can block in
+# select/poll exactly that long.
+#
+# Scheduler is not thread safe - use it only from the thread that owns it.
+# ----------------------------------------------------------------------
+import heapq
+import itertools
+from time import monotonic
+
+
+class timer_handle():
+
+    def __init__(self, deadline, interval, callback, args):
+        self.deadline = deadline
+        self.interval = interval
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class timer_scheduler():
+
+    def __init__(self):
+        self._heap = []
+        self._cnt = itertools.count()   # Keeps timers with same deadline in FIFO order
+
+    def _push(self, handle):
+        heapq.heappush(self._heap, (handle.deadline, next(self._cnt), handle))
+        return handle
+
+    # ------------------------------------------------------------------
+    # Call callback(*args) once after delay seconds
+    #
+    #   @return:    handle which can be used to cancel the timer
+    # ------------------------------------------------------------------
+    def call_later(self, delay, callback, *args):
+        return self._push(timer_handle(monotonic() + delay, None, callback, args))
+
+    # ------------------------------------------------------------------
+    # Call callback(*args) every interval seconds (first call after one interval)
+    #
+    #   @return:    handle which can be used to cancel the timer
+    # ------------------------------------------------------------------
+    def call_every(self, interval, callback, *args):
+        return self._push(timer_handle(monotonic() + interval, interval, callback, args))
+
+    def cancel(self, handle):
+        handle.cancel()
+
+    # ------------------------------------------------------------------
+    # Run all timers with expired deadline
+    #
+    #   @return:    seconds until next deadline (0 or more)
+    #               None if there are no timers
+    # ------------------------------------------------------------------
+    def run_due(self):
+        now = monotonic()
+
+        while self._heap:
+            deadline, cnt, handle = self._heap[0]
+
+            if handle.cancelled:
+                heapq.heappop(self._heap)
+                continue
+
+            if deadline > now:
+                return deadline - now
+
+            heapq.heappop(self._heap)
+
+            # Periodic timers keep their phase; if we fell behind, skip missed periods
+            if handle.interval is not None:
+                handle.deadline += handle.interval
+                if handle.deadline <= now:
+                    handle.deadline = now + handle.interval
+                self._push(handle)
+
+            handle.callback(*handle.args)
+            now = monotonic()
+
+        return None
+
+    # Seconds until next deadline without running anything (None if there are no timers)
+    def next_timeout(self):
+        while self._heap and self._heap[0][2].cancelled:
+            heapq.heappop(self._heap)
+
+        if not self._heap:
+            return None
+        return max(0, self._heap[0][0] - monotonic())
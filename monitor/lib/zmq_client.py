@@ -1,16 +1,93 @@
 import time
 import zmq
+import heapq
+import random
 import logging
+import itertools
 import sys
+from zmq.utils.monitor import parse_monitor_message
+from collections import deque, OrderedDict
 from datetime import datetime as timer
 #from timeit import default_timer as timer #TODO test if better
 
 LOG_LEVEL = logging.DEBUG
 
+# Messages whose ACK carries controller timestamps: "<type> <t1 received> <t2 sent>"
+CLOCK_SYNC_TYPES = ("SYNC", "TSYNC")
+CLOCK_SAMPLES = 8       # Offset is taken from the sample with the shortest RTT among last N
+
+# Retransmission of messages without ACK - timeout doubles with every retry (+- jitter)
+ACK_TIMEOUT = 3         # In seconds - first timeout
+ACK_TIMEOUT_MAX = 30    # In seconds
+ACK_JITTER = 0.2        # Timeout is randomly changed for up to 20 %
+ACK_RETRIES = 3         # Number of retransmissions before message is dropped
+
+# Messages sent with transmit_async get a sequence number and the broker acknowledges them
+# with cumulative ACKs [CACK, <n>] - all messages up to n were received. At most SEND_WINDOW
+# messages are waiting for ACK, the rest wait in a backlog.
+SEND_WINDOW = 16
+CUMULATIVE_ACK = "CACK"
+
+# Optional batching of messages sent with transmit_async - messages are collected for up to
+# BATCH_LINGER seconds (or BATCH_MAX messages) and sent as one multipart message
+#   [BATCH, <number>, <data>, <seq low>, <number>, <data>, <seq low>, ...]
+# Newer STATE replaces the STATE which is still waiting in the batch.
+BATCH = "BATCH"
+BATCH_LINGER = 0.005    # In seconds
+BATCH_MAX = 16
+
+# Commands from the publish socket start with a topic and node receives only the topics it
+# subscribed to (libzmq filters them already on the controller):
+#   All <number> <data>                 all nodes
+#   Cluster:<name> <number> <data>      nodes in Ansible inventory group <name> (e.g. SRDA)
+#   Tech:<name> <number> <data>         nodes with given radio technology (e.g. ble)
+TOPIC_ALL = "All"
+TOPIC_CLUSTER = "Cluster:"
+TOPIC_TECH = "Tech:"
+
+# ZMTP heartbeats on both sockets - connection is closed if the controller doesn't answer a
+# PING in HEARTBEAT_TIMEOUT (dead or unreachable controller is noticed without sending
+# anything) and libzmq reconnects every RECONNECT_IVL, up to RECONNECT_IVL_MAX.
+HEARTBEAT_IVL = 500         # In ms
+HEARTBEAT_TIMEOUT = 2000    # In ms
+RECONNECT_IVL = 500         # In ms
+RECONNECT_IVL_MAX = 5000    # In ms
+
+# Connection to the controller (DEALER socket), followed with a socket monitor:
+#   CONNECTING --> CONNECTED <--> DISCONNECTED,  any --> CLOSED (close())
+# While disconnected, messages sent with transmit_async wait in the backlog and messages
+# waiting for ACK are not resent (nor dropped). After reconnect, client sends
+# [SYNC, RECONNECT] (controller keeps our sequence numbers and adds us to its database if it
+# was restarted) and sends all messages without ACK again, in order.
+CONNECTING = "CONNECTING"
+CONNECTED = "CONNECTED"
+DISCONNECTED = "DISCONNECTED"
+CLOSED = "CLOSED"
+RECONNECT = "RECONNECT"
+CLOSE_LINGER = 1000         # In ms - how long close() waits for messages not sent yet
+
+
+# Message sent with transmit_async, waiting for ACK
+class pending_msg():
+
+    __slots__ = ("msg", "seq", "sent", "deadline", "retries", "acked")
+
+    def __init__(self, msg, seq, sent, deadline):
+        self.msg = msg
+        self.seq = seq
+        self.sent = sent            # Time of the first transmission
+        self.deadline = deadline    # Time of the next retransmission
+        self.retries = 0
+        self.acked = False
+
+
 class zmq_client():
 
     
-    ACK_TIMEOUT = 3
+    ACK_TIMEOUT = ACK_TIMEOUT
+
+    # Subclasses may use another context (zmq.asyncio.Context in zmq_client_async)
+    context_class = zmq.Context
 
     rxCnt = 0
     txCnt = 0
@@ -19,57 +96,107 @@ class zmq_client():
     # Initialize sockets and poller
     #
     # ----------------------------------------------------------------------------------------
-    def __init__(self, SUBS_HOSTNAME, ROUT_HOSTNAME, deviceID="NoName"):
+    def __init__(self, SUBS_HOSTNAME, ROUT_HOSTNAME, deviceID="NoName", window=SEND_WINDOW, batching=False,
+                 topics=()):
 
         self.log = logging.getLogger(__name__)
         self.log.setLevel(LOG_LEVEL)
 
-        context = zmq.Context()
+        self.context = self.context_class()
 
         # Get device address
         device_address = deviceID.encode("ascii")
 
         # Connect to subscribe socket (--> publish)
         self.log.debug("Connecting to publish socket...")
-        self.subscriber = context.socket(zmq.SUB)
+        self.subscriber = self.context.socket(zmq.SUB)
+        self._set_heartbeat(self.subscriber)
         self.subscriber.connect(SUBS_HOSTNAME)
-        self.subscriber.setsockopt(zmq.SUBSCRIBE, b'')  #TODO
+        self.topics = set()
+        for topic in (TOPIC_ALL,) + tuple(topics):
+            self.subscribe(topic)
 
         # Connect to dealer socket (--> router)
         self.log.debug("Connecting to router socket...")
-        self.dealer = context.socket(zmq.DEALER)
+        self.dealer = self.context.socket(zmq.DEALER)
         self.dealer.identity = device_address
+        self._set_heartbeat(self.dealer)
+        # Follow the connection to the controller
+        self.monitor = self.dealer.get_monitor_socket(zmq.EVENT_CONNECTED | zmq.EVENT_DISCONNECTED)
         self.dealer.connect(ROUT_HOSTNAME)
 
         # Configure poller
         self.poller = zmq.Poller()
         self.poller.register(self.subscriber, zmq.POLLIN)
         self.poller.register(self.dealer, zmq.POLLIN)
-
-        # Class variables ... they are storing:
-        self.waitingForAck = []             # Buffer - a list with sequence number of messages that must receive an ACK
-        self.lastSentInfo = []              # The last sent message
-        self.nbrRetries = 0                 # A number of sending retries 
-        #self.lastSentTime = timer.now()    # The last time we sent any message (it must be a type: datetime.datetime)
+        self.poller.register(self.monitor, zmq.POLLIN)
+
+        # Connection state
+        self.connection = CONNECTING
+        self.synced = False                 # Controller acknowledged our SYNC (in this connection)
+        self.reconnected = False            # Set after reconnect (user clears it)
+        self.disconnects = 0
+
+        # Messages waiting for ACK: {seq : pending_msg} in order of sending
+        self.waitingForAck = OrderedDict()
+        self.window = max(1, window)
+        self._backlog = deque()             # Messages waiting for space in the window
+        self._next_seq = 1
+        # Messages waiting to be sent in one batch (with batching enabled)
+        self.batching = batching
+        self._batch = []
+        self._batch_deadline = None
+        # Retransmission deadlines - heap of (deadline, cnt, pending_msg), acked ones are skipped
+        self._retry_heap = []
+        self._retry_cnt = itertools.count()
+
+        # ACK statistics
+        self.acks = 0
+        self.retransmits = 0
+        self.ack_failed = 0                 # Messages dropped after ACK_RETRIES retransmissions
+        self.ack_rtt_last = 0
+        self.ack_rtt_sum = 0
+        self.ack_rtt_max = 0
+        self.ack_rtt_cnt = 0                # RTT is measured only on messages sent once
+        self.batches = 0
+        self.coalesced = 0
+
+        # Clock offset to the controller (NTP-style estimate from SYNC/TSYNC timestamps)
+        self.clock_offset = None            # Node clock - controller clock (in seconds)
+        self.clock_rtt = None               # Round trip time of the sample used for the offset
+        self.clock_updated = False          # Set when new sample arrived (user clears it)
+        self._clock_samples = deque(maxlen=CLOCK_SAMPLES)
+        self._clock_sent = {}               # {message type : time sent}
 
 
     # ----------------------------------------------------------------------------------------
     # Send a message to the broker via DEALER socket
     # 
     #   @params:    message made with list of strings: [number, data]
+    #               seq - sequence number (only for messages sent with transmit_async)
     #   @return:    True if success
     # ----------------------------------------------------------------------------------------
-    def transmit(self, msg):
+    def transmit(self, msg, seq=None):
 
         if not isinstance(msg, list):
             self.log.error("transmit: Incorect format of message")
             return False
     
+        # Remember when clock sync request was sent (ACK will carry controller timestamps)
+        if msg[0] in CLOCK_SYNC_TYPES:
+            self._clock_sent[msg[0]] = time.time()
+
         # Encode the message from string to bytes
         msg = [msg[0].encode(), msg[1].encode()]
+
+        # Sequence number and the lowest one still waiting for ACK (broker doesn't have to
+        # wait for lower ones anymore - they were dropped)
+        if seq is not None:
+            low = next(iter(self.waitingForAck), seq)
+            msg.append(b"%d %d" % (seq, low))
         
         self.log.debug("Sending data to broker...")
-        self.dealer.send_multipart(msg)
+        self._send(msg)
         
         self.txCnt += 1
         return True
@@ -77,25 +204,131 @@ class zmq_client():
 
     # ----------------------------------------------------------------------------------------
     # Send a message to the broker via DEALER socket (same as transmit)
-    # But also put message number in ack queue
+    # But also give it a sequence number and wait for ACK on it. If there are already window
+    # messages waiting for ACK, message is sent when ACKs come.
     #
     #   @params:    message made with list of strings: [number, data]
     # ----------------------------------------------------------------------------------------
     def transmit_async(self, msg):
-  
-        if not self.transmit(msg):
+
+        if not isinstance(msg, list):
+            self.log.error("transmit_async: Incorect format of message")
+            return
+
+        # Messages must not overtake the ones in the backlog
+        if self._backlog or len(self.waitingForAck) + len(self._batch) >= self.window:
+            if not self._backlog:
+                self.log.warning("Send window full - broker didn't ack our previous messages!")
+            self._backlog.append(msg)
+            return
+
+        # Wait for the connection
+        if self.connection != CONNECTED:
+            self._backlog.append(msg)
+            return
+
+        if not self.batching:
+            self.transmit(msg, self._register(msg))
+            return
+
+        # Only the latest state matters
+        if msg[0] == "STATE":
+            for i, m in enumerate(self._batch):
+                if m[0] == "STATE":
+                    del self._batch[i]
+                    self.coalesced += 1
+                    break
+
+        if not self._batch:
+            self._batch_deadline = time.monotonic() + BATCH_LINGER
+        self._batch.append(msg)
+
+        if len(self._batch) >= BATCH_MAX:
+            self.flush_batch()
+
+
+    # Give message a sequence number and put it among messages waiting for ACK
+    def _register(self, msg):
+        seq = self._next_seq
+        self._next_seq += 1
+
+        now = time.monotonic()
+        p = pending_msg(msg, seq, now, now + self.retry_timeout(0))
+        self.waitingForAck[seq] = p
+        heapq.heappush(self._retry_heap, (p.deadline, next(self._retry_cnt), p))
+        return seq
+
+
+    # Send messages from the backlog while there is space in the window
+    def _fill_window(self):
+        if not self._backlog or self.connection != CONNECTED:
             return
 
-        # Broker sent another command before sending ACK to our previous message
-        if len(self.waitingForAck) > 1:
-            self.log.warning("New message sent but broker didn't ack our previous one!")
-            # TODO: stop receiveing messages after 3 already in queue?
+        # Messages in the batch are older than the ones in the backlog
+        msgs = [(msg, self._register(msg)) for msg in self._batch]
+        self._batch = []
+        self._batch_deadline = None
+
+        while self._backlog and len(self.waitingForAck) < self.window:
+            msg = self._backlog.popleft()
+            msgs.append((msg, self._register(msg)))
+
+        if self.batching:
+            self._transmit_batch(msgs)
+        else:
+            for msg, seq in msgs:
+                self.transmit(msg, seq)
+
+
+    # ----------------------------------------------------------------------------------------
+    # Send messages waiting in the batch (call it when flush_due() says so)
+    # ----------------------------------------------------------------------------------------
+    def flush_batch(self):
+        msgs = [(msg, self._register(msg)) for msg in self._batch]
+        self._batch = []
+        self._batch_deadline = None
+        self._transmit_batch(msgs)
+
+    # Send the batch if its linger time has passed
+    #
+    #   @return:    seconds until the batch must be sent (None if there is no batch)
+    def flush_due(self):
+        if not self._batch:
+            return None
+        timeout = self._batch_deadline - time.monotonic()
+        if timeout <= 0:
+            self.flush_batch()
+            return None
+        return timeout
+
+    def _transmit_batch(self, msgs):
+        if len(msgs) == 1:
+            self.transmit(*msgs[0])
+        elif msgs:
+            low = b" %d" % next(iter(self.waitingForAck))
+            frames = [BATCH.encode()]
+            for msg, seq in msgs:
+                frames += [msg[0].encode(), msg[1].encode(), b"%d" % seq + low]
+            self.log.debug("Sending batch of %d messages to broker...", len(msgs))
+            self._send(frames)
+            self.txCnt += 1
+            self.batches += 1
+
+
+    # All messages to the broker go out here
+    def _send(self, frames):
+        self.dealer.send_multipart(frames)
+
 
-        self.waitingForAck.append(msg[0]) 
-        self.lastSentInfo.append(msg)
-        self.lastSentTime = timer.now()
+    # Number of messages waiting for ACK (sent, in the batch or in the backlog)
+    def ack_pending(self):
+        return len(self.waitingForAck) + len(self._batch) + len(self._backlog)
 
-        return
+
+    # Timeout before retransmission number n (exponential backoff with jitter)
+    def retry_timeout(self, n):
+        timeout = min(self.ACK_TIMEOUT * (2 ** n), ACK_TIMEOUT_MAX)
+        return timeout * random.uniform(1 - ACK_JITTER, 1 + ACK_JITTER)
 
 
     # ----------------------------------------------------------------------------------------
@@ -108,6 +341,9 @@ class zmq_client():
         
         sockets = dict(self.poller.poll(timeout))
 
+        if self.monitor in sockets:
+            self.monitor_events()
+
         if sockets.get(self.subscriber) == zmq.POLLIN:
             return "SUBSCRIBER"
         elif sockets.get(self.dealer) == zmq.POLLIN:
@@ -116,6 +352,40 @@ class zmq_client():
             return None
 
 
+    # ----------------------------------------------------------------------------------------
+    # Add file descriptor to the poller (e.g. wakeup descriptor of the queue from other
+    # thread), so wait() also returns when it becomes readable
+    # ----------------------------------------------------------------------------------------
+    def add_wakeup(self, fd):
+        self.poller.register(fd, zmq.POLLIN)
+
+
+    # ----------------------------------------------------------------------------------------
+    # Block until there is a message on any socket, wakeup descriptor is readable or timeout
+    # passes
+    #
+    #   @params:    timeout - seconds to wait (None = forever)
+    #   @return:    set of ready instances ("SUBSCRIBER", "DEALER", "WAKEUP"), connection
+    #               events are handled here
+    # ----------------------------------------------------------------------------------------
+    def wait(self, timeout=None):
+
+        if timeout is not None:
+            timeout = max(0, timeout) * 1000
+
+        ready = set()
+        for sock, event in self.poller.poll(timeout):
+            if sock is self.subscriber:
+                ready.add("SUBSCRIBER")
+            elif sock is self.dealer:
+                ready.add("DEALER")
+            elif sock is self.monitor:
+                self.monitor_events()
+            else:
+                ready.add("WAKEUP")
+        return ready
+
+
     # ----------------------------------------------------------------------------------------
     # Read received message of given instance (use with func check_input). 
     # 
@@ -128,16 +398,7 @@ class zmq_client():
         self.rxCnt += 1
 
         if (instance == "SUBSCRIBER"):
-            packet = self.subscriber.recv()
-
-            # Decode message manually
-            p = packet.split()
-            nbr = p[0].decode()
-            data = p[1].decode()
-
-            self.log.debug("Subscriber got [%s]: %s" % (nbr, data))
-
-            return nbr, data
+            return self.subscriber_msg(self.subscriber.recv())
 
         elif (instance == "DEALER"):
             nbr, data = self.dealer.recv_multipart()
@@ -145,7 +406,7 @@ class zmq_client():
             # Decode message from bytes to string
             msg = [nbr.decode(), data.decode()]
 
-            self.log.debug("Dealer got [%s]: %s" % (msg[0], msg[1]))
+            self.log.debug("Dealer got [%s]: %s", msg[0], msg[1])
 
             return msg
         else:
@@ -168,48 +429,11 @@ class zmq_client():
 
         # If it is a message from publish socket
         if (instance == "SUBSCRIBER"):
-            packet = self.subscriber.recv()
-
-            p = packet.split()
-            sqn = p[0].decode()
-            data = p[1].decode()
-
-            self.log.debug("aSubscriber got [%s]: %s" % (sqn, data))
-
-            return sqn, data
+            return self.subscriber_msg(self.subscriber.recv())
 
         # If it is a message from router socket
         elif (instance == "DEALER"):
-            sqn, msg = self.dealer.recv_multipart()
-
-            # Decode the message from bytes to string
-            sqn = sqn.decode()
-            msg = msg.decode()
-
-            # If we got acknowledge on transmitted data, message stores SQN of acknowledged response
-            if sqn == "ACK":
-                if msg in self.waitingForAck:
-                    self.log.debug("Broker acknowledged our data [" + msg + "]")
-                    self.nbrRetries = 0
-
-                    # Delete messages waiting in queue with number in msg
-                    self.waitingForAck.remove(msg)
-                    i = 0
-                    for info in self.lastSentInfo:
-                        if info[0] == msg:
-                            del self.lastSentInfo[i]
-                        i += 1
-                else:
-                    self.log.warning("Got ACK for msg %s but in queue we have:" % msg)
-                    self.log.warning(self.waitingForAck)
-                    self.nbrRetries = 0
-
-                return None, True
-
-            # If we received any unicast command
-            else:
-                self.log.debug("aDealer got [%s]: %s" % (sqn ,msg))
-                return sqn, msg
+            return self.dealer_msg(self.dealer.recv_multipart())
 
         # If there is an error in calling the function
         else:
@@ -217,39 +441,130 @@ class zmq_client():
             return None, None
 
 
+    # Decode message from publish socket: b"<topic> <sqn> <data>"
+    def subscriber_msg(self, packet):
+
+        topic, sqn, data = packet.decode().split(" ", 2)
+
+        self.log.debug("Subscriber got [%s] on %s: %s", sqn, topic, data)
+
+        return sqn, data
+
+
+    # Decode message from router socket and handle it if it is an ACK
+    def dealer_msg(self, frames):
+
+        # Decode the message from bytes to string
+        sqn = frames[0].decode()
+        msg = frames[1].decode()
+
+        # Cumulative acknowledge - message stores the highest acknowledged sequence number
+        if sqn == CUMULATIVE_ACK:
+            self.ack_received(msg)
+            return None, True
+
+        # Acknowledge on message sent with transmit (clock sync ACK carries timestamps)
+        if sqn == "ACK":
+            self.handle_ack(msg)
+            return None, True
+
+        # If we received any unicast command
+        else:
+            self.log.debug("aDealer got [%s]: %s", sqn, msg)
+            return sqn, msg
+
+
     # ----------------------------------------------------------------------------------------
-    # Check how long we waited for ACK on sent package. If ACK_TIMEOUT seconds have passed,
-    # send message again. Should be called periodically, whenever LGTC has some spare time.
+    # Remove all messages up to the acknowledged sequence number from messages waiting for
+    # ACK and send messages from the backlog
+    #
+    #   @params:    ack - data of cumulative ACK: "<highest acknowledged seq>"
+    # ----------------------------------------------------------------------------------------
+    def ack_received(self, ack):
+
+        try:
+            ack = int(ack)
+        except ValueError:
+            self.log.warning("Bad cumulative ACK: %s", ack)
+            return
+
+        now = time.monotonic()
+        n = 0
+        while self.waitingForAck:
+            seq = next(iter(self.waitingForAck))
+            if seq > ack:
+                break
+            p = self.waitingForAck.pop(seq)
+            p.acked = True
+            n += 1
+
+            # RTT of retransmitted message is ambiguous (which transmission was acked?)
+            if p.retries == 0:
+                rtt = now - p.sent
+                self.ack_rtt_last = rtt
+                self.ack_rtt_sum += rtt
+                self.ack_rtt_max = max(self.ack_rtt_max, rtt)
+                self.ack_rtt_cnt += 1
+
+        self.acks += n
+        self.log.debug("Broker acknowledged %d message(s) up to [%d]", n, ack)
+
+        self._fill_window()
+
+
+    # ----------------------------------------------------------------------------------------
+    # Retransmit messages whose ACK deadline has passed. Every message has its own deadline,
+    # timeout doubles with every retransmission; after ACK_RETRIES retransmissions message
+    # is dropped. Should be called periodically, whenever LGTC has some spare time.
+    # While disconnected, nothing is resent - messages are sent again after reconnect.
     # 
-    #   @params:    / (everything is stored in class variables)
+    #   @return:    seconds until the next deadline (None if no message is waiting for ACK or
+    #               if controller is not connected)
     # ----------------------------------------------------------------------------------------
     def send_retry(self):
 
-        if ((timer.now() - self.lastSentTime).total_seconds() > self.ACK_TIMEOUT):
-            self.log.warning("3 second have passed and no response from broker.. Resending data!")
+        if self.connection != CONNECTED:
+            return None
 
-            # Resend info with lowest number...Example:
-            # waitingForAck = [15, 16, 17]
-            # lastSentInfo = [[15, START], [16, STOP], [17, START]]
+        now = time.monotonic()
+        heap = self._retry_heap
 
-            oldest = self.waitingForAck[0]
+        while heap and (heap[0][2].acked or heap[0][0] <= now):
+            deadline, cnt, p = heapq.heappop(heap)
+            if p.acked:
+                continue
 
-            for info in self.lastSentInfo:
-                if info[0] == oldest:
-                    self.transmit(info)
-                    self.lastSentTime = timer.now()
-                    break
+            if p.retries >= ACK_RETRIES:
+                # Broker has died ?
+                self.log.warning("No ACK on message [%s] after %d retransmissions - dropping it", p.msg[0], p.retries)
+                del self.waitingForAck[p.seq]
+                p.acked = True
+                self.ack_failed += 1
+                continue
 
-            self.nbrRetries += 1
-            if self.nbrRetries > 1:
-                # Server has died ?
-                self.waitingForAck = []
-                self.lastSentInfo = []
-                self.nbrRetries = 0
-                self.log.warning("Broker has died :(")
-                #TODO clean the resources (zmq.close)
-        else:
-            return
+            self.log.warning("No ACK on message [%s] from broker.. Resending data!", p.msg[0])
+            self.transmit(p.msg, p.seq)
+            p.retries += 1
+            p.deadline = now + self.retry_timeout(p.retries)
+            self.retransmits += 1
+            heapq.heappush(heap, (p.deadline, next(self._retry_cnt), p))
+
+        self._fill_window()
+
+        if heap:
+            return max(0, heap[0][0] - now)
+        return None
+
+
+    def ack_stats(self):
+        avg = self.ack_rtt_sum / self.ack_rtt_cnt * 1000 if self.ack_rtt_cnt else 0
+        resp = "ACK: %d waiting, %d acked, %d retransmits, %d dropped, RTT last %.1f ms, avg %.1f ms, max %.1f ms" % (
+            self.ack_pending(), self.acks, self.retransmits, self.ack_failed,
+            self.ack_rtt_last * 1000, avg, self.ack_rtt_max * 1000)
+        resp += ", %s (%d disconnects)" % (self.connection, self.disconnects)
+        if self.batching:
+            resp += ", %d batches, %d STATE coalesced" % (self.batches, self.coalesced)
+        return resp
 
 
     # ----------------------------------------------------------------------------------------
@@ -275,17 +590,172 @@ class zmq_client():
 
                     rec = self.receive(inp)     # rec = ["ACK", sqn]
                     # Nbr of transmitted and received msg must be the same
-                    if(rec[0] == "ACK" and rec[1] == sqn):
+                    if rec[0] == "ACK" and self.handle_ack(rec[1]) == sqn:
                         return True
+                    # ACK on messages sent with transmit_async
+                    elif rec[0] == CUMULATIVE_ACK:
+                        self.ack_received(rec[1])
                     else:
-                        self.log.warning("Received: " + rec[0] + " message but waiting for ACK")
+                        self.log.warning("Received: %s message but waiting for ACK", rec[0])
             else:
                 return False
 
 
 
+    # ----------------------------------------------------------------------------------------
+    # Get SQN from ACK message. If ACK carries controller timestamps (SYNC, TSYNC), use them
+    # for a new clock offset sample.
+    #
+    #   @params:    msg - data of ACK message: "<sqn>" or "<sqn> <t1> <t2>"
+    #   @return:    sqn of acknowledged message
+    # ----------------------------------------------------------------------------------------
+    def handle_ack(self, msg):
+        p = msg.split()
+        if p and p[0] == "SYNC":
+            self.synced = True
+        if len(p) == 3 and p[0] in self._clock_sent:
+            try:
+                self.clock_sample(self._clock_sent.pop(p[0]), float(p[1]), float(p[2]), time.time())
+            except ValueError:
+                self.log.warning("Bad timestamps in ACK: %s", msg)
+        return p[0] if p else msg
+
+
+    # ----------------------------------------------------------------------------------------
+    # New clock offset sample (NTP):
+    #   t0 - node sent request, t1 - controller received it,
+    #   t2 - controller sent ACK, t3 - node received ACK
+    # ----------------------------------------------------------------------------------------
+    def clock_sample(self, t0, t1, t2, t3):
+        rtt = (t3 - t0) - (t2 - t1)
+        offset = ((t0 - t1) + (t3 - t2)) / 2
+
+        self._clock_samples.append((rtt, offset))
+        self.clock_rtt, self.clock_offset = min(self._clock_samples)
+        self.clock_updated = True
+
+        self.log.debug("Clock sample: offset %.6f s, RTT %.6f s", offset, rtt)
+
+
+
+    # ----------------------------------------------------------------------------------------
+    # TOPICS
+    # Receive commands published to the topic (TOPIC_ALL, TOPIC_CLUSTER + name, TOPIC_TECH +
+    # name). Topic is followed by space in the message, so "Cluster:SRD" doesn't match
+    # "Cluster:SRDA".
+    # ----------------------------------------------------------------------------------------
+    def subscribe(self, topic):
+        if topic not in self.topics:
+            self.subscriber.setsockopt(zmq.SUBSCRIBE, topic.encode() + b" ")
+            self.topics.add(topic)
+            self.log.debug("Subscribed to %s", topic)
+
+    def unsubscribe(self, topic):
+        if topic in self.topics:
+            self.subscriber.setsockopt(zmq.UNSUBSCRIBE, topic.encode() + b" ")
+            self.topics.discard(topic)
+
+
+    # ----------------------------------------------------------------------------------------
+    # CONNECTION
+    # ----------------------------------------------------------------------------------------
+    def _set_heartbeat(self, sock):
+        sock.setsockopt(zmq.HEARTBEAT_IVL, HEARTBEAT_IVL)
+        sock.setsockopt(zmq.HEARTBEAT_TIMEOUT, HEARTBEAT_TIMEOUT)
+        sock.setsockopt(zmq.HEARTBEAT_TTL, HEARTBEAT_TIMEOUT)
+        sock.setsockopt(zmq.RECONNECT_IVL, RECONNECT_IVL)
+        sock.setsockopt(zmq.RECONNECT_IVL_MAX, RECONNECT_IVL_MAX)
+
+    def connected(self):
+        return self.connection == CONNECTED
+
+    # Handle all events waiting on the monitor socket
+    def monitor_events(self):
+        while self.monitor.poll(0):
+            self.monitor_event(self.monitor.recv_multipart())
+
+    # ----------------------------------------------------------------------------------------
+    # Connection state machine - event from the monitor socket of the dealer
+    # ----------------------------------------------------------------------------------------
+    def monitor_event(self, frames):
+
+        event = parse_monitor_message(frames)["event"]
+
+        if event == zmq.EVENT_DISCONNECTED and self.connection == CONNECTED:
+            self.connection = DISCONNECTED
+            self.synced = False
+            self.disconnects += 1
+            self.log.warning("Lost connection to the controller - %d message(s) waiting for ACK",
+                             self.ack_pending())
+
+        elif event == zmq.EVENT_CONNECTED and self.connection in (CONNECTING, DISCONNECTED):
+            first = self.connection == CONNECTING
+            self.connection = CONNECTED
+            if first:
+                self.log.info("Connected to the controller")
+                self._fill_window()
+            else:
+                self.resync()
+
+
+    # ----------------------------------------------------------------------------------------
+    # After reconnect - sync with the controller again and send all messages without ACK in
+    # the same order, with new deadlines (messages in the batch and backlog follow them)
+    # ----------------------------------------------------------------------------------------
+    def resync(self):
+
+        self.log.info("Reconnected to the controller - replaying %d message(s)", len(self.waitingForAck))
+        self.transmit(["SYNC", RECONNECT])
+
+        now = time.monotonic()
+        for p in self.waitingForAck.values():
+            p.sent = now
+            p.retries = 0
+            p.deadline = now + self.retry_timeout(0)
+            self.transmit(p.msg, p.seq)
+
+        # Old deadlines are no longer valid
+        self._retry_heap = [(p.deadline, next(self._retry_cnt), p) for p in self.waitingForAck.values()]
+        heapq.heapify(self._retry_heap)
+
+        self._fill_window()
+        self.reconnected = True
+
+
+    # ----------------------------------------------------------------------------------------
+    # Close sockets and terminate the context. Messages still waiting for ACK are lost.
+    #
+    #   @params:    linger - ms to wait for messages that were not sent yet
+    # ----------------------------------------------------------------------------------------
+    def close(self, linger=CLOSE_LINGER):
+
+        if self.connection == CLOSED:
+            return
+
+        if self.ack_pending():
+            self.log.warning("Closing client with %d message(s) waiting for ACK", self.ack_pending())
+
+        self.dealer.disable_monitor()
+        self.monitor.close(linger=0)
+        self.subscriber.close(linger=linger)
+        self.dealer.close(linger=linger)
+        self.context.term()
+
+        self.connection = CLOSED
+
+
+
+
+# ----------------------------------------------------------------------------------------
+# Topics of a node: its clusters (Ansible inventory groups) and radio technology
+# ----------------------------------------------------------------------------------------
+def node_topics(clusters=(), technology=None):
+    topics = [TOPIC_CLUSTER + c for c in clusters if c]
+    if technology:
+        topics.append(TOPIC_TECH + technology)
+    return topics
 
 
 
 # TODO: Demo usage?
-# if __name__ == "__main__":
\ No newline at end of file
+# if __name__ == "__main__":
@@ -0,0 +1,264 @@
+# ----------------------------------------------------------------------
+# ZMQ CLIENT ASYNC: asyncio variant of zmq_client
+# ----------------------------------------------------------------------
+# Same protocol as zmq_client (sequence numbers, send window, cumulative
+# ACKs, retransmissions, batching, clock sync) on zmq.asyncio sockets, so
+# an experiment driver can run serial I/O, ZMQ and timers on one event
+# loop - without threads and without polling the sockets.
+#
+#   client = zmq_client_async(SUBSCR_HOSTNAME, ROUTER_HOSTNAME, "LGTC66")
+#   async with client:
+#       if not await client.request(["SYNC", "SYNC"], 10):
+#           ...
+#       await client.send(["STATE", "ONLINE"])
+#       async for sqn, cmd in client.commands():
+#           ...
+#
+# While the client is started (start() or async with), these tasks run in
+# the background:
+#   * receivers - read both sockets, handle ACKs and put commands into the
+#     queue of commands()
+#   * monitor   - connection state machine (reconnect and replay)
+#   * timer     - resends messages without ACK, sends the batch when its
+#     linger time passed and sleeps until the next of these deadlines
+#
+# Use send(), request() and commands() instead of transmit_async(),
+# wait_ack() and check_input()/receive_async() of the sync client.
+#
+# Sends on zmq.asyncio sockets complete in the background. send() and
+# request() wait for their own message to be sent; failed sends from
+# the background tasks (retransmissions, batches, replay) are logged and
+# counted in send_errors.
+# ----------------------------------------------------------------------
+import asyncio
+
+import zmq
+import zmq.asyncio
+
+from lib import zmq_client
+
+
+class zmq_client_async(zmq_client.zmq_client):
+
+    context_class = zmq.asyncio.Context
+
+    def __init__(self, SUBS_HOSTNAME, ROUT_HOSTNAME, deviceID="NoName", window=zmq_client.SEND_WINDOW,
+                 batching=False, topics=()):
+
+        zmq_client.zmq_client.__init__(self, SUBS_HOSTNAME, ROUT_HOSTNAME, deviceID, window, batching, topics)
+
+        # Futures of request() waiting for ACK: {message type : [future, ...]}
+        self._requests = {}
+
+        # Created in start() - they must belong to the running event loop
+        self._commands = None       # Received commands (None - client was closed)
+        self._space = None          # Set when there is space in the send window
+        self._deadline = None       # Set when there may be a new deadline for the timer
+        self._tasks = []
+
+        self._last_send = None      # Future of the last message given to the socket
+        self.send_errors = 0
+
+
+    # ----------------------------------------------------------------------------------------
+    # Start background tasks (must be called from a coroutine)
+    # ----------------------------------------------------------------------------------------
+    def start(self):
+        if self._tasks:
+            return
+
+        self._commands = asyncio.Queue()
+        self._space = asyncio.Event()
+        self._deadline = asyncio.Event()
+        self._space.set()
+
+        self._tasks = [
+            asyncio.ensure_future(self._subscriber_loop()),
+            asyncio.ensure_future(self._dealer_loop()),
+            asyncio.ensure_future(self._monitor_loop()),
+            asyncio.ensure_future(self._timer_loop()),
+        ]
+
+
+    # ----------------------------------------------------------------------------------------
+    # Send the batch, stop background tasks, close the sockets and terminate the context.
+    # Iteration over commands() ends.
+    # ----------------------------------------------------------------------------------------
+    async def close(self, linger=zmq_client.CLOSE_LINGER):
+        if self.connection == zmq_client.CLOSED:
+            return
+
+        self.flush_batch()
+
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+        for futures in self._requests.values():
+            for fut in futures:
+                fut.cancel()
+        self._requests = {}
+
+        if self._commands is not None:
+            self._commands.put_nowait(None)
+
+        zmq_client.zmq_client.close(self, linger)
+
+    async def __aenter__(self):
+        self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+
+    # ----------------------------------------------------------------------------------------
+    # Send a message with a sequence number - broker acknowledges it with cumulative ACK and
+    # it is resent if ACK doesn't come (same as transmit_async). Waits while the send window
+    # is full.
+    #
+    #   @params:    message made with list of strings: [number, data]
+    #   @raises:    zmq.ZMQError if socket didn't take the message (it is still resent
+    #               until ACK comes)
+    # ----------------------------------------------------------------------------------------
+    async def send(self, msg):
+
+        while self._window_full():
+            self._space.clear()
+            await self._space.wait()
+
+        # Message may also stay in the batch - then there is nothing to wait for yet
+        self._last_send = None
+        self.transmit_async(msg)
+        self._deadline.set()
+
+        if self._last_send is not None:
+            await self._last_send
+
+
+    # ----------------------------------------------------------------------------------------
+    # Send a message without sequence number and wait for the ACK on its type (same as
+    # transmit followed by wait_ack, but other messages are still handled meanwhile)
+    #
+    #   @params:    message made with list of strings: [type, data]
+    #               timeout - time to wait in seconds
+    #   @return:    True when received ACK, False if timeout passes
+    # ----------------------------------------------------------------------------------------
+    async def request(self, msg, timeout=zmq_client.ACK_TIMEOUT):
+
+        fut = asyncio.get_event_loop().create_future()
+        futures = self._requests.setdefault(msg[0], [])
+        futures.append(fut)
+
+        self._last_send = None
+        if not self.transmit(msg):
+            futures.remove(fut)
+            return False
+
+        try:
+            await self._last_send
+            return await asyncio.wait_for(fut, timeout)
+        except zmq.ZMQError as e:
+            self.log.warning("Request [%s] was not sent: %s", msg[0], e)
+            return False
+        except asyncio.TimeoutError:
+            self.log.warning("No ACK on request [%s] in %s s", msg[0], timeout)
+            return False
+        finally:
+            if fut in futures:
+                futures.remove(fut)
+
+
+    # ----------------------------------------------------------------------------------------
+    # Async iterator of received commands: async for sqn, cmd in client.commands()
+    # ACKs are handled by the client and never returned.
+    # ----------------------------------------------------------------------------------------
+    async def commands(self):
+        while True:
+            cmd = await self._commands.get()
+            if cmd is None:
+                # Let other iterators end as well
+                self._commands.put_nowait(None)
+                return
+            yield cmd
+
+
+    # ----------------------------------------------------------------------------------------
+    # PROTOCOL HOOKS
+    # ----------------------------------------------------------------------------------------
+    # Socket gives a future - failed send must not end as "Future exception was never retrieved"
+    def _send(self, frames):
+        self._last_send = self.dealer.send_multipart(frames)
+        self._last_send.add_done_callback(self._send_done)
+
+    def _send_done(self, fut):
+        if fut.cancelled():
+            return
+        e = fut.exception()
+        if e is not None:
+            self.send_errors += 1
+            self.log.warning("Sending to broker failed: %s", e)
+
+    def _window_full(self):
+        return bool(self._backlog) or len(self.waitingForAck) + len(self._batch) >= self.window
+
+    # ACKs and dropped messages free the window
+    def _fill_window(self):
+        zmq_client.zmq_client._fill_window(self)
+        if self._space is not None and not self._window_full():
+            self._space.set()
+
+    # Resolve requests waiting for this ACK
+    def handle_ack(self, msg):
+        sqn = zmq_client.zmq_client.handle_ack(self, msg)
+        for fut in self._requests.pop(sqn, []):
+            if not fut.done():
+                fut.set_result(True)
+        return sqn
+
+
+    # ----------------------------------------------------------------------------------------
+    # BACKGROUND TASKS
+    # ----------------------------------------------------------------------------------------
+    async def _subscriber_loop(self):
+        while True:
+            packet = await self.subscriber.recv()
+            self.rxCnt += 1
+            try:
+                self._commands.put_nowait(self.subscriber_msg(packet))
+            except ValueError:
+                self.log.warning("Bad message from publish socket: %s", packet)
+
+    async def _dealer_loop(self):
+        while True:
+            frames = await self.dealer.recv_multipart()
+            self.rxCnt += 1
+            try:
+                sqn, msg = self.dealer_msg(frames)
+            except (IndexError, UnicodeDecodeError):
+                self.log.warning("Bad message from router socket: %s", frames)
+                continue
+            if sqn:
+                self._commands.put_nowait((sqn, msg))
+
+    async def _monitor_loop(self):
+        while True:
+            self.monitor_event(await self.monitor.recv_multipart())
+            # Replayed messages have new deadlines
+            self._deadline.set()
+
+    # Retransmissions and batches - sleep until the first deadline or until send() is called
+    async def _timer_loop(self):
+        while True:
+            self._deadline.clear()
+
+            timeout = None
+            for t in (self.send_retry(), self.flush_due()):
+                if t is not None and (timeout is None or t < timeout):
+                    timeout = t
+
+            try:
+                await asyncio.wait_for(self._deadline.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
@@ -0,0 +1,152 @@
+#!/usr/bin/python3
+
+# ----------------------------------------------------------------------------------------
+# Post-process results of a finished experiment.
+#
+# Finds all .txt and .log files collected with collect_results.yml (out/ folder), computes
+# statistics of every file in a pool of worker processes (see lib/results_stats.py) and
+# prints a summary per file and for the whole experiment.
+#
+# Results of every file are cached in <dir>/.postprocess_cache.json under the hash of the
+# file content, so when the script is run again only new or changed files are processed.
+#
+# Usage: python3 postprocess_results.py [-h] [--jobs N] [--gap S] [--no-cache] [--json FILE] [dir]
+# ----------------------------------------------------------------------------------------
+
+import os
+import sys
+import json
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+from lib import results_stats
+
+
+DEFAULT_DIR = "../out"
+CACHE_FILE = ".postprocess_cache.json"
+EXTENSIONS = (".txt", ".log")
+
+
+# ----------------------------------------------------------------------------------------
+# Cache {"version", "files" : {path : [size, mtime, hash]}, "stats" : {hash : stats}}
+# ----------------------------------------------------------------------------------------
+def load_cache(path, gap):
+    try:
+        with open(path) as f:
+            cache = json.load(f)
+        if cache.get("version") == results_stats.VERSION and cache.get("gap") == gap:
+            return cache
+    except (OSError, ValueError):
+        pass
+    return {"version": results_stats.VERSION, "gap": gap, "files": {}, "stats": {}}
+
+
+def save_cache(path, cache):
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(cache, f)
+    os.replace(tmp, path)
+
+
+def find_files(directory):
+    files = []
+    for root, dirs, names in os.walk(directory):
+        for name in names:
+            if name.endswith(EXTENSIONS):
+                files.append(os.path.join(root, name))
+    return sorted(files)
+
+
+# Worker - hash of the file and its stats (if they are not known yet)
+def process_file(path, known_hashes, gap):
+    h = results_stats.file_hash(path)
+    if h in known_hashes:
+        return h, None
+    return h, results_stats.file_stats(path, gap)
+
+
+def fmt(value, form="%.1f"):
+    return "-" if value is None else form % value
+
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Parallel post-processing of collected experiment results")
+    parser.add_argument("dir", nargs="?", default=DEFAULT_DIR, help="folder with collected results")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count(), help="number of worker processes")
+    parser.add_argument("--gap", type=float, default=results_stats.GAP, help="seconds without lines counted as a gap")
+    parser.add_argument("--no-cache", action="store_true", help="ignore cached results")
+    parser.add_argument("--json", help="also write per file stats and summary into this file")
+    args = parser.parse_args()
+
+    files = find_files(args.dir)
+    if not files:
+        print("No results in " + args.dir)
+        sys.exit(1)
+
+    cache_path = os.path.join(args.dir, CACHE_FILE)
+    cache = load_cache(cache_path, args.gap)
+    if args.no_cache:
+        cache["files"] = {}
+        cache["stats"] = {}
+
+    start = time.perf_counter()
+
+    # Files with same size and modification time as last time don't have to be hashed again
+    hashes = {}
+    todo = []
+    for path in files:
+        st = os.stat(path)
+        known = cache["files"].get(path)
+        if known and known[0] == st.st_size and known[1] == st.st_mtime and known[2] in cache["stats"]:
+            hashes[path] = known[2]
+        else:
+            todo.append((path, st))
+
+    # Process the rest in parallel - biggest files first, so workers finish at the same time
+    todo.sort(key=lambda x: -x[1].st_size)
+    known_hashes = set(cache["stats"])
+    if todo:
+        with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+            futures = [(path, st, pool.submit(process_file, path, known_hashes, args.gap)) for path, st in todo]
+            for path, st, fut in futures:
+                h, stats = fut.result()
+                hashes[path] = h
+                cache["files"][path] = [st.st_size, st.st_mtime, h]
+                if stats is not None:
+                    cache["stats"][h] = stats
+
+    # Forget files which are not there anymore
+    cache["files"] = {p: v for p, v in cache["files"].items() if p in hashes}
+    used = set(hashes.values())
+    cache["stats"] = {h: s for h, s in cache["stats"].items() if h in used}
+    save_cache(cache_path, cache)
+
+    elapsed = time.perf_counter() - start
+
+    # ------------------------------------------------------------------------------------
+    per_file = {path: cache["stats"][hashes[path]] for path in files}
+    total = results_stats.summary(list(per_file.values()))
+
+    print("%-40s %10s %8s %8s %8s %6s %9s %10s" %
+          ("file", "lines", "t/o", "warn", "err", "gaps", "max gap", "lat ms"))
+    for path, s in per_file.items():
+        lat = sum(s["latencies"]) / len(s["latencies"]) if s["latencies"] else None
+        print("%-40s %10d %8d %8d %8d %6s %9s %10s" %
+              (os.path.relpath(path, args.dir)[-40:], s["lines"], s["timeouts"], s["warnings"], s["errors"],
+               s.get("gaps", "-"), fmt(s.get("max_gap"), "%.2f s"), fmt(lat, "%.2f")))
+
+    print("\nSummary of %d files (%d results, %d logs):" % (total["files"], total["results_files"], total["log_files"]))
+    print("  lines:     %d (%s)" % (total["lines"], ", ".join("%s %d" % kv for kv in total["types"].items())))
+    print("  timeouts:  %d, warnings: %d, errors: %d" % (total["timeouts"], total["warnings"], total["errors"]))
+    if total["start"] is not None:
+        print("  duration:  %.1f s, gaps: %d (max %.2f s)" % (total["end"] - total["start"], total["gaps"], total["max_gap"]))
+    print("  commands:  %d, latency avg %s ms, p95 %s ms, max %s ms" %
+          (total["commands"], fmt(total["latency_avg"], "%.2f"), fmt(total["latency_p95"], "%.2f"), fmt(total["latency_max"], "%.2f")))
+    print("\nProcessed %d of %d files in %.2f s with %d workers" % (len(todo), len(files), elapsed, args.jobs))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"files": per_file, "summary": total}, f, indent=2)
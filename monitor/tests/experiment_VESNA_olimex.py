@@ -187,7 +187,7 @@ class ECMS_client():
 
             # --------------------------------------------------------------------------------
             # If there is still some message that didn't receive ACK back from server, re send it
-            elif (len(self.client.waitingForAck) != 0):
+            elif self.client.ack_pending():
                 self.client.send_retry()
                 #TODO self.queuePut(["-1", "BROKER_DIED"])
 
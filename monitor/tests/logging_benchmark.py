@@ -0,0 +1,153 @@
+#!/usr/bin/python3
+
+# ----------------------------------------------------------------------------------------
+# Benchmark of logging overhead per message in the controller main loop.
+#
+# For every response from a device the controller loop logs the same records as
+# ECMS_controller.py (backend receive, ACK send, frontend send, response). Compared are:
+#   before - logging.basicConfig file handler and eagerly formatted messages
+#   after  - lib/log_setup.py queue handler (file written by listener thread) and lazy
+#            %-formatting
+# at DEBUG level (all records written) and INFO level (debug records discarded).
+#
+# Messages arrive every --interval us and only the time spent in log calls of one message
+# is measured (mean, 99th percentile, max). Total time includes waiting for the listener
+# to write everything into the file.
+#
+# Usage: python3 logging_benchmark.py [-h] [--messages N] [--interval US] [--keep]
+# ----------------------------------------------------------------------------------------
+
+import os
+import sys
+import time
+import logging
+import argparse
+import tempfile
+
+# Workaround to import files from parent dir
+cdir = os.path.dirname(os.path.realpath(__file__))
+pdir = os.path.dirname(cdir)
+sys.path.append(pdir)
+
+from lib import log_setup
+
+
+MESSAGES = 100000
+INTERVAL = 200          # In us - time between messages (controller waits in poll)
+LOG_FORMAT = "%(asctime)s [%(levelname)7s]:[%(name)16s > %(funcName)16s() > %(lineno)3s] - %(message)s"
+
+
+# Log calls of one response in the controller loop - as they were
+def loop_before(log, mlog, n, interval):
+    times = []
+    for i in range(n):
+        idle(interval)
+        start = time.perf_counter()
+
+        nbr = str(i)
+        adr = "LGTC66"
+        data = "%d RSSI -71 LQI 104 node 51" % i
+
+        log.debug("Received from backend...")
+        log.debug("Router send message [%s]: %s to device %s" % ("ACK", nbr, adr))
+        log.debug("Send to frontend: [" + nbr +"|" + adr + "|" + data +"]")
+        mlog.debug("Response number [%s] from device %s: %s" % (nbr, adr, data))
+
+        times.append(time.perf_counter() - start)
+    return times
+
+
+# Log calls of one response in the controller loop - lazy formatting
+def loop_after(log, mlog, n, interval):
+    times = []
+    for i in range(n):
+        idle(interval)
+        start = time.perf_counter()
+
+        nbr = str(i)
+        adr = "LGTC66"
+        data = "%d RSSI -71 LQI 104 node 51" % i
+
+        log.debug("Received from backend...")
+        log.debug("Router send message [%s]: %s to device %s", "ACK", nbr, adr)
+        log.debug("Send to frontend: [%s|%s|%s]", nbr, adr, data)
+        mlog.debug("Response number [%s] from device %s: %s", nbr, adr, data)
+
+        times.append(time.perf_counter() - start)
+    return times
+
+
+# Loop waits for the next message in poll (GIL is released meanwhile)
+def idle(interval):
+    if interval:
+        end = time.perf_counter() + interval
+        while time.perf_counter() < end:
+            time.sleep(0)
+
+
+def reset_logging():
+    log_setup.shutdown()
+    root = logging.getLogger()
+    for h in root.handlers[:]:
+        root.removeHandler(h)
+        h.close()
+
+
+def run(mode, level, filename, n, interval):
+    reset_logging()
+    if os.path.exists(filename):
+        os.unlink(filename)
+
+    if mode == "before":
+        logging.basicConfig(format=LOG_FORMAT, level=level, filename=filename)
+        loop = loop_before
+    else:
+        log_setup.setup(filename, LOG_FORMAT, level)
+        loop = loop_after
+
+    log = logging.getLogger("zmq_broker")
+    mlog = logging.getLogger("main")
+    log_setup.set_level(level)
+
+    start = time.perf_counter()
+    times = loop(log, mlog, n, interval)
+
+    reset_logging()
+    drained = time.perf_counter() - start
+
+    lines = 0
+    with open(filename, "rb") as f:
+        for line in f:
+            lines += 1
+
+    times.sort()
+    return sum(times) / n, times[int(n * 0.99)], times[-1], drained, lines
+
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Logging overhead per message in the controller loop")
+    parser.add_argument("--messages", type=int, default=MESSAGES, help="number of messages")
+    parser.add_argument("--interval", type=float, default=INTERVAL, help="us between messages (0 = back to back)")
+    parser.add_argument("--keep", action="store_true", help="don't delete log file")
+    args = parser.parse_args()
+
+    filename = tempfile.NamedTemporaryFile(suffix=".log", delete=False).name
+
+    print("Controller loop logging, %d messages every %.0f us (4 records per message):" % (args.messages, args.interval))
+    print("  %-8s %-8s %10s %10s %10s %10s %10s" % ("level", "mode", "mean us", "p99 us", "max us", "total", "lines"))
+
+    for level in (logging.DEBUG, logging.INFO):
+        res = {}
+        for mode in ("before", "after"):
+            mean, p99, worst, total, lines = run(mode, level, filename, args.messages, args.interval / 1e6)
+            res[mode] = mean
+            print("  %-8s %-8s %10.2f %10.2f %10.1f %8.2f s %10d" %
+                  (logging.getLevelName(level), mode, mean * 1e6, p99 * 1e6, worst * 1e6, total, lines))
+        print("  %-8s %-8s %9.1fx" % ("", "speedup", res["before"] / res["after"]))
+
+    if args.keep:
+        print("Log file: " + filename)
+    else:
+        os.unlink(filename)
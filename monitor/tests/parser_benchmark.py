@@ -0,0 +1,153 @@
+#!/usr/bin/python3
+
+# ----------------------------------------------------------------------------------------
+# Benchmark of the vectorized results parser (lib/results_parser.py) against a plain
+# "for line in f" loop which extracts the same information (time, type, payload).
+#
+# A synthetic node_results file of given size is generated with file_logger (mostly
+# measurement lines with some responses, infos, LGTC lines, warnings and errors), or an
+# existing results file can be given with --file.
+#
+# Usage: python3 parser_benchmark.py [-h] [--size MB] [--file FILE] [--keep]
+# ----------------------------------------------------------------------------------------
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+import numpy as np
+
+# Workaround to import files from parent dir
+cdir = os.path.dirname(os.path.realpath(__file__))
+pdir = os.path.dirname(cdir)
+sys.path.append(pdir)
+
+from lib import file_logger
+from lib import results_parser
+from lib import measurement_store as ms
+
+
+SIZE = 1024         # In MB
+
+
+# ----------------------------------------------------------------------------------------
+# Generate results file with file_logger
+# ----------------------------------------------------------------------------------------
+def generate(filename, size):
+    f = file_logger.file_logger()
+    f.prepare_file(filename, "LGTC_BENCH")
+    f.open_file()
+
+    # Write in batches of 1000 lines with increasing timestamps - file_logger would take
+    # too long to generate a GB of lines one by one
+    t = 8 * 3600.0
+    batch = 1000
+    seq = 0
+    while f.file.tell() < size:
+        buf = bytearray()
+        for i in range(batch):
+            seq += 1
+            t += 0.0001
+            h, rem = divmod(t, 3600)
+            m, s = divmod(rem, 60)
+            prefix = b"[%02d:%02d:%09.6f]: " % (h, m, s)
+
+            if seq % 1000 == 0:
+                buf += prefix + b"$ PING\n"
+            elif seq % 1000 == 1:
+                buf += prefix + b"& JOIN_DAG\n"
+            elif seq % 5000 == 2:
+                buf += prefix + b"[LGTC_WARNING]:Command timeout occurred!\n"
+            elif seq % 5000 == 3:
+                buf += prefix + b"[LGTC_ERROR]:Couldn't sync with VESNA.\n"
+            elif seq % 5000 == 4:
+                buf += prefix + b"[LGTC]: Timeout detected.\n"
+            else:
+                buf += prefix + b"%d RSSI -71 LQI 104 node 51 payload 0123456789\n" % seq
+        f.file.write(buf)
+
+    f.close()
+
+
+# ----------------------------------------------------------------------------------------
+# Reference parser - one line at a time
+# ----------------------------------------------------------------------------------------
+def parse_loop(filename):
+    times = []
+    types = []
+    lengths = []
+
+    with open(filename, "rb") as f:
+        for line in f:
+            # Header lines don't start with a time prefix
+            if line[:1] != b"[":
+                continue
+
+            end = line.index(b"]")
+            h, m, s = line[1:end].split(b":")
+            t = int(h) * 3600 + int(m) * 60 + float(s)
+            payload = line[end + 3:].rstrip(b"\n")
+
+            ltype = ms.line_type(payload)
+            for tag, tt in results_parser.TAGS.items():
+                if payload.startswith(tag):
+                    ltype = tt
+                    payload = payload[len(tag):]
+                    break
+
+            times.append(t)
+            types.append(ltype)
+            lengths.append(len(payload))
+
+    return times, types, lengths
+
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Vectorized results parser benchmark")
+    parser.add_argument("--size", type=int, default=SIZE, help="size of generated file in MB")
+    parser.add_argument("--file", help="use existing results file instead of generating one")
+    parser.add_argument("--keep", action="store_true", help="don't delete generated file")
+    args = parser.parse_args()
+
+    filename = args.file
+    if filename is None:
+        filename = tempfile.NamedTemporaryFile(suffix=".txt", delete=False).name
+        print("Generating %d MB results file %s ..." % (args.size, filename))
+        generate(filename, args.size * 1024 * 1024)
+
+    size = os.path.getsize(filename) / 1024 / 1024
+
+    # Cold cache is not measured - read the file once, so both parsers start equal
+    with open(filename, "rb") as f:
+        while f.read(64 * 1024 * 1024):
+            pass
+
+    start = time.perf_counter()
+    r = results_parser.parse(filename)
+    vec = time.perf_counter() - start
+
+    start = time.perf_counter()
+    times, types, lengths = parse_loop(filename)
+    loop = time.perf_counter() - start
+
+    # Both parsers must agree
+    same = (len(times) == len(r) and
+            np.allclose(np.array(times), r.records["time"]) and
+            np.array_equal(np.array(types, dtype="u1"), r.records["type"]) and
+            np.array_equal(np.array(lengths), r.records["length"]))
+
+    print("File: %.0f MB, %d lines" % (size, len(r)))
+    print("  %-12s %8.2f s %8.1f MB/s" % ("for line", loop, size / loop))
+    print("  %-12s %8.2f s %8.1f MB/s" % ("vectorized", vec, size / vec))
+    print("  speedup      %8.1f x" % (loop / vec))
+    print("  results      %s" % ("equal" if same else "DIFFERENT"))
+
+    for ltype, name in enumerate(ms.LINE_TYPES):
+        print("  %-12s %8d lines" % (name, np.count_nonzero(r.records["type"] == ltype)))
+
+    if args.file is None and not args.keep:
+        os.unlink(filename)
@@ -0,0 +1,89 @@
+#!/usr/bin/python3
+
+# ----------------------------------------------------------------------------------------
+# Regression test: clock offset of a node changes during the experiment.
+#
+# A new "[LGTC]: CLOCK_OFFSET" line with a bigger offset moves the corrected time of the
+# following lines back. results_merge must still give every node's lines in order (and
+# so the merged timeline sorted), otherwise heapq.merge silently mixes up the order.
+#
+# Usage: python3 results_merge_offset.py
+# ----------------------------------------------------------------------------------------
+
+import os
+import sys
+import tempfile
+
+# Workaround to import files from parent dir
+cdir = os.path.dirname(os.path.realpath(__file__))
+pdir = os.path.dirname(cdir)
+sys.path.append(pdir)
+
+from lib import results_merge
+
+
+HEADER = (b"2026-10-18 12:00:00.000000\n"
+          b"----------------------------------------------------------------------------------------------- \n"
+          b"SERIAL INPUT FROM LGTC DEVICE %s\n"
+          b"CLOCK OFFSET 0.000000 s (RTT 0.001000 s)\n"
+          b"----------------------------------------------------------------------------------------------- \n")
+
+
+def write_node(path, node, lines, segment=None):
+    name = "node_results_" + node + ("" if segment is None else ".%03d" % segment) + ".txt"
+    with open(os.path.join(path, name), "wb") as f:
+        f.write(HEADER % node.encode())
+        for tod, payload in lines:
+            f.write(b"[12:00:%09.6f]: " % tod + payload + b"\n")
+    return os.path.join(path, name)
+
+
+def test_offset_change():
+    with tempfile.TemporaryDirectory() as path:
+        # Node A clock jumps 2 s ahead at 10 s - new offset is 2 s
+        a = write_node(path, "A", [
+            (1.0, b"a1"),
+            (9.5, b"a2"),
+            (10.0, b"[LGTC]: CLOCK_OFFSET 2.000000"),
+            (10.5, b"a3"),
+            (11.0, b"a4"),
+            (13.0, b"a5"),
+        ])
+        b = write_node(path, "B", [(t, b"b%d" % t) for t in range(0, 15)])
+
+        merged = list(results_merge.merge([a, b]))
+        times = [t for t, node, payload in merged]
+        assert times == sorted(times), "merged timeline is not sorted"
+
+        a_lines = [(t, payload) for t, node, payload in merged if node == "A"]
+        start = a_lines[0][0] - 1.0
+
+        # Lines before the node time catches up keep the last corrected time, then offset applies
+        assert [t - start for t, payload in a_lines] == [1.0, 9.5, 9.5, 9.5, 9.5, 11.0], a_lines
+        assert len(merged) == 6 + 15
+
+
+# Rotated segments repeat the startup header (offset 0) - it must not undo a later CLOCK_OFFSET line
+def test_offset_in_segments():
+    with tempfile.TemporaryDirectory() as path:
+        s0 = write_node(path, "A", [
+            (1.0, b"[LGTC]: CLOCK_OFFSET 5.000000"),
+            (6.0, b"a1"),
+            (7.0, b"a2"),
+        ], segment=0)
+        s1 = write_node(path, "A", [
+            (8.0, b"a3"),
+            (9.0, b"a4"),
+        ], segment=1)
+
+        a_lines = [(t, payload) for t, node, payload in results_merge.merge([s1, s0])][1:]
+        start = a_lines[0][0]
+
+        assert [t - start for t, payload in a_lines] == [0.0, 1.0, 2.0, 3.0], a_lines
+
+
+
+if __name__ == "__main__":
+    test_offset_change()
+    test_offset_in_segments()
+    print("OK")
@@ -0,0 +1,264 @@
+#!/usr/bin/python3
+
+# ----------------------------------------------------------------------------------------
+# Benchmark of serial_monitor + serial_monitor_thread + file_logger without VESNA hardware.
+#
+# Serial port is replaced with a virtual VESNA on a Linux pseudo-terminal (virtual_vesna.py),
+# so the whole chain can be measured on any machine. For every read mode it reports:
+#   * idle     - CPU usage of the monitor thread when nothing is happening
+#   * lines/s  - sustained rate of lines stored into results file
+#   * lost     - lines VESNA sent but were not stored and bytes dropped on the pty
+#   * CPU      - CPU usage of the monitor thread (in percent of one core)
+#   * latency  - time from command put in the queue to its "$" response from the thread
+#   * burst    - time to get responses on a burst of commands for different command windows
+#
+# With --sync-writer results file is written directly from the serial thread (no writer thread).
+#
+# Usage: python3 serial_benchmark.py [-h] [--modes ...] [--rates ...] [--size N] [--time S]
+#                                   [--framing line|binary] [--windows ...] [--sync-writer]
+# ----------------------------------------------------------------------------------------
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import logging
+
+# Workaround to import files from parent dir
+cdir = os.path.dirname(os.path.realpath(__file__))
+pdir = os.path.dirname(cdir)
+sys.path.append(pdir)
+
+from lib import measurement_store
+from lib import serial_monitor_thread
+from lib import thread_queue
+
+from virtual_vesna import virtual_vesna
+
+
+MODES = ["spin", "event"]
+RATES = [1000, 10000, 0]    # Lines per second, 0 = as fast as virtual VESNA can go
+LINE_SIZE = 64              # In bytes
+DURATION = 5                # In seconds
+COMMANDS = 20               # Number of commands sent during one measurement
+WINDOWS = [1, 8]            # Command windows for the burst test
+CMD_BURST_TIMEOUT = 10      # In seconds
+ASYNC_WRITER = True         # Results file written by file_logger writer thread
+
+
+# Serial monitor thread without compiling and flashing VESNA
+class bench_thread(serial_monitor_thread.serial_monitor_thread):
+
+    def VESNA_flash(self):
+        return True
+
+
+# CPU time used by given thread (in seconds)
+def thread_cpu(t):
+    return time.clock_gettime(time.pthread_getcpuclockid(t.ident))
+
+
+class bench():
+
+    def __init__(self, mode, rate=0, size=LINE_SIZE, framing="line", window=1):
+        self.vesna = virtual_vesna(rate, size, framing=framing)
+        self.vesna.start()
+        os.close(self.vesna.master)
+
+        self.results = tempfile.NamedTemporaryFile(suffix=".txt", delete=False).name
+
+        self.in_q = thread_queue.wakeup_queue()
+        self.out_q = thread_queue.wakeup_queue()
+
+        self.t = bench_thread(self.in_q, self.out_q, self.results, "LGTC_BENCH", "bench", cdir, read_mode=mode, framing=framing, cmd_window=window, async_writer=ASYNC_WRITER)
+        self.t.port = self.vesna.port
+        self.t.start()
+
+        # Wait until thread is synced with virtual VESNA
+        self.wait_for("STATE", "ONLINE", 5)
+
+        self._sqn = 0
+
+
+    # Wait for a message from serial monitor thread
+    def wait_for(self, sqn, resp=None, timeout=3):
+        end = time.monotonic() + timeout
+        while time.monotonic() < end:
+            self.out_q.clear_wakeup()
+            while not self.out_q.empty():
+                s, r = self.out_q.get()
+                if s == sqn and (resp is None or r == resp):
+                    return True
+            self.out_q.clear_wakeup()
+            time.sleep(0.0005)
+        return False
+
+
+    # Send command to VESNA through the thread and return latency in seconds (None on timeout)
+    def command(self, cmd, timeout=3):
+        self._sqn += 1
+        sqn = str(self._sqn)
+        start = time.monotonic()
+        self.in_q.put([sqn, cmd])
+        if not self.wait_for(sqn, None, timeout):
+            return None
+        return time.monotonic() - start
+
+
+    def close(self):
+        self.t._is_thread_running = False
+        self.in_q.wakeup()
+        self.t.join()
+        self.t.monitor.close()
+        self.t.f.close()
+
+        self.vesna.stop()
+        self.vesna.join()
+
+        self.in_q.close()
+        self.out_q.close()
+        os.unlink(self.results)
+        # Columnar store of binary measurement frames
+        shutil.rmtree(os.path.splitext(self.results)[0] + measurement_store.STORE_EXT, ignore_errors=True)
+
+
+# ----------------------------------------------------------------------------------------
+# Measure CPU usage of the thread while it has nothing to do
+#
+#   @return:    CPU usage in percent of one core
+# ----------------------------------------------------------------------------------------
+def idle_cpu(mode, duration, framing="line"):
+
+    b = bench(mode, framing=framing)
+
+    cpu_start = thread_cpu(b.t)
+    wall_start = time.monotonic()
+    time.sleep(duration)
+    cpu = thread_cpu(b.t) - cpu_start
+    wall = time.monotonic() - wall_start
+
+    b.close()
+    return 100 * cpu / wall
+
+
+# ----------------------------------------------------------------------------------------
+# Let virtual VESNA emit lines with given rate and send commands in between
+#
+#   @return:    dict with lines/s, lost lines, dropped bytes, CPU % and command latencies
+# ----------------------------------------------------------------------------------------
+def throughput(mode, rate, size, duration, framing="line", commands=COMMANDS):
+
+    b = bench(mode, rate, size, framing)
+
+    # Both virtual VESNA and the thread reset their line counters on START
+    b.command("START")
+    cpu_start = thread_cpu(b.t)
+    wall_start = time.monotonic()
+
+    latency = []
+    timeouts = 0
+    for i in range(commands):
+        time.sleep(duration / commands)
+        l = b.command("PING")
+        if l is None:
+            timeouts += 1
+        else:
+            latency.append(l)
+
+    wall = time.monotonic() - wall_start
+    cpu = thread_cpu(b.t) - cpu_start
+    lines = b.t.lines_stored
+
+    # Stop the measurements and let the thread store what is left in buffers
+    b.command("STOP", 10)
+    sent = b.vesna.lines_sent.value - 1     # Without "$ START" line
+    stored = b.t.lines_stored
+
+    res = {
+        "rate":     lines / wall,
+        "lost":     sent - stored,
+        "dropped":  b.vesna.bytes_dropped.value,
+        "cpu":      100 * cpu / wall,
+        "lat_avg":  1000 * sum(latency) / len(latency) if latency else float("nan"),
+        "lat_max":  1000 * max(latency) if latency else float("nan"),
+        "timeouts": timeouts,
+    }
+
+    b.close()
+    return res
+
+
+# ----------------------------------------------------------------------------------------
+# Put a burst of commands in the queue at once and wait for all responses
+#
+#   @return:    total time in seconds (None if some response didn't come)
+# ----------------------------------------------------------------------------------------
+def burst(mode, window, framing="line", commands=COMMANDS):
+
+    b = bench(mode, framing=framing, window=window)
+
+    start = time.monotonic()
+    sqns = set()
+    for i in range(commands):
+        sqns.add(str(i + 1))
+        b.in_q.put([str(i + 1), "PING"])
+
+    end = start + CMD_BURST_TIMEOUT
+    while sqns and time.monotonic() < end:
+        b.out_q.clear_wakeup()
+        while not b.out_q.empty():
+            sqns.discard(b.out_q.get()[0])
+        time.sleep(0.0005)
+
+    total = time.monotonic() - start
+    b.close()
+
+    if sqns:
+        return None
+    return total
+
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Serial monitor benchmark with virtual VESNA")
+    parser.add_argument("--modes", nargs="+", default=MODES, help="read modes of serial_monitor_thread")
+    parser.add_argument("--rates", nargs="+", type=int, default=RATES, help="lines per second (0 = max)")
+    parser.add_argument("--size", type=int, default=LINE_SIZE, help="line size in bytes")
+    parser.add_argument("--time", type=float, default=DURATION, help="seconds per measurement")
+    parser.add_argument("--framing", default="line", choices=["line", "binary"], help="UART framing")
+    parser.add_argument("--windows", nargs="+", type=int, default=WINDOWS, help="command windows for burst test")
+    parser.add_argument("--sync-writer", action="store_true", help="write results file from the serial thread")
+    args = parser.parse_args()
+
+    ASYNC_WRITER = not args.sync_writer
+
+    # Modules set their own log level, so silence everything below warnings here
+    logging.basicConfig()
+    logging.disable(logging.INFO)
+
+    print("Idle CPU usage (%.1f s per mode):" % args.time)
+    for mode in args.modes:
+        print("  %-8s %6.2f %%" % (mode, idle_cpu(mode, args.time, args.framing)))
+
+    print("\nThroughput with %d byte %s frames (%.1f s per measurement):" % (args.size, args.framing, args.time))
+    print("  %-8s %8s %10s %8s %10s %7s %10s %10s %5s" %
+        ("mode", "target", "lines/s", "lost", "dropped B", "CPU %", "lat avg ms", "lat max ms", "t/o"))
+
+    for mode in args.modes:
+        for rate in args.rates:
+            r = throughput(mode, rate, args.size, args.time, args.framing)
+            print("  %-8s %8s %10.0f %8d %10d %7.1f %10.2f %10.2f %5d" %
+                (mode, rate if rate else "max", r["rate"], r["lost"], r["dropped"], r["cpu"],
+                r["lat_avg"], r["lat_max"], r["timeouts"]))
+
+    print("\nBurst of %d commands:" % COMMANDS)
+    for mode in args.modes:
+        for window in args.windows:
+            total = burst(mode, window, args.framing)
+            if total is None:
+                print("  %-8s window %3d   timeout" % (mode, window))
+            else:
+                print("  %-8s window %3d %8.2f ms (%.2f ms per command)" % (mode, window, total * 1000, total * 1000 / COMMANDS))
@@ -0,0 +1,77 @@
+#!/usr/bin/python3
+
+# ----------------------------------------------------------------------------------------
+# Regression test: burst of lines right after the sync character.
+#
+# VESNA answers the sync with "@" and may send more lines in the same burst. read_line()
+# in sync_with_vesna() takes only the "@" line, the rest stays in serial_monitor.lines and
+# must be given out by the next read_raw_lines() - without waiting for the serial timeout
+# and without input_waiting() staying True forever.
+#
+# Runs on a Linux pseudo-terminal, no device needed.
+#
+# Usage: python3 serial_sync_burst.py
+# ----------------------------------------------------------------------------------------
+
+import os
+import sys
+import pty
+import time
+import serial
+import threading
+
+# Workaround to import files from parent dir
+cdir = os.path.dirname(os.path.realpath(__file__))
+pdir = os.path.dirname(cdir)
+sys.path.append(pdir)
+
+from lib import serial_monitor
+
+
+BURST = b"@\n$ START\nmeas 1\n"
+TIMEOUT = 2
+
+
+# Answer the sync character with the whole burst
+def vesna(master):
+    while os.read(master, 64).find(b"@") < 0:
+        pass
+    os.write(master, BURST)
+
+
+def test_burst_after_sync():
+    master, slave = pty.openpty()
+
+    monitor = serial_monitor.serial_monitor(timeout=TIMEOUT)
+    monitor.ser = serial.Serial(os.ttyname(slave), timeout=TIMEOUT)
+
+    t = threading.Thread(target=vesna, args=(master,), daemon=True)
+    t.start()
+
+    assert monitor.sync_with_vesna(), "no sync"
+    t.join()
+
+    # Rest of the burst is waiting in the monitor
+    assert monitor.input_waiting()
+
+    start = time.monotonic()
+    lines = [bytes(line) for line in monitor.read_raw_lines()]
+    elapsed = time.monotonic() - start
+
+    assert lines == [b"$ START\n", b"meas 1\n"], lines
+    assert elapsed < TIMEOUT / 2, "read_raw_lines() waited for serial timeout (%.1f s)" % elapsed
+    assert not monitor.input_waiting()
+
+    # Next lines are read from the port again
+    os.write(master, b"meas 2\n")
+    assert monitor.read_lines() == ["meas 2\n"]
+
+    monitor.close()
+    os.close(master)
+    os.close(slave)
+
+
+
+if __name__ == "__main__":
+    test_burst_after_sync()
+    print("OK")
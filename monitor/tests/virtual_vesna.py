@@ -0,0 +1,234 @@
+#!/usr/bin/python3
+
+# ----------------------------------------------------------------------------------------
+# Virtual VESNA device on a Linux pseudo-terminal.
+#
+# Speaks the same UART protocol as experiment applications on VESNA:
+#   "@"       - sync, answered with "@"
+#   "$ CMD"   - command, answered with "$ CMD" (START/STOP also start/stop measurements)
+#   "$t CMD"  - tagged command, answered with "$t CMD"
+#   "="       - stop the application
+#
+# With binary framing the same messages are sent in frames (see lib/serial_monitor.py) and
+# measurements are sent as binary "M" frames.
+#
+# While application is running it emits measurement lines of given size with given rate.
+# Runs in its own process so it doesn't compete for GIL with the serial monitor thread.
+# If LGTC side doesn't read fast enough, bytes that don't fit in the pty buffer are
+# dropped (like on UART overflow) and counted.
+#
+# Usage: python3 virtual_vesna.py [lines_per_second] [line_size] [line|binary]
+# ----------------------------------------------------------------------------------------
+
+import os
+import sys
+import time
+import select
+import struct
+import termios
+import multiprocessing
+
+# Workaround to import files from parent dir
+cdir = os.path.dirname(os.path.realpath(__file__))
+pdir = os.path.dirname(cdir)
+sys.path.append(pdir)
+
+from lib import serial_monitor
+
+
+DEFAULT_RATE = 100      # Lines per second (0 = as fast as possible)
+DEFAULT_SIZE = 64       # Bytes per line (including \n)
+MAX_BURST = 256         # Max lines written at once
+
+
+class virtual_vesna(multiprocessing.Process):
+
+    def __init__(self, rate=DEFAULT_RATE, size=DEFAULT_SIZE, autostart=False, framing="line"):
+
+        multiprocessing.Process.__init__(self, daemon=True)
+
+        self.framing = framing
+        self.rate = rate
+        self.size = max(size, 16)
+        self.autostart = autostart
+
+        # Pseudo-terminal pair - LGTC opens the slave, we use the master
+        self.master, slave = os.openpty()
+        self.port = os.ttyname(slave)[len("/dev/"):]
+
+        # Raw mode on both sides, so pty doesn't echo or translate anything
+        attr = termios.tcgetattr(slave)
+        attr[0] = attr[1] = attr[3] = 0
+        termios.tcsetattr(slave, termios.TCSANOW, attr)
+        os.close(slave)
+
+        self._stop_event = multiprocessing.Event()
+
+        # Statistics (shared with parent process)
+        self.lines_sent = multiprocessing.Value("q", 0)
+        self.bytes_sent = multiprocessing.Value("q", 0)
+        self.bytes_dropped = multiprocessing.Value("q", 0)
+        self.commands = multiprocessing.Value("q", 0)
+
+
+    # ----------------------------------------------------------------------------------------
+    # MAIN
+    # ----------------------------------------------------------------------------------------
+    def run(self):
+
+        os.set_blocking(self.master, False)
+
+        self._rx = bytearray()
+        self._decoder = serial_monitor.frame_decoder()
+        self._running = self.autostart
+        self._start_time = time.monotonic()
+        self._seq = 0
+
+        while not self._stop_event.is_set():
+
+            timeout = 0.1
+            if self._running:
+                timeout = 0.001
+
+            r, w, x = select.select([self.master], [], [], timeout)
+            if r:
+                self.receive()
+
+            if self._running:
+                self.measure()
+
+        os.close(self.master)
+
+
+    def stop(self):
+        self._stop_event.set()
+
+
+    # ----------------------------------------------------------------------------------------
+    # UART PROTOCOL
+    # ----------------------------------------------------------------------------------------
+    def receive(self):
+        try:
+            data = os.read(self.master, 4096)
+        except (BlockingIOError, OSError):
+            return
+
+        if self.framing == "binary":
+            self._decoder.feed(data)
+            for ftype, payload in self._decoder.frames():
+                self.handle(chr(ftype) + str(payload, "ascii", "replace"))
+            return
+
+        self._rx += data
+        while b"\n" in self._rx:
+            line, _, self._rx = bytes(self._rx).partition(b"\n")
+            self.handle(line.decode(errors="replace"))
+
+
+    def handle(self, line):
+
+        if not line:
+            return
+
+        if line[0] == "@":
+            self.send_line(b"@")
+
+        elif line[0] == "=":
+            self._running = False
+
+        elif line[0] == "$":
+            self.commands.value += 1
+
+            # Tagged command "$<tag> CMD" - echo the tag back
+            if line[1:2] in ("", " "):
+                prefix = "$ "
+                cmd = line[2:]
+            else:
+                prefix = "$" + line[1] + " "
+                cmd = line[3:]
+
+            if cmd == "START":
+                self.lines_sent.value = 0
+                self.bytes_sent.value = 0
+                self.bytes_dropped.value = 0
+                self._running = True
+                self._start_time = time.monotonic()
+                self._seq = 0
+
+            elif cmd == "STOP":
+                self._running = False
+
+            self.send_line((prefix + cmd).encode())
+
+
+    # Emit as many measurement lines as needed to keep up with the given rate
+    def measure(self):
+
+        if self.rate:
+            due = int((time.monotonic() - self._start_time) * self.rate) - self._seq
+        else:
+            due = MAX_BURST
+
+        for i in range(min(due, MAX_BURST)):
+            self._seq += 1
+            if self.framing == "binary":
+                # Frame overhead is 6 bytes, payload starts with 32 bit sequence number
+                payload = struct.pack("<I", self._seq)
+                self.send(serial_monitor.encode_frame(serial_monitor.FRAME_DATA, payload + bytes(self.size - 10)))
+            else:
+                head = b"%d " % self._seq
+                self.send_line(head + b"x" * (self.size - len(head) - 1))
+
+        # We are too far behind - don't try to catch up
+        if due > MAX_BURST:
+            self._seq += due - MAX_BURST
+
+
+    def send_line(self, line):
+        if self.framing == "binary":
+            self.send(serial_monitor.encode_frame(line[0], line[1:]))
+        else:
+            self.send(line + b"\n")
+
+    def send(self, data):
+        try:
+            n = os.write(self.master, data)
+        except BlockingIOError:
+            n = 0
+
+        self.lines_sent.value += 1
+        self.bytes_sent.value += n
+        self.bytes_dropped.value += len(data) - n
+
+
+
+if __name__ == "__main__":
+
+    try:
+        rate = int(sys.argv[1])
+    except:
+        rate = DEFAULT_RATE
+
+    try:
+        size = int(sys.argv[2])
+    except:
+        size = DEFAULT_SIZE
+
+    try:
+        framing = sys.argv[3]
+    except:
+        framing = "line"
+
+    vesna = virtual_vesna(rate, size, framing=framing)
+    vesna.start()
+    os.close(vesna.master)
+
+    print("Virtual VESNA on /dev/%s (%d lines/s, %d bytes per line, %s framing)" % (vesna.port, rate, size, framing))
+
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        vesna.stop()
+        vesna.join()
+        print("Sent %d lines (%d bytes), dropped %d bytes" % (vesna.lines_sent.value, vesna.bytes_sent.value, vesna.bytes_dropped.value))